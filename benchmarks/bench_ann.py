@@ -0,0 +1,63 @@
+"""
+Recall and latency of the IVF index against brute-force cosine search, run from the project root with
+    python -m benchmarks.bench_ann --rows 100000 --dim 256
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+
+from src.search import IVFIndex
+from src.search.exact import ExactIndex
+
+
+def make_embeddings(rows, dim, clusters=200, seed=0):
+    # Clustered data, uniform noise would make every index look bad
+    random = np.random.default_rng(seed)
+    centers = random.normal(size=(clusters, dim)).astype(np.float32)
+    labels = random.integers(clusters, size=rows)
+    return centers[labels] + 0.5 * random.normal(size=(rows, dim)).astype(np.float32)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+
+    embeddings = make_embeddings(args.rows, args.dim)
+    queries = make_embeddings(args.queries, args.dim, seed=1)
+
+    start = perf_counter()
+    exact = ExactIndex(embeddings)
+    print(f'exact normalize: {perf_counter() - start:.2f}s')
+    start = perf_counter()
+    truth = exact.search(queries, args.k)[0]
+    print(f'exact batched: {(perf_counter() - start) / args.queries * 1000:.2f} ms/query')
+    start = perf_counter()
+    for query in queries[:20]:
+        exact.search(query, args.k)
+    print(f'exact single: {(perf_counter() - start) / 20 * 1000:.2f} ms/query')
+
+    start = perf_counter()
+    index = IVFIndex().build(embeddings)
+    print(f'build: {perf_counter() - start:.2f}s for {args.rows} rows, {index.n_lists} lists')
+
+    for n_probe in (1, 2, 4, 8, 16, 32):
+        start = perf_counter()
+        found = [index.query(query, args.k, n_probe)[0] for query in queries]
+        latency = (perf_counter() - start) / args.queries
+        recall = np.mean([len(np.intersect1d(ids, expected)) / args.k for ids, expected in zip(found, truth)])
+        print(f'n_probe {n_probe:>3}: recall@{args.k} {recall:.3f}  {latency * 1000:.2f} ms/query')
+
+    extra = make_embeddings(args.rows // 10, args.dim, seed=2)
+    start = perf_counter()
+    index.add(extra, np.arange(args.rows, args.rows + len(extra)))
+    index.compact()
+    print(f'insert + compact {len(extra)} rows: {perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
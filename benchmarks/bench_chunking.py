@@ -0,0 +1,75 @@
+"""
+Chunking throughput, run from the project root with
+    python -m benchmarks.bench_chunking --documents 200 --words 5000
+"""
+from argparse import ArgumentParser
+from random import Random
+from time import perf_counter
+
+from src.chunking import DEFAULT_CHUNK_SIZE, chunk_spans
+from src.utils import chunk_text
+
+WORDS = ['the', 'embedding', 'of', 'a', 'note', 'is', 'computed', 'from', 'its', 'chunks', 'hierarchical', 'map']
+
+
+def legacy_chunk_text(text, chunk_size=512):
+    # The previous utils.chunk_text, kept for comparison
+    tokens = text.split()
+    chunks = []
+    chunk = []
+    for token in tokens:
+        if len(chunk) + len(token) + 1 <= chunk_size:
+            chunk.append(token)
+        else:
+            chunks.append(' '.join(chunk))
+            chunk = [token]
+    if len(chunk) > 0:
+        chunks.append(' '.join(chunk))
+    return chunks
+
+
+def make_documents(count, words, seed=0):
+    random = Random(seed)
+    documents = []
+    for _ in range(count):
+        parts = []
+        for ix in range(words):
+            parts.append(random.choice(WORDS))
+            if ix % 17 == 16:
+                parts[-1] += '.'
+            if ix % 120 == 119:
+                parts[-1] += '\n\n'
+        documents.append(' '.join(parts))
+    return documents
+
+
+def bench(name, documents, function):
+    start = perf_counter()
+    chunks = 0
+    for document in documents:
+        chunks += len(function(document))
+    elapsed = perf_counter() - start
+    megabytes = sum(len(document) for document in documents) / 1e6
+    print(f'{name:<32} {elapsed:8.3f}s {megabytes / elapsed:8.2f} MB/s {chunks / elapsed:10.0f} chunks/s')
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--documents', type=int, default=200)
+    parser.add_argument('--words', type=int, default=5000)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    documents = make_documents(args.documents, args.words)
+    size = args.chunk_size
+    bench('legacy chunk_text', documents, lambda text: legacy_chunk_text(text, size))
+    bench('chunk_text words', documents, lambda text: chunk_text(text, size))
+    bench('chunk_spans words', documents, lambda text: chunk_spans(text, size))
+    bench('chunk_spans words overlap', documents, lambda text: chunk_spans(text, size, overlap=size // 8))
+    bench('chunk_spans words sentence', documents, lambda text: chunk_spans(text, size, boundary='sentence'))
+    bench('chunk_spans chars', documents, lambda text: chunk_spans(text, size * 6, unit='chars'))
+    bench('chunk_spans chars paragraph', documents, lambda text: chunk_spans(text, size * 6, unit='chars', boundary='paragraph'))
+
+
+if __name__ == '__main__':
+    main()
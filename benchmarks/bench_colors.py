@@ -0,0 +1,75 @@
+"""
+Speed of coloring a dendrogram, run from the project root with
+    python -m benchmarks.bench_colors --leaves 10000 100000 1000000
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+
+import matplotlib.colors as mcolors
+import numpy as np
+
+from src.color_utils import blend_colors, blend_pca_colors, color_to_hex
+
+
+def make_linkage(leaves, seed=0):
+    # A random binary tree built level by level, scipy's linkage cannot cluster a million rows
+    random = np.random.default_rng(seed)
+    pool = random.permutation(leaves)
+    sizes = np.ones(2 * leaves - 1)
+    rows = []
+    next_id = leaves
+    height = 0
+    while len(pool) > 1:
+        height += 1
+        pairs = pool[:len(pool) // 2 * 2].reshape(-1, 2)
+        ids = np.arange(next_id, next_id + len(pairs))
+        sizes[ids] = sizes[pairs[:, 0]] + sizes[pairs[:, 1]]
+        rows.append(np.column_stack([pairs, np.full(len(pairs), height), sizes[ids]]))
+        next_id += len(pairs)
+        pool = random.permutation(np.concatenate([ids, pool[len(pairs) * 2:]]))
+    return np.concatenate(rows).astype(np.float64)
+
+
+def legacy_blend_pca_colors(linked, colors, file_count):
+    # The loop blend_pca_colors replaced, with the cluster size lookup corrected
+    for row in linked:
+        cluster1_id = int(row[0])
+        cluster2_id = int(row[1])
+        cluster1_size = 1 if cluster1_id < file_count else linked[cluster1_id - file_count][-1]
+        cluster2_size = 1 if cluster2_id < file_count else linked[cluster2_id - file_count][-1]
+        t = cluster2_size / (cluster1_size + cluster2_size)
+        colors = np.vstack((colors, blend_colors(colors[cluster1_id], colors[cluster2_id], t)))
+    return colors
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--leaves', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--legacy-max', type=int, default=10000, help='Largest tree to run the old quadratic loop on')
+    args = parser.parse_args()
+
+    for leaves in args.leaves:
+        linked = make_linkage(leaves)
+        colors = np.random.default_rng(1).random((leaves, 3))
+
+        start = perf_counter()
+        blended = blend_pca_colors(linked, colors, leaves)
+        blend_time = perf_counter() - start
+        start = perf_counter()
+        hex_colors = color_to_hex(blended)
+        hex_time = perf_counter() - start
+        print(f'{leaves} leaves: blend {blend_time * 1000:.1f} ms, hex {hex_time * 1000:.1f} ms')
+
+        if leaves <= args.legacy_max:
+            start = perf_counter()
+            expected = legacy_blend_pca_colors(linked, colors, leaves)
+            legacy_time = perf_counter() - start
+            start = perf_counter()
+            expected_hex = [mcolors.to_hex(color) for color in expected]
+            legacy_hex_time = perf_counter() - start
+            print(f'{leaves} leaves: legacy blend {legacy_time * 1000:.1f} ms, legacy hex {legacy_hex_time * 1000:.1f} ms, '
+                  f'max difference {np.abs(blended - expected).max():.2e}, hex equal {hex_colors == expected_hex}')
+
+
+if __name__ == '__main__':
+    main()
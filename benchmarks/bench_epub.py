@@ -0,0 +1,92 @@
+"""
+EPUB extraction throughput on large synthetic books, run from the project root with
+    python -m benchmarks.bench_epub --books 10 --chapters 100 --words 5000
+"""
+import xml.etree.ElementTree as ET
+from argparse import ArgumentParser
+from os.path import dirname
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from zipfile import ZipFile
+
+from benchmarks.synthetic import make_library
+from src.data_extract.epub import EPUB_EMBEDDINGS, EpubExtract
+
+
+class LegacyEpubExtract(EpubExtract):
+    # The previous parser, kept for comparison: a full tree per chapter and a manifest scan per spine entry
+
+    def _get_text_data(self, itemid, data, debug=False):
+        try:
+            root = ET.fromstring(data)
+        except ET.ParseError:
+            return
+        body = root.find('.//{http://www.w3.org/1999/xhtml}body')
+        header = body.find('.//{http://www.w3.org/1999/xhtml}h1')
+        text = '\n'.join([p.text for p in body.findall('.//*') if p.text is not None]).strip()
+        if header is None or header.text is None:
+            if len(self._data['chapters']) == 0:
+                return
+            self._data['chapters'][-1]['text'] += '\n' + text
+            return
+        title = header.text
+        if text.startswith(title):
+            text = text[len(title):].strip()
+        if len(text) == 0:
+            return
+        self._data['chapters'].append({'id': itemid, 'title': title, 'text': text})
+
+    def _load_data(self, filepath, debug=False):
+        self._data = {'filepath': filepath, 'book_name': '', 'author': '', 'chapters': []}
+        with ZipFile(filepath, 'r') as zip_file:
+            with zip_file.open('META-INF/container.xml') as container:
+                manifest_path = ET.fromstring(container.read()).find(".//*[@full-path]").get('full-path')
+            if manifest_path not in zip_file.namelist():
+                return 0
+            manifest_dir = dirname(manifest_path)
+            with zip_file.open(manifest_path) as manifest:
+                root = ET.fromstring(manifest.read())
+                items = root.findall('.//{http://www.idpf.org/2007/opf}manifest/{http://www.idpf.org/2007/opf}item')
+                for ref in root.find('.//{http://www.idpf.org/2007/opf}spine'):
+                    item = [x for x in items if x.get('id') == ref.get('idref')][0]
+                    if item.get('media-type') not in ('application/xhtml+xml',) or item.get('properties') in ('nav',):
+                        continue
+                    with zip_file.open(manifest_dir + '/' + item.get('href')) as text_file:
+                        self._get_text_data(item.get('id'), text_file.read(), debug)
+        return len(self._data['chapters'])
+
+
+def bench(name, extractor, files, megabytes):
+    chapters = 0
+    characters = 0
+    elapsed = 0
+    for filepath in files:
+        start = perf_counter()
+        chapters += extractor._load_data(filepath)
+        elapsed += perf_counter() - start
+        characters += sum(len(chapter['text']) for chapter in extractor._data['chapters'])
+    print(f'{name:<10} {elapsed:8.3f}s {len(files) / elapsed:8.2f} books/s {chapters / elapsed:10.1f} chapters/s '
+          f'{megabytes / elapsed:8.2f} MB/s  {characters} characters kept')
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--books', type=int, default=10)
+    parser.add_argument('--chapters', type=int, default=100)
+    parser.add_argument('--words', type=int, default=5000, help='Words per chapter')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as folder:
+        size = make_library(folder, args.books, args.chapters, args.words)
+        extractor = EpubExtract()
+        files = extractor.list_files(folder)
+        megabytes = size / 1e6
+        bench('legacy', LegacyEpubExtract(), files, megabytes)
+        bench('streaming', extractor, files, megabytes)
+        start = perf_counter()
+        extractor.extract_files(files, EPUB_EMBEDDINGS)
+        print(f'extract_files {perf_counter() - start:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+End to end pipeline benchmark on synthetic data with a fake Cohere client, run from the project root with
+    python -m benchmarks.bench_pipeline --notes 2000 --books 20 --output results.json
+and compare a later run against it with
+    python -m benchmarks.bench_pipeline --notes 2000 --books 20 --compare results.json
+Stages call the same functions as src.main: extraction into Parquet datasets, an incremental merge, chunking and
+embedding streamed from the datasets and the reductions of the combined stores.
+Every stage reports wall time, files/s, chunks/s, MB/s and the peak resident memory of the process while it ran,
+see PeakMemory for what is measured where /proc is missing
+"""
+import json
+import os
+import platform
+import tracemalloc
+from argparse import ArgumentParser
+from os.path import join
+from sys import platform as system
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from time import perf_counter, time
+
+import src.data_extract.cohere_api as capi
+from benchmarks.synthetic import FakeCohereClient, make_library, make_vault
+from src.chunking import DEFAULT_CHUNK_SIZE
+from src.data_extract import DataExtract
+from src.data_extract.embedding_cache import EmbeddingCache
+from src.data_extract.utils import get_extractor_for_extension, get_extractor_struct_for_extension
+from src.dataset import dataset_info, iter_row_groups, merge_dataset
+from src.embedding_store import ShardedEmbeddings
+from src.reduction import run_reduction
+
+try:
+    from resource import RUSAGE_SELF, getrusage
+except ImportError:
+    # Windows has no resource module
+    getrusage = None
+
+
+def _rss():
+    # Current resident memory in bytes, /proc is only there on linux
+    with open('/proc/self/statm', 'r') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class PeakMemory:
+    """
+    Samples the resident memory of the process in a thread while a stage runs.
+    Without /proc the lifetime peak from getrusage is reported instead, and where there is no getrusage either,
+    as on Windows, the peak of the memory allocated through Python and numpy while the stage ran
+    """
+
+    def __init__(self, interval=0.005):
+        self._interval = interval
+        self._stop = Event()
+        self._thread = None
+        self._tracing = False
+        self.peak = 0
+
+    def _sample(self):
+        while not self._stop.wait(self._interval):
+            self.peak = max(self.peak, _rss())
+
+    def __enter__(self):
+        if system.startswith('linux'):
+            self.peak = _rss()
+            self._thread = Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        elif getrusage is None:
+            self._tracing = not tracemalloc.is_tracing()
+            if self._tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        return self
+
+    def __exit__(self, *_):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, _rss())
+        elif getrusage is None:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            if self._tracing:
+                tracemalloc.stop()
+        else:
+            # ru_maxrss is in kilobytes on linux and bytes on macOS
+            self.peak = getrusage(RUSAGE_SELF).ru_maxrss * (1 if system == 'darwin' else 1024)
+
+
+def run_stage(results, name, function, files=0, chunks=0, size=0):
+    """
+    Time one stage and append its metrics to results
+    :param function: Runs the stage
+    :return: The output of the stage
+    """
+    with PeakMemory() as memory:
+        start = perf_counter()
+        output = function()
+        elapsed = perf_counter() - start
+    result = {
+        'stage': name,
+        'seconds': elapsed,
+        'files': files,
+        'chunks': chunks,
+        'megabytes': size / 1e6,
+        'files_per_second': files / elapsed if files else None,
+        'chunks_per_second': chunks / elapsed if chunks else None,
+        'megabytes_per_second': size / 1e6 / elapsed if size else None,
+        'peak_rss_megabytes': memory.peak / 1e6,
+    }
+    results.append(result)
+    rates = '  '.join(f'{result[key]:10.1f} {unit}' for key, unit in
+                      (('files_per_second', 'files/s'), ('chunks_per_second', 'chunks/s'), ('megabytes_per_second', 'MB/s'))
+                      if result[key] is not None)
+    print(f'{name:<22} {elapsed:8.3f}s  {rates}  peak {result["peak_rss_megabytes"]:.0f} MB')
+    return output
+
+
+def compare(results, baseline_path, threshold, min_seconds=0.1):
+    """
+    Print the change of every stage against a saved run, a stage slower by more than threshold is flagged.
+    Stages faster than min_seconds are too noisy to flag
+    :return: The names of the regressed stages
+    """
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {stage['stage']: stage for stage in json.load(f)['stages']}
+    regressed = []
+    for stage in results:
+        previous = baseline.get(stage['stage'])
+        if previous is None:
+            continue
+        ratio = stage['seconds'] / max(previous['seconds'], 1e-9)
+        memory = stage['peak_rss_megabytes'] - previous['peak_rss_megabytes']
+        flag = ''
+        if ratio > 1 + threshold and stage['seconds'] >= min_seconds:
+            flag = '  REGRESSION'
+            regressed.append(stage['stage'])
+        print(f'{stage["stage"]:<22} {ratio:6.2f}x time  {memory:+8.0f} MB peak{flag}')
+    return regressed
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--notes', type=int, default=2000, help='Markdown notes in the synthetic vault')
+    parser.add_argument('--note-words', type=int, default=1000)
+    parser.add_argument('--books', type=int, default=20, help='Synthetic EPUB books')
+    parser.add_argument('--chapters', type=int, default=20)
+    parser.add_argument('--chapter-words', type=int, default=3000)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Words per chunk')
+    parser.add_argument('--workers', type=int, default=1, help='Extraction processes, their memory is not counted')
+    parser.add_argument('--dim', type=int, default=1024, help='Fake embedding size')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds each fake embed call takes')
+    parser.add_argument('--reductions', default='pca5', help='Comma separated reductions to time, such as pca5,umap2')
+    parser.add_argument('--changed', type=float, default=0.05, help='Fraction of files re-extracted by the merge stage')
+    parser.add_argument('--output', help='Save the results as json')
+    parser.add_argument('--compare', help='A saved json run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Slowdown flagged as a regression by --compare')
+    parser.add_argument('--min-seconds', type=float, default=0.1, help='Stages faster than this are never flagged')
+    args = parser.parse_args()
+
+    results = []
+    with TemporaryDirectory() as folder:
+        vault_path = join(folder, 'vault')
+        library_path = join(folder, 'library')
+        print('Generating synthetic data')
+        vault_bytes = make_vault(vault_path, args.notes, args.note_words)
+        library_bytes = make_library(library_path, args.books, args.chapters, args.chapter_words)
+
+        # Extracted and merged into Parquet datasets the way load_data does
+        inputs = {'vault': ('md', vault_path, args.notes, vault_bytes), 'library': ('epub', library_path, args.books, library_bytes)}
+        data = {}
+        for data_name, (extension, input_path, files, size) in inputs.items():
+            extractor = get_extractor_for_extension(extension)()
+            extractor.set_valid_extensions([extension])
+            struct = {'filepath': DataExtract.get_filepath, **get_extractor_struct_for_extension(extension)}
+            data[data_name] = run_stage(results, f'extract {extension}',
+                                        lambda: extractor.extract_data(input_path, struct, workers=args.workers), files, size=size)
+        data_paths = {data_name: join(folder, f'{data_name}.parquet') for data_name in data}
+        file_count = args.notes + args.books
+        text_bytes = sum(int(frame['text'].str.len().sum()) for frame in data.values())
+        run_stage(results, 'dataset write', lambda: [merge_dataset(data_paths[data_name], frame, []) for data_name, frame in data.items()],
+                  file_count, size=text_bytes)
+
+        def merge_changed():
+            # A rerun after some files changed, every dataset is rewritten by streaming over its row groups
+            for data_name, frame in data.items():
+                filepaths = frame['filepath'].unique()
+                changed = filepaths[:max(1, int(len(filepaths) * args.changed))]
+                merge_dataset(data_paths[data_name], frame[frame['filepath'].isin(changed)], list(changed))
+        run_stage(results, 'dataset merge', merge_changed, file_count, size=text_bytes)
+        run_stage(results, 'dataset scan', lambda: [sum(len(frame) for frame in iter_row_groups(path, ['text'])) for path in data_paths.values()],
+                  file_count, size=text_bytes)
+        rows = sum(dataset_info(path)['rows'] for path in data_paths.values())
+
+        chunk_count = run_stage(results, 'chunking',
+                                lambda: sum(capi.count_chunks(path, args.chunk_size) for path in data_paths.values()),
+                                rows, size=text_bytes)
+
+        client = FakeCohereClient(args.dim, args.latency)
+        cache = EmbeddingCache(join(folder, 'embedding_cache.sqlite'), max_bytes=1 << 40)
+        store_paths = [join(folder, f'{data_name}_embeddings') for data_name in data_paths]
+        create = lambda: [capi.create_embeddings(path, None, rate_limit_calls=1 << 30, cache=cache, client=client,
+                                                 chunk_size=args.chunk_size, store_path=store_path)
+                          for path, store_path in zip(data_paths.values(), store_paths)]
+        run_stage(results, 'embedding', create, rows, chunk_count, text_bytes)
+        # The second pass is served from the cache, it measures the post-processing without the API
+        run_stage(results, 'embedding cached', create, rows, chunk_count, text_bytes)
+        cache.close()
+
+        combined = ShardedEmbeddings(store_paths)
+        combined_path = join(folder, 'combined_embeddings.json')
+        combined.save(combined_path)
+        embedding_bytes = len(combined) * combined.shape[1] * combined.dtype.itemsize
+        for method in args.reductions.split(','):
+            run_stage(results, f'reduction {method}', lambda: run_reduction(combined_path, method, folder),
+                      chunks=chunk_count, size=embedding_bytes)
+
+    report = {
+        'created': time(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'arguments': vars(args),
+        'stages': results,
+        'total_seconds': sum(stage['seconds'] for stage in results),
+    }
+    print(f'total {report["total_seconds"]:.3f}s')
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.compare is not None:
+        regressed = compare(results, args.compare, args.threshold, args.min_seconds)
+        if regressed:
+            print(f'{len(regressed)} stages regressed: {", ".join(regressed)}')
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
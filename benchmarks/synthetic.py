@@ -0,0 +1,150 @@
+"""
+Synthetic inputs for the benchmarks: markdown vaults, EPUB books and a deterministic stand-in for the Cohere client
+"""
+from hashlib import sha1
+from os import makedirs
+from os.path import join
+from random import Random
+from time import sleep
+from zipfile import ZIP_DEFLATED, ZipFile
+
+import numpy as np
+
+WORDS = ['the', 'embedding', 'of', 'a', 'note', 'is', 'computed', 'from', 'its', 'chunks', 'hierarchical', 'map',
+         'cluster', 'label', 'vault', 'chapter', 'reduction', 'river', 'mountain', 'python', 'garden', 'letter']
+
+
+def make_paragraphs(random, words, words_per_paragraph=120):
+    """
+    :return: A list of paragraphs of sentences made of random words
+    """
+    paragraphs = []
+    for _ in range(0, words, words_per_paragraph):
+        sentences = []
+        for _ in range(0, words_per_paragraph, 15):
+            sentence = ' '.join(random.choice(WORDS) for _ in range(15))
+            sentences.append(sentence[0].upper() + sentence[1:] + '.')
+        paragraphs.append(' '.join(sentences))
+    return paragraphs
+
+
+def make_vault(path, files, words=1000, folders=10, seed=0):
+    """
+    Write a markdown vault of notes linking to each other, spread over nested folders
+    :param path: The vault directory
+    :param files: The number of notes
+    :param words: The words per note
+    :return: The total bytes written
+    """
+    random = Random(seed)
+    total = 0
+    for ix in range(files):
+        folder = join(path, *[f'folder{(ix // folders ** depth) % folders}' for depth in range(ix % 3)])
+        makedirs(folder, exist_ok=True)
+        links = ' '.join(f'[[note{random.randrange(files)}]]' for _ in range(3))
+        text = f'# Note {ix}\n\n' + '\n\n'.join(make_paragraphs(random, words)) + f'\n\n{links}\n'
+        data = text.encode('utf-8')
+        with open(join(folder, f'note{ix}.md'), 'wb') as f:
+            f.write(data)
+        total += len(data)
+    return total
+
+
+CONTAINER = '''<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>'''
+
+PACKAGE = '''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>{title}</dc:title>
+    <dc:creator>Synthetic Author</dc:creator>
+  </metadata>
+  <manifest>
+    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+{items}
+  </manifest>
+  <spine>
+{refs}
+  </spine>
+</package>'''
+
+CHAPTER = '''<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>{title}</title></head>
+<body>
+<h1>{title}</h1>
+{paragraphs}
+</body>
+</html>'''
+
+
+def make_epub(path, chapters, words=3000, seed=0):
+    """
+    Write an EPUB book, paragraphs mix inline markup so text is split between element text and tails
+    :param path: The .epub file
+    :param chapters: The number of chapters
+    :param words: The words per chapter
+    :return: The uncompressed bytes of the chapters
+    """
+    random = Random(seed)
+    items = []
+    refs = []
+    total = 0
+    with ZipFile(path, 'w', ZIP_DEFLATED) as book:
+        book.writestr('mimetype', 'application/epub+zip')
+        book.writestr('META-INF/container.xml', CONTAINER)
+        book.writestr('OEBPS/nav.xhtml', CHAPTER.format(title='Contents', paragraphs=''))
+        for ix in range(chapters):
+            paragraphs = []
+            for paragraph in make_paragraphs(random, words):
+                first, _, rest = paragraph.partition(' ')
+                paragraphs.append(f'<p><em>{first}</em> {rest}</p>')
+            data = CHAPTER.format(title=f'Chapter {ix + 1}', paragraphs='\n'.join(paragraphs)).encode('utf-8')
+            book.writestr(f'OEBPS/chapter{ix}.xhtml', data)
+            items.append(f'    <item id="chapter{ix}" href="chapter{ix}.xhtml" media-type="application/xhtml+xml"/>')
+            refs.append(f'    <itemref idref="chapter{ix}"/>')
+            total += len(data)
+        book.writestr('OEBPS/content.opf', PACKAGE.format(title=f'Book {seed}', items='\n'.join(items), refs='\n'.join(refs)))
+    return total
+
+
+def make_library(path, books, chapters=20, words=3000, seed=0):
+    """
+    Write a folder of EPUB books
+    :return: The total uncompressed bytes of the chapters
+    """
+    makedirs(path, exist_ok=True)
+    return sum(make_epub(join(path, f'book{ix}.epub'), chapters, words, seed + ix) for ix in range(books))
+
+
+class _Response:
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+
+class FakeCohereClient:
+    """
+    Stands in for cohere.Client: every text gets a unit vector seeded from its hash, so runs are reproducible
+    """
+
+    def __init__(self, dim=1024, latency=0.0):
+        """
+        :param dim: The embedding size
+        :param latency: Seconds each embed call sleeps, to mimic the network
+        """
+        self._dim = dim
+        self._latency = latency
+        self.calls = 0
+
+    def embed(self, texts, model=None, truncate=None):
+        self.calls += 1
+        if self._latency > 0:
+            sleep(self._latency)
+        vectors = np.empty((len(texts), self._dim), dtype=np.float32)
+        for ix, text in enumerate(texts):
+            seed = int.from_bytes(sha1(text.encode('utf-8')).digest()[:8], 'little')
+            vectors[ix] = np.random.default_rng(seed).standard_normal(self._dim, dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return _Response(vectors.tolist())
@@ -0,0 +1,129 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from random import random
+from time import monotonic, sleep
+
+import httpx
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket, allows bursts of up to capacity calls and refills at rate calls per second
+    """
+
+    def __init__(self, rate, capacity):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and take it
+        """
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            sleep(wait)
+
+
+def _status_code(error):
+    """
+    Find the HTTP status of an API error across client versions
+    :param error: The raised exception
+    :return: The status code or None
+    """
+    for attribute in ('http_status', 'status_code'):
+        status = getattr(error, attribute, None)
+        if isinstance(status, int):
+            return status
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+def is_retryable(error):
+    # httpx based clients raise their own connection and timeout errors, which are not builtin ones
+    if isinstance(error, (ConnectionError, TimeoutError, httpx.TransportError)):
+        return True
+    return _status_code(error) in RETRY_STATUS_CODES
+
+
+class RateLimitedClient:
+    """
+    Keeps up to concurrency API requests in flight under a token bucket rate limit.
+    Rate limited and server errors are retried with exponential backoff.
+    """
+
+    def __init__(self, request, concurrency=4, rate_limit_calls=100, rate_limit_duration=60,
+                 max_retries=5, backoff=1.0, max_backoff=60.0):
+        """
+        :param request: A callable sending one request, such as a list of texts to embed or a prompt to complete
+        :param concurrency: The number of requests in flight
+        :param rate_limit_calls: The number of calls allowed per rate_limit_duration seconds
+        :param max_retries: The number of retries before an error is raised
+        :param backoff: The delay before the first retry in seconds, doubled on every attempt
+        """
+        self._request = request
+        self._concurrency = concurrency
+        self._limiter = TokenBucket(rate_limit_calls / rate_limit_duration, rate_limit_calls)
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+
+    def call(self, inputs):
+        """
+        Send one request, retrying on retryable errors. An empty list, such as a batch the cache fully answered,
+        is not sent and uses no rate limit
+        :param inputs: The argument of the request
+        :return: The response
+        """
+        if isinstance(inputs, list) and len(inputs) == 0:
+            return []
+        attempt = 0
+        while True:
+            self._limiter.acquire()
+            try:
+                return self._request(inputs)
+            except Exception as e:
+                if attempt >= self._max_retries or not is_retryable(e):
+                    raise
+            delay = min(self._max_backoff, self._backoff * 2 ** attempt)
+            sleep(delay * (0.5 + random() / 2))
+            attempt += 1
+
+    def call_batches(self, batches, get_inputs=None):
+        """
+        Send one request per batch concurrently, results are yielded in the order of batches so the caller
+        can checkpoint every finished batch as it arrives
+        :param batches: An iterable of batches, consumed lazily
+        :param get_inputs: A callable returning the request argument of a batch, defaults to the batch itself
+        :return: A generator of (batch, response)
+        """
+        if get_inputs is None:
+            get_inputs = lambda batch: batch
+        batches = iter(batches)
+        with ThreadPoolExecutor(self._concurrency) as executor:
+            in_flight = deque()
+            try:
+                for batch in batches:
+                    in_flight.append((batch, executor.submit(self.call, get_inputs(batch))))
+                    if len(in_flight) < self._concurrency:
+                        continue
+                    batch, future = in_flight.popleft()
+                    yield batch, future.result()
+                while len(in_flight) > 0:
+                    batch, future = in_flight.popleft()
+                    yield batch, future.result()
+            finally:
+                for _, future in in_flight:
+                    future.cancel()
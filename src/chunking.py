@@ -0,0 +1,110 @@
+import re
+
+import numpy as np
+
+# Lookup table of every code point str.isspace() accepts, the largest is U+3000
+_WHITESPACE = np.array([chr(code).isspace() for code in range(0x3001)], dtype=bool)
+SENTENCE_END_PATTERN = re.compile(r'[.!?]+["\'”’)\]]*(?=\s|$)')
+PARAGRAPH_BREAK_PATTERN = re.compile(r'\n[ \t\r\f\v]*\n')
+# Whitespace words per chunk that stay inside a 512 token embedding window. Words are budgeted at 1.6 tokens each,
+# above plain English prose so text heavy with names, numbers or code still fits: 512 / 1.6 = 320
+DEFAULT_CHUNK_SIZE = 320
+
+
+def token_spans(text, tokenizer=None):
+    """
+    Finds the character span of every token in the text
+    :param text: The raw text
+    :param tokenizer: A callable returning (start, end) offsets for each token, defaults to whitespace separated words
+    :return: Two int64 arrays of token starts and ends
+    """
+    if tokenizer is None:
+        return _word_spans(text)
+    spans = list(tokenizer(text))
+    if len(spans) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    spans = np.asarray(spans, dtype=np.int64)
+    return spans[:, 0], spans[:, 1]
+
+
+def _word_spans(text):
+    """
+    Vectorized equivalent of re.finditer(r'\S+', text), works on the code points of the whole text at once
+    """
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+    is_word = np.ones(len(codes) + 2, dtype=bool)
+    in_table = codes < len(_WHITESPACE)
+    is_word[1:-1] = ~(in_table & _WHITESPACE[np.where(in_table, codes, 0)])
+    is_word[0] = is_word[-1] = False
+    edges = np.flatnonzero(is_word[1:] != is_word[:-1])
+    return edges[0::2].astype(np.int64), edges[1::2].astype(np.int64)
+
+
+def _boundaries(text, starts, ends, boundary):
+    """
+    Token indices that a chunk may end before without splitting a sentence or paragraph
+    :return: A sorted int array of indices in [1, len(starts)]
+    """
+    # A paragraph break between token j - 1 and token j makes j a boundary
+    breaks = np.fromiter((match.start() for match in PARAGRAPH_BREAK_PATTERN.finditer(text)), dtype=np.int64)
+    candidates = [np.searchsorted(starts, breaks, 'right')]
+    if boundary == 'sentence':
+        sentence_ends = np.fromiter((match.end() for match in SENTENCE_END_PATTERN.finditer(text)), dtype=np.int64)
+        candidates.append(np.searchsorted(ends, sentence_ends, 'left') + 1)
+    candidates.append([len(starts)])
+    boundaries = np.unique(np.concatenate(candidates))
+    return boundaries[(boundaries > 0) & (boundaries <= len(starts))]
+
+
+def chunk_spans(text, chunk_size=DEFAULT_CHUNK_SIZE, unit='words', overlap=0, boundary=None, tokenizer=None):
+    """
+    Splits text into chunks and returns their character offsets, chunk i is text[start:end]
+    :param text: The raw text
+    :param chunk_size: The maximum number of words, tokens or characters in a chunk
+    :param unit: 'words' to budget in whitespace separated words, 'tokens' to budget in the units of tokenizer,
+    'chars' to budget in characters
+    :param overlap: The number of words, tokens or characters repeated at the start of the next chunk
+    :param boundary: None to cut between any words, 'sentence' or 'paragraph' to prefer cutting at those boundaries
+    :param tokenizer: A callable returning (start, end) offsets for each token, the embedding model's own tokenizer
+    keeps chunks exactly inside its window. Required for 'tokens', 'chars' cuts between its tokens and 'words' ignores it
+    :return: The list of (start, end) offsets
+    """
+    if unit not in ('words', 'tokens', 'chars'):
+        raise ValueError(f"Unknown chunk unit {unit}")
+    if unit == 'tokens' and tokenizer is None:
+        raise ValueError("Chunking by tokens needs a tokenizer")
+    if boundary not in (None, 'sentence', 'paragraph'):
+        raise ValueError(f"Unknown chunk boundary {boundary}")
+    if overlap >= chunk_size:
+        raise ValueError(f"Overlap {overlap} must be smaller than the chunk size {chunk_size}")
+    starts, ends = token_spans(text, None if unit == 'words' else tokenizer)
+    token_count = len(starts)
+    boundaries = None if boundary is None else _boundaries(text, starts, ends, boundary)
+
+    spans = []
+    first = 0
+    # Exclusive token index where the previous chunk ended, a boundary inside the overlap makes no progress
+    previous = 0
+    while first < token_count:
+        # Exclusive index of the last token that still fits in the budget
+        if unit == 'chars':
+            last = int(np.searchsorted(ends, starts[first] + chunk_size, 'right'))
+        else:
+            last = min(first + chunk_size, token_count)
+        # A single token larger than the budget becomes its own chunk
+        last = max(last, first + 1)
+        if boundaries is not None and last < token_count:
+            ix = np.searchsorted(boundaries, last, 'right') - 1
+            # Only back off to a boundary if it keeps at least half the chunk
+            if ix >= 0 and boundaries[ix] > previous and boundaries[ix] - first >= (last - first) // 2:
+                last = int(boundaries[ix])
+        spans.append((int(starts[first]), int(ends[last - 1])))
+        if last >= token_count:
+            break
+        previous = last
+        if unit == 'chars':
+            following = int(np.searchsorted(starts, ends[last - 1] - overlap, 'left'))
+        else:
+            following = last - overlap
+        first = max(following, first + 1)
+    return spans
@@ -0,0 +1,157 @@
+import numpy as np
+from scipy.cluster.hierarchy import linkage
+from scipy.sparse import csr_matrix
+from sklearn.cluster import MiniBatchKMeans
+
+
+# Upper bound on the k-means training sample, 256 MB is 16k rows at 4096 float32 dimensions
+SAMPLE_BYTES = 256 * 1024 ** 2
+
+
+def _gather(embeddings, rows, dtype=np.float64):
+    return np.asarray(embeddings[rows], dtype=dtype)
+
+
+class _Subset:
+    """
+    The rows of a matrix picked by index, read only when indexed, so splitting an oversized cluster
+    never copies it
+    """
+
+    def __init__(self, embeddings, rows):
+        self._embeddings = embeddings
+        self._rows = rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def shape(self):
+        return (len(self._rows),) + tuple(self._embeddings.shape[1:])
+
+    def __getitem__(self, index):
+        return self._embeddings[self._rows[index]]
+
+
+def _add_sums(sums, block, labels):
+    # One sparse product adds every row of the block to the sum of its cluster
+    indicator = csr_matrix((np.ones(len(block)), (labels, np.arange(len(block)))), shape=(len(sums), len(block)))
+    sums += indicator @ block
+
+
+def _relabel(sub_linkage, members, next_id):
+    """
+    Map a linkage over a subset into the ids of the full linkage
+    :param sub_linkage: The linkage over len(members) leaves
+    :param members: The global leaf id of each local leaf
+    :param next_id: The first free global id for merged clusters
+    :return: The relabelled rows and the global id of the subset's root
+    """
+    count = len(members)
+    if count == 1:
+        return np.empty((0, 4)), int(members[0])
+    ids = np.concatenate([members, np.arange(next_id, next_id + count - 1)])
+    rows = sub_linkage.copy()
+    rows[:, 0] = ids[sub_linkage[:, 0].astype(np.int64)]
+    rows[:, 1] = ids[sub_linkage[:, 1].astype(np.int64)]
+    return rows, next_id + count - 2
+
+
+def _sort_linkage(rows, count):
+    """
+    Order merges by height, as scipy's linkage does, and renumber the merged clusters to match.
+    Heights never decrease from child to parent, so a stable sort keeps children before parents
+    """
+    order = np.argsort(rows[:, 2], kind='stable')
+    rank = np.empty(len(rows), dtype=np.int64)
+    rank[order] = np.arange(len(rows))
+    rows = rows[order]
+    for column in (0, 1):
+        ids = rows[:, column].astype(np.int64)
+        merged = ids >= count
+        ids[merged] = count + rank[ids[merged] - count]
+        rows[:, column] = ids
+    return rows
+
+
+def hierarchical_linkage(embeddings, leaf_size=2000, sample_size=100000, block_size=16384, seed=0, sample_bytes=SAMPLE_BYTES):
+    """
+    Ward-style hierarchical clustering that scales past what scipy's O(n^2) linkage can hold.
+    Rows are split into micro clusters with mini-batch k-means, each micro cluster gets an exact ward linkage,
+    and the micro cluster centroids are clustered the same way recursively. The pieces are stitched into one
+    scipy-compatible linkage matrix.
+    Besides the output, memory holds the float32 k-means sample (at most sample_bytes, but never fewer rows than
+    micro clusters), one float32 block of rows, a float64 sum per micro cluster (2 * rows / leaf_size of them),
+    a few int64 per row for labels and ordering, and in each exact linkage leaf_size float64 rows with
+    their leaf_size^2 / 2 pairwise distances
+    :param embeddings: An array, memmap or ShardedEmbeddings
+    :param leaf_size: The largest set of rows given to scipy's exact ward linkage, at least 2
+    :param sample_size: The most rows k-means is trained on
+    :param block_size: Rows read at a time
+    :param sample_bytes: The most bytes of float32 rows k-means is trained on
+    :return: A (rows - 1, 4) linkage matrix
+    """
+    if leaf_size < 2:
+        raise ValueError(f"leaf_size must be at least 2, got {leaf_size}")
+    count = len(embeddings)
+    if count <= 1:
+        return np.empty((0, 4))
+    if count <= leaf_size:
+        return linkage(_gather(embeddings, np.arange(count)), method='ward')
+
+    # Aim for micro clusters of half the leaf size so uneven clusters still fit,
+    # at most half as many as rows so the centroids clustered above them are always fewer than the rows
+    clusters = min(int(np.ceil(count / (leaf_size / 2))), count // 2)
+    row_bytes = 4 * int(np.prod(embeddings.shape[1:]))
+    sample_count = min(count, max(sample_size, clusters * 10), max(sample_bytes // row_bytes, clusters))
+    random = np.random.default_rng(seed)
+    sample = np.sort(random.choice(count, sample_count, replace=False))
+    kmeans = MiniBatchKMeans(n_clusters=clusters, batch_size=4096, n_init=1, random_state=seed)
+    kmeans.fit(_gather(embeddings, sample, np.float32))
+
+    labels = np.empty(count, dtype=np.int64)
+    sums = np.zeros((clusters, embeddings.shape[1]))
+    for start in range(0, count, block_size):
+        block = _gather(embeddings, slice(start, start + block_size), np.float32)
+        block_labels = kmeans.predict(block)
+        labels[start:start + len(block)] = block_labels
+        _add_sums(sums, block, block_labels)
+    sizes = np.bincount(labels, minlength=clusters)
+    used = np.flatnonzero(sizes)
+    if len(used) == 1:
+        # k-means could not separate the rows, they are (near) duplicates so any split is as good
+        labels = np.arange(count) // max(2, leaf_size // 2)
+        used = np.unique(labels)
+        sizes = np.bincount(labels)
+        sums = np.zeros((len(used), embeddings.shape[1]))
+        for start in range(0, count, block_size):
+            _add_sums(sums, _gather(embeddings, slice(start, start + block_size), np.float32), labels[start:start + block_size])
+    centroids = sums[used] / sizes[used, None]
+
+    rows = []
+    roots = np.empty(len(used), dtype=np.int64)
+    heights = np.zeros(len(used))
+    next_id = count
+    members_by_cluster = np.argsort(labels, kind='stable')
+    boundaries = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=int(labels.max()) + 1))])
+    for ix, label in enumerate(used):
+        members = members_by_cluster[boundaries[label]:boundaries[label + 1]]
+        # Oversized micro clusters are split again, the rest get an exact ward linkage
+        sub_linkage = hierarchical_linkage(_Subset(embeddings, members), leaf_size, sample_size, block_size, seed + 1, sample_bytes)
+        relabelled, roots[ix] = _relabel(sub_linkage, members, next_id)
+        if len(relabelled) > 0:
+            heights[ix] = relabelled[-1, 2]
+            next_id = roots[ix] + 1
+        rows.append(relabelled)
+
+    # The centroids are clustered above every micro cluster, offset so heights keep increasing toward the root
+    top_linkage = hierarchical_linkage(centroids, leaf_size, sample_size, block_size, seed + 1, sample_bytes)
+    top_rows, _ = _relabel(top_linkage, roots, next_id)
+    top_rows[:, 2] += heights.max()
+    merged_rows = np.concatenate(rows + [top_rows])
+    # Counts of the top merges are leaves, not centroids
+    node_sizes = np.concatenate([np.ones(count), np.zeros(count - 1)])
+    for ix, (left, right, _, _) in enumerate(merged_rows):
+        node_sizes[count + ix] = node_sizes[int(left)] + node_sizes[int(right)]
+    merged_rows[:, 3] = node_sizes[count:]
+    return _sort_linkage(merged_rows, count)
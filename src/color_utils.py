@@ -1,6 +1,7 @@
-import matplotlib.colors as mcolors
 import numpy as np
 
+from src.hierarchy import leaf_order
+
 
 # Adds colors for linkages by blending the leave colors together, recursively
 # if t is 1, color2 is returned, if it is 0, color1 is
@@ -16,30 +17,37 @@ def blend_colors(color1, color2, t):
 
 
 def blend_pca_colors(linked, colors, file_count):
-    for row in linked:
-        cluster1_id = int(row[0])
-        cluster2_id = int(row[1])
-
-        if cluster1_id < file_count:  # it is a sample/leaf
-            cluster1_size = 1
-        else:
-            cluster1_size = linked[file_count - cluster1_id][-1]
-
-        if cluster2_id < file_count:  # it is a sample/leaf
-            cluster2_size = 1
-        else:
-            cluster2_size = linked[file_count - cluster2_id][-1]
-
-        # If a cluster is huge and is blended with a leaf, the color should be mostly the leaf color
-        # Can try different weighting here
-        t = cluster2_size / (cluster1_size + cluster2_size)
-
-        color1 = colors[cluster1_id]
-        color2 = colors[cluster2_id]
-
-        colors = np.vstack((colors, blend_colors(color1, color2, t)))
-    return colors
+    """
+    Colors every cluster of a linkage by blending its two children weighted by their sizes, as blend_colors would.
+    Blending that way makes a cluster's color the mean color of its leaves, and the leaves of a cluster are a
+    contiguous run of the dendrogram's leaf order, so every cluster is one difference of a cumulative sum
+    :param linked: A scipy linkage matrix
+    :param colors: The (file_count, 3) color of each leaf
+    :param file_count: The number of leaves
+    :return: A (2 * file_count - 1, 3) array, row i is the color of leaf or cluster i
+    """
+    colors = np.asarray(colors, dtype=np.float64)
+    linked = np.asarray(linked)
+    node_count = 2 * file_count - 1
+
+    order, starts = leaf_order(linked)
+    sizes = np.ones(node_count, dtype=np.int64)
+    sizes[file_count:] = linked[:, 3].astype(np.int64)
+
+    totals = np.zeros((file_count + 1, colors.shape[1]))
+    np.cumsum(colors[order], axis=0, out=totals[1:])
+    blended = np.empty((node_count, colors.shape[1]))
+    blended[:file_count] = colors[:file_count]
+    blended[file_count:] = (totals[starts[file_count:] + sizes[file_count:]] - totals[starts[file_count:]]) / sizes[file_count:, None]
+    return blended
 
 
 def color_to_hex(colors):
-    return [mcolors.to_hex(color) for color in colors]
+    """
+    :param colors: An (n, 3) array of rgb colors in [0, 1]
+    :return: The list of '#rrggbb' strings
+    """
+    # Same rounding as matplotlib's to_hex, half to even
+    channels = np.rint(np.clip(np.asarray(colors, dtype=np.float64)[:, :3], 0, 1) * 255).astype(np.uint8)
+    digits = channels.tobytes().hex()
+    return ['#' + digits[start:start + 6] for start in range(0, len(digits), 6)]
@@ -1,12 +1,13 @@
 from __future__ import annotations
 
 import re
-from os import listdir
-from os.path import basename, isdir, join
+from concurrent.futures import ProcessPoolExecutor
+from os.path import basename
 
 import pandas as pd
 from tqdm import tqdm
 
+from src.data_extract.scanner import scan_files
 from src.utils import read_file
 
 
@@ -18,52 +19,16 @@ class DataExtract:
     def set_valid_extensions(self, exts):
         self._extensions = exts
 
-    @staticmethod
-    def _glob_path(path):
-        """
-        Recursively searches through the path and returns a list of all files
-        :param path: The directory to search in
-        :return: A list of paths
-        """
-        if not isdir(path):
-            raise ValueError(f"{path} is not a directory")
-        out = []
-        for file in listdir(path):
-            filepath = join(path, file)
-            out.append(filepath)
-            if isdir(filepath):
-                out += DataExtract._glob_path(filepath)
-        return out
-
-    def _valid(self, filename):
-        """
-        Checks if the file is valid
-        :return: True if valid, False otherwise
-        """
-        ext = filename.rsplit('.', 1)[-1]
-        return ext in self._extensions
-
-    def _glob_valid(self, path):
-        """
-        Combs through all files and directories in the path and returns paths to files this extractor can process
-        :param path: The path to search in
-        :return: A list of paths
-        """
-        paths = []
-        for filepath in self._glob_path(path):
-            if not self._valid(filepath):
-                continue
-            paths.append(filepath)
-        return paths
-
     def _load_data(self, filepath):
         """
         Load the data from the file
         :param filepath: The path to the file
         :return: The count of objects in this file
         """
-        self._data['filepath'] = filepath
-        self._data['raw_data'] = read_file(filepath)
+        self._data = {
+            'filepath': filepath,
+            'raw_data': read_file(filepath)
+        }
         return 1
 
     def get_file(self, _):
@@ -93,38 +58,103 @@ class DataExtract:
             self._data['links'] = [link.strip("[[").strip("]]") for link in links]
         return self._data['links']
 
-    def extract_data(self, input_path, embedding_struct, debug=False):
+    def get_filepath(self, _):
+        """
+        Get the path of the file the data was loaded from
+        :param _: Does Nothing
+        :return: The filepath
+        """
+        return self._data['filepath']
+
+    def list_files(self, input_path, workers=1):
+        """
+        Lists the files in the input path this extractor can process
+        :param input_path: The path to the input directory
+        :param workers: The number of threads listing subdirectories
+        :return: A list of paths
+        """
+        return list(scan_files(input_path, self._extensions, workers))
+
+    def _extract_rows(self, filepath, embedding_struct):
+        """
+        Loads a file and evaluates the struct for every object in it
+        :param filepath: The path to the file
+        :param embedding_struct: The struct to use to extract data
+        :return: A list of row dicts, empty if the file could not be loaded
+        """
+        count = self._load_data(filepath)
+        rows = []
+        for ix in range(count):
+            file_data = {}
+            for key, method in embedding_struct.items():
+                file_data[key] = method(self, ix)
+            rows.append(file_data)
+        return rows
+
+    def extract_files(self, files_to_extract, embedding_struct, debug=False, workers=1):
+        """
+        Extracts data from the given files utilizing the passed struct
+        :param files_to_extract: The paths of the files to extract
+        :param embedding_struct: The struct to use to extract data
+        :param workers: The number of processes to extract with, rows keep the order of files_to_extract
+        :return: A dataframe containing the extracted data
+        """
+        if workers > 1 and len(files_to_extract) > 1:
+            executor = ProcessPoolExecutor(workers, initializer=_init_worker,
+                                           initargs=(type(self), self._extensions, embedding_struct))
+            chunksize = max(1, min(64, len(files_to_extract) // (workers * 4)))
+            results = executor.map(_extract_worker, files_to_extract, chunksize=chunksize)
+        else:
+            executor = None
+            results = (self._extract_rows(filepath, embedding_struct) for filepath in files_to_extract)
+
+        data = []
+        success_count = 0
+        try:
+            for filepath, rows in tqdm(zip(files_to_extract, results), total=len(files_to_extract), desc='Extracting data'):
+                if len(rows) == 0:
+                    if debug:
+                        print('Error loading data from', filepath)
+                    continue
+                success_count += 1
+                data += rows
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        if debug:
+            print(f'Successfully extracted data from {success_count} files')
+        return pd.DataFrame(data, columns=embedding_struct.keys())
+
+    def extract_data(self, input_path, embedding_struct, debug=False, workers=1):
         """
         Extracts data from the input path utilizing the passed struct
         See DEFAULT_EMBEDDING for an example
         :param input_path: The path to the input directory
         :param embedding_struct: The struct to use to extract data
+        :param workers: The number of processes to extract with
         :return: A dataframe containing the extracted data
         """
-        if not isdir(input_path):
-            raise ValueError(f"{input_path} is not a directory")
-        files_to_extract = self._glob_valid(input_path)
+        files_to_extract = self.list_files(input_path)
         if len(files_to_extract) == 0:
             raise ValueError(f"No valid files found in {input_path}")
         if debug:
             print(f'Extracting data from {len(files_to_extract)} files')
-        data = []
-        success_count = 0
-        for filepath in tqdm(files_to_extract, desc='Extracting data'):
-            count = self._load_data(filepath)
-            if count == 0:
-                if debug:
-                    print('Error loading data from', filepath)
-                continue
-            success_count += 1
-            for ix in range(count):
-                file_data = {}
-                for key, method in embedding_struct.items():
-                    file_data[key] = method(self, ix)
-                data.append(file_data)
-        if debug:
-            print(f'Successfully extracted data from {success_count} files')
-        return pd.DataFrame(data, columns=embedding_struct.keys())
+        return self.extract_files(files_to_extract, embedding_struct, debug, workers)
+
+
+# Each worker process keeps its own extractor so per-file state is never shared
+_worker_state = {}
+
+
+def _init_worker(extractor_class, extensions, embedding_struct):
+    extractor = extractor_class()
+    extractor.set_valid_extensions(extensions)
+    _worker_state['extractor'] = extractor
+    _worker_state['struct'] = embedding_struct
+
+
+def _extract_worker(filepath):
+    return _worker_state['extractor']._extract_rows(filepath, _worker_state['struct'])
 
 
 DEFAULT_EMBEDDING = {
@@ -1,54 +1,174 @@
+from os import makedirs
+
 import cohere
-import pandas as pd
+import numpy as np
 
-from time import time, sleep
 from tqdm import tqdm
 
-from src.utils import chunk_text
+from src.api_client import RateLimitedClient
+from src.data_extract.embedding_cache import chunk_key
+from src.chunking import DEFAULT_CHUNK_SIZE, chunk_spans
+from src.dataset import iter_row_groups
+from src.embedding_store import embeddings_path, invalidate_store, save_store
+
+
+class EmbeddingCancelled(Exception):
+    """
+    Raised by create_embeddings when its stop callback asks it to stop, every finished batch is already in the cache
+    """
+
+
+def make_client(api_key, api_url=None):
+    """
+    :param api_key: The Cohere API key
+    :param api_url: The base URL of the API, None for Cohere's own, e.g. a local embedding server
+    :return: A cohere.Client
+    """
+    if api_url is None:
+        return cohere.Client(api_key)
+    return cohere.Client(api_key, base_url=api_url)
+
+
+def iter_texts(df):
+    """
+    :param df: A dataframe with filename and text columns, or the path of a dataset read one row group of
+    those two columns at a time
+    :return: A generator of (filename, text) of every row
+    """
+    if isinstance(df, str):
+        for frame in iter_row_groups(df, ['filename', 'text']):
+            yield from zip(frame['filename'], frame['text'])
+    else:
+        yield from zip(df['filename'], df['text'])
+
+
+def iter_chunks(df, chunk_size=DEFAULT_CHUNK_SIZE, unit='words', tokenizer=None):
+    """
+    Lazily chunk the text of every row
+    :param df: A dataframe with filename and text columns or the path of a dataset
+    :param chunk_size: The chunk size, unit and tokenizer passed to chunk_spans
+    :return: A generator of (row, filename, start, end, chunk)
+    """
+    for row, (filename, text) in enumerate(iter_texts(df)):
+        for start, end in chunk_spans(text, chunk_size, unit, tokenizer=tokenizer):
+            yield row, filename, start, end, text[start:end]
 
 
-def create_embeddings(df, api_key, rate_limit_calls=100, rate_limit_duration=60, batch_size=96):
-    co = cohere.Client(api_key)
-    embeddings = []
+def iter_batches(items, batch_size):
+    """
+    Group an iterable into lists of batch_size items
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
 
-    start_time = time()
-    call_count = 0
 
-    for ix, row in df.iterrows():
-        text_chunks = chunk_text(row['text'])
+def iter_cached_batches(batches, cache, model, truncate):
+    """
+    Attach cached vectors to each batch of chunks
+    :return: A generator of batches of chunk dicts, embedding is None for chunks missing from the cache
+    """
+    for batch in batches:
+        items = [{
+            'row': row,
+            'filename': filename,
+            'start': start,
+            'end': end,
+            'chunk_text': chunk,
+            'key': chunk_key(model, truncate, chunk),
+            'embedding': None
+        } for row, filename, start, end, chunk in batch]
+        if cache is not None:
+            cached = cache.get_many([item['key'] for item in items])
+            for item in items:
+                item['embedding'] = cached.get(item['key'])
+        yield items
 
-        for chunk in text_chunks:
-            embeddings.append({
-                'filename': row['filename'],
-                'index': ix,
-                'chunk_text': chunk,
-                'embedding': None
-            })
 
-    embedding_batches = [embeddings[ix:ix + batch_size] for ix in range(0, len(embeddings), batch_size)]
+def count_chunks(df, chunk_size=DEFAULT_CHUNK_SIZE, unit='words', tokenizer=None):
+    """
+    Count the chunks iter_chunks will produce without materializing their text
+    """
+    return sum(len(chunk_spans(text, chunk_size, unit, tokenizer=tokenizer)) for _, text in iter_texts(df))
 
-    for batch in tqdm(embedding_batches, total=len(embedding_batches), desc="Embedding text"):
-        texts = [item['chunk_text'] for item in batch]
-        response = co.embed(texts=texts, model='large', truncate='END')
 
-        for ix, embedding in enumerate(response.embeddings):
-            batch[ix]['embedding'] = embedding
+def create_embeddings(df, api_key, rate_limit_calls=100, rate_limit_duration=60, batch_size=96, cache=None, model='large', truncate='END',
+                      concurrency=4, client=None, chunk_size=DEFAULT_CHUNK_SIZE, chunk_unit='words', tokenizer=None, dtype=np.float32,
+                      store_path=None, stop=None, progress=None):
+    """
+    Embeds the chunks of every row as a stream: rows -> chunks -> batches -> embeddings.
+    Only one window of batches is held in memory at a time and vectors are written straight into a preallocated matrix
+    :param df: A dataframe with filename and text columns, or the path of a dataset streamed by row group
+    :param cache: An EmbeddingCache, only chunks missing from it are sent to the API
+    :param chunk_size: The chunk budget in chunk_unit, the default number of words stays inside a 512 token window
+    :param chunk_unit: 'words', 'tokens' or 'chars', see chunk_spans
+    :param tokenizer: The tokenizer of the model, needed to chunk by tokens
+    :param dtype: The dtype of the embedding matrix, float32 or float16
+    :param store_path: If given, the matrix is written in place into an embedding store at this path
+    :param stop: A callable checked after every batch, when it returns True EmbeddingCancelled is raised
+    :param progress: A callable receiving (chunks done, chunk count) after every batch
+    :return: The embeddings and the filename of each embedding
+    """
+    co = client if client is not None else make_client(api_key)
+    engine = RateLimitedClient(lambda texts: co.embed(texts=texts, model=model, truncate=truncate).embeddings,
+                               concurrency=concurrency, rate_limit_calls=rate_limit_calls, rate_limit_duration=rate_limit_duration)
 
-        call_count += 1
+    # The cache outlives a single call, only this call's lookups are reported
+    hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    chunk_count = count_chunks(df, chunk_size, chunk_unit, tokenizer)
+    batches = iter_cached_batches(iter_batches(iter_chunks(df, chunk_size, chunk_unit, tokenizer), batch_size), cache, model, truncate)
+    # Only chunks that are not in the cache are sent to the API
+    batch_results = engine.call_batches(batches, lambda batch: [item['chunk_text'] for item in batch if item['embedding'] is None])
 
-        if call_count >= rate_limit_calls:
-            elapsed_time = time() - start_time
+    filenames = np.empty(chunk_count, dtype=object)
+    spans = np.empty((chunk_count, 3), dtype=np.int64)
+    keys = np.empty(chunk_count, dtype='S40')
+    embeddings = None
+    row = 0
+    for batch, vectors in tqdm(batch_results, total=-(-chunk_count // batch_size), desc="Embedding text"):
+        missing = [item for item in batch if item['embedding'] is None]
+        for item, vector in zip(missing, vectors):
+            item['embedding'] = vector
 
-            if elapsed_time < rate_limit_duration:
-                sleep(rate_limit_duration - elapsed_time)
+        # Finished batches are checkpointed in the cache so an interrupted run resumes from here
+        if cache is not None and len(missing) > 0:
+            cache.put_many((item['key'], item['embedding']) for item in missing)
 
-            start_time = time()
-            call_count = 0
+        # The embedding size is only known once the first batch arrives
+        if embeddings is None:
+            shape = (chunk_count, len(batch[0]['embedding']))
+            if store_path is not None:
+                makedirs(store_path, exist_ok=True)
+                # The matrix is rewritten in place, a store left behind by a stop or a crash must not load
+                invalidate_store(store_path)
+                embeddings = np.lib.format.open_memmap(embeddings_path(store_path), mode='w+', dtype=dtype, shape=shape)
+            else:
+                embeddings = np.empty(shape, dtype=dtype)
+        for ix, item in enumerate(batch):
+            embeddings[row + ix] = item['embedding']
+            filenames[row + ix] = item['filename']
+            spans[row + ix] = item['row'], item['start'], item['end']
+            keys[row + ix] = item['key']
+        row += len(batch)
+        if progress is not None:
+            progress(row, chunk_count)
+        # The batch is already checkpointed, a later run picks up from here through the cache
+        if stop is not None and stop():
+            batch_results.close()
+            raise EmbeddingCancelled(f'Stopped after {row} of {chunk_count} chunks')
 
-    df_embeddings = pd.DataFrame(embeddings)
-    remaining_keys = list(df.keys())
-    remaining_keys.remove('text')
-    df_embeddings = df_embeddings.merge(df[remaining_keys], on='filename', how='left')
-    embeddings = df_embeddings['embedding'].apply(pd.Series).to_numpy()
-    filenames = df_embeddings['filename'].to_numpy()
+    if cache is not None:
+        print(f'Embedding cache: {cache.hits - hits} hits, {cache.misses - misses} misses')
+    if embeddings is None:
+        embeddings = np.empty((0, 0), dtype=dtype)
+    if store_path is not None:
+        if isinstance(embeddings, np.memmap):
+            embeddings.flush()
+        save_store(store_path, embeddings, filenames, spans, keys, model=model, truncate=truncate, chunk_size=chunk_size,
+                   chunk_unit=chunk_unit)
     return embeddings, filenames
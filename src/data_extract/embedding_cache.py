@@ -0,0 +1,106 @@
+from hashlib import sha1
+from time import time
+
+import numpy as np
+
+from src.sqlite_cache import SqliteCache, placeholders
+
+
+def chunk_key(model, truncate, text):
+    """
+    Content address of a chunk embedding
+    :param model: The embedding model name
+    :param truncate: The truncate mode sent with the request
+    :param text: The chunk text
+    :return: A hex digest identifying the embedding
+    """
+    return sha1(f'{model}\0{truncate}\0{text}'.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache(SqliteCache):
+    """
+    Persistent on-disk cache of chunk embeddings keyed by chunk_key.
+    Vectors are stored as float32 blobs in sqlite and the least recently used entries
+    are evicted once the stored vectors exceed max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=2 * 1024 ** 3):
+        super().__init__(path, 'embeddings', 'vector BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)')
+        self._conn.commit()
+        self._max_bytes = max_bytes
+        self._size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM embeddings').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size(self):
+        """
+        :return: The number of bytes of vectors currently stored
+        """
+        return self._size
+
+    def get_many(self, keys):
+        """
+        Look up embeddings and mark them as recently used
+        :param keys: An iterable of chunk keys
+        :return: A dict of key -> float32 vector for every key found
+        """
+        found = {}
+        requested = 0
+        for query_keys, rows in self._select_many(keys, ('vector',)):
+            requested += len(query_keys)
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+            if len(rows) > 0:
+                self._conn.execute(f'UPDATE embeddings SET accessed = ? WHERE key IN ({placeholders(query_keys)})', [time()] + query_keys)
+        self._conn.commit()
+        self.hits += len(found)
+        self.misses += requested - len(found)
+        return found
+
+    def put_many(self, items):
+        """
+        Store embeddings, evicting old entries if the cache grows past its limit
+        :param items: An iterable of (key, vector) pairs
+        """
+        now = time()
+        for key, vector in items:
+            blob = np.asarray(vector, dtype=np.float32).tobytes()
+            previous = self._conn.execute('SELECT size FROM embeddings WHERE key = ?', (key,)).fetchone()
+            if previous is not None:
+                self._size -= previous[0]
+            self._conn.execute('INSERT OR REPLACE INTO embeddings (key, vector, size, accessed) VALUES (?, ?, ?, ?)',
+                               (key, blob, len(blob), now))
+            self._size += len(blob)
+        self._conn.commit()
+        if self._size > self._max_bytes:
+            self.evict()
+
+    def evict(self, max_bytes=None):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes
+        :param max_bytes: The size to shrink to, defaults to the cache limit
+        :return: The number of entries removed
+        """
+        if max_bytes is None:
+            max_bytes = self._max_bytes
+        to_remove = []
+        excess = self._size - max_bytes
+        for key, size in self._conn.execute('SELECT key, size FROM embeddings ORDER BY accessed'):
+            if excess <= 0:
+                break
+            to_remove.append((key,))
+            excess -= size
+            self._size -= size
+        self._conn.executemany('DELETE FROM embeddings WHERE key = ?', to_remove)
+        self._conn.commit()
+        return len(to_remove)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self),
+            'bytes': self._size,
+        }
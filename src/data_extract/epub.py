@@ -1,10 +1,126 @@
+import posixpath
+import re
 import xml.etree.ElementTree as ET
-from os.path import dirname, join
+from html.entities import name2codepoint
+from os.path import basename
+from urllib.parse import unquote
+from xml.parsers.expat import errors as expat_errors
 
 from zipfile import ZipFile
 
 from src.data_extract import DataExtract
 
+XHTML_NAMESPACE = '{http://www.w3.org/1999/xhtml}'
+OPF_NAMESPACE = '{http://www.idpf.org/2007/opf}'
+DC_NAMESPACE = '{http://purl.org/dc/elements/1.1/}'
+# Elements that start a new line of text, inline elements such as em or a are joined with their surroundings
+BLOCK_TAGS = {'p', 'div', 'br', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'pre', 'section', 'dt', 'dd'}
+SKIPPED_TAGS = {'script', 'style'}
+HTML_ENTITIES = {name: chr(code) for name, code in name2codepoint.items()}
+NAMED_ENTITY = re.compile(rb'&([A-Za-z][A-Za-z0-9]*);')
+UNDEFINED_ENTITY = expat_errors.codes[expat_errors.XML_ERROR_UNDEFINED_ENTITY]
+
+
+class _ChapterText:
+    """
+    Parser target collecting the text of a chapter as it streams through expat, no element tree is built.
+    Text arrives in document order, so text inside inline elements and the tail text after them are both kept
+    """
+
+    # Namespaced tag -> local name, shared so each tag is only split once
+    _names = {}
+
+    def __init__(self):
+        self.lines = []
+        self.title = None
+        self._line = []
+        self._title = None
+        self._in_body = False
+        self._skipping = 0
+
+    def _break(self):
+        line = ''.join(self._line).strip()
+        if len(line) > 0:
+            self.lines.append(line)
+        self._line = []
+
+    def _name(self, tag):
+        name = self._names.get(tag)
+        if name is None:
+            name = self._names[tag] = tag.rsplit('}', 1)[-1]
+        return name
+
+    def start(self, tag, _):
+        tag = self._name(tag)
+        if tag == 'body':
+            self._in_body = True
+        elif tag in SKIPPED_TAGS:
+            self._skipping += 1
+        elif tag in BLOCK_TAGS:
+            self._break()
+        if tag == 'h1' and self.title is None and self._in_body:
+            self._title = []
+
+    def end(self, tag):
+        tag = self._name(tag)
+        if tag == 'body':
+            self._break()
+            self._in_body = False
+        elif tag in SKIPPED_TAGS:
+            self._skipping -= 1
+        elif tag in BLOCK_TAGS:
+            self._break()
+        if tag == 'h1' and self._title is not None:
+            self.title = ''.join(self._title).strip()
+            self._title = None
+
+    def data(self, data):
+        if not self._in_body or self._skipping > 0:
+            return
+        self._line.append(data)
+        if self._title is not None:
+            self._title.append(data)
+
+    def close(self):
+        return '\n'.join(self.lines)
+
+
+def _numeric_entities(data):
+    """
+    Replace named HTML entities with numeric character references, which resolve without a DTD.
+    Unknown names are left alone
+    """
+    def replace(match):
+        code = name2codepoint.get(match.group(1).decode('ascii'))
+        return match.group(0) if code is None else b'&#%d;' % code
+    return NAMED_ENTITY.sub(replace, data)
+
+
+def _parse(data):
+    target = _ChapterText()
+    parser = ET.XMLParser(target=target)
+    # Named HTML entities resolve through this table in chapters that declare an external DTD
+    parser.entity.update(HTML_ENTITIES)
+    parser.feed(data)
+    text = parser.close()
+    return target.title, text
+
+
+def parse_chapter(data):
+    """
+    Stream the text out of an XHTML chapter
+    :param data: The raw chapter bytes
+    :return: The title from the first h1 or None, and the body text with one line per block element
+    """
+    try:
+        return _parse(data)
+    except ET.ParseError as e:
+        # Without an external DTD, such as <!DOCTYPE html> or no doctype, expat rejects &nbsp; and the like
+        # before the entity table is consulted, the chapter is parsed again with them as character references
+        if e.code != UNDEFINED_ENTITY:
+            raise
+    return _parse(_numeric_entities(data))
+
 
 class EpubExtract(DataExtract):
     def __init__(self):
@@ -13,26 +129,20 @@ class EpubExtract(DataExtract):
 
     def _get_text_data(self, itemid, data, debug=False):
         try:
-            root = ET.fromstring(data)
+            title, text = parse_chapter(data)
         except ET.ParseError:
             return
-        body = root.find('.//{http://www.w3.org/1999/xhtml}body')
-        header = body.find('.//{http://www.w3.org/1999/xhtml}h1')
-        text = '\n'.join([p.text for p in body.findall('.//*') if p.text is not None]).strip()
-        if header is None or header.text is None:
+        if not title:
             # Append to previous chapter
-            if len(self._data['chapters']) == 0:
+            if len(self._data['chapters']) == 0 or len(text) == 0:
                 return
             self._data['chapters'][-1]['text'] += '\n' + text
             return
-        if text is None:
-            if debug:
-                print('No text found for chapter', header.text, itemid)
-            return
-        title = header.text
         if text.startswith(title):
             text = text[len(title):].strip()
         if len(text) == 0:
+            if debug:
+                print('No text found for chapter', title, itemid)
             return
         self._data['chapters'].append({
             'id': itemid,
@@ -41,52 +151,54 @@ class EpubExtract(DataExtract):
         })
 
     def _load_data(self, filepath, debug=False):
-        self._data['filepath'] = filepath
-        self._data['chapters'] = []
+        self._data = {
+            'filepath': filepath,
+            'book_name': basename(filepath).rsplit('.', 1)[0],
+            'author': '',
+            'chapters': []
+        }
+        # Every file of the book is read through this one open archive
         with ZipFile(filepath, 'r') as zip_file:
+            names = set(zip_file.namelist())
             # Read the container file to get the manifest path
-            with zip_file.open('META-INF/container.xml') as container:
-                root = ET.fromstring(container.read())
-                manifest_path = root.find(".//*[@full-path]").get('full-path')
-            if manifest_path not in zip_file.namelist():
+            root = ET.fromstring(zip_file.read('META-INF/container.xml'))
+            manifest_path = root.find(".//*[@full-path]").get('full-path')
+            if manifest_path not in names:
                 return 0
             # Read the manifest file to get the text files
-            manifest_dir = dirname(manifest_path)
-            with zip_file.open(manifest_path) as manifest:
-                root = ET.fromstring(manifest.read())
-                metadata = root.find('.//{http://www.idpf.org/2007/opf}metadata')
-                if metadata is None:
-                    return 0
-                book_title = metadata.find('.//{http://purl.org/dc/elements/1.1/}title')
-                if book_title is not None:
-                    self._data['book_name'] = book_title.text
-                creator = metadata.find('.//{http://purl.org/dc/elements/1.1/}creator')
-                if creator is not None:
-                    self._data['author'] = creator.text
-
-                items = root.findall('.//{http://www.idpf.org/2007/opf}manifest/{http://www.idpf.org/2007/opf}item')
-                for ref in root.find('.//{http://www.idpf.org/2007/opf}spine'):
-                    item = [x for x in items if x.get('id') == ref.get('idref')][0]
-                    # Only load the text files
-                    if item.get('media-type') not in ('application/xhtml+xml',):
-                        continue
-                    if item.get('properties') in ('nav',):
-                        continue
-                    item_path = manifest_dir + '/' + item.get('href')
-                    skip = False
-                    for k in ['frontmatter', 'backmatter', 'cover', 'copyright', 'signup']:
-                        if k in item_path:
-                            skip = True
-                            break
-                    if skip:
-                        continue
-                    try:
-                        with zip_file.open(item_path) as text_file:
-                            self._get_text_data(item.get('id'), text_file.read(), debug)
-                    except KeyError:
-                        if debug:
-                            print('Could not find', item_path)
-                        continue
+            manifest_dir = posixpath.dirname(manifest_path)
+            root = ET.fromstring(zip_file.read(manifest_path))
+            metadata = root.find(f'.//{OPF_NAMESPACE}metadata')
+            if metadata is None:
+                return 0
+            book_title = metadata.find(f'.//{DC_NAMESPACE}title')
+            if book_title is not None:
+                self._data['book_name'] = book_title.text
+            creator = metadata.find(f'.//{DC_NAMESPACE}creator')
+            if creator is not None:
+                self._data['author'] = creator.text
+
+            items = {item.get('id'): item for item in root.iterfind(f'.//{OPF_NAMESPACE}manifest/{OPF_NAMESPACE}item')}
+            spine = root.find(f'.//{OPF_NAMESPACE}spine')
+            for ref in (spine if spine is not None else ()):
+                item = items.get(ref.get('idref'))
+                if item is None:
+                    if debug:
+                        print('No manifest item for', ref.get('idref'))
+                    continue
+                # Only load the text files
+                if item.get('media-type') not in ('application/xhtml+xml',):
+                    continue
+                if item.get('properties') in ('nav',):
+                    continue
+                item_path = posixpath.normpath(posixpath.join(manifest_dir, unquote(item.get('href'))))
+                if any(k in item_path for k in ('frontmatter', 'backmatter', 'cover', 'copyright', 'signup')):
+                    continue
+                if item_path not in names:
+                    if debug:
+                        print('Could not find', item_path)
+                    continue
+                self._get_text_data(item.get('id'), zip_file.read(item_path), debug)
         return len(self._data['chapters'])
 
     def get_book_name(self, _):
@@ -0,0 +1,56 @@
+import json
+from hashlib import sha1
+from os import stat
+
+
+def file_hash(filepath, block_size=1 << 20):
+    """
+    Hash the contents of a file
+    :param filepath: The path to the file
+    :param block_size: The number of bytes to read at a time
+    :return: The sha1 hex digest of the file
+    """
+    digest = sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(manifest_path):
+    """
+    Load a manifest written by save_manifest
+    :param manifest_path: The path to the manifest
+    :return: A dict of filepath -> {'mtime', 'size', 'hash'}
+    """
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, manifest_path):
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+
+def update_manifest(manifest, filepaths):
+    """
+    Compares the files on disk against a previous manifest.
+    Files whose mtime and size are unchanged are trusted without being read, the others are hashed
+    :param manifest: The previous manifest, empty if there is none
+    :param filepaths: The paths of the files currently on disk
+    :return: The new manifest, the list of added or modified files and the list of removed files
+    """
+    updated = {}
+    changed = []
+    for filepath in filepaths:
+        info = stat(filepath)
+        previous = manifest.get(filepath)
+        if previous is not None and previous['mtime'] == info.st_mtime_ns and previous['size'] == info.st_size:
+            updated[filepath] = previous
+            continue
+        entry = {'mtime': info.st_mtime_ns, 'size': info.st_size, 'hash': file_hash(filepath)}
+        if previous is None or previous['hash'] != entry['hash']:
+            changed.append(filepath)
+        updated[filepath] = entry
+    removed = [filepath for filepath in manifest if filepath not in updated]
+    return updated, changed, removed
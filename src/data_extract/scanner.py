@@ -0,0 +1,145 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os.path import isdir
+from threading import Lock
+
+
+def file_extension(name):
+    """
+    :param name: A file name or path
+    :return: The text after the last dot of the name, '' if it has none
+    """
+    name = os.path.basename(name)
+    return name.rsplit('.', 1)[1] if '.' in name else ''
+
+
+class DirectoryCache:
+    """
+    Directory listings keyed by path and validated against the directory's mtime.
+    Adding, removing or renaming an entry changes the mtime of its directory, so an unchanged directory
+    costs one stat on a rescan instead of a full listing
+    """
+
+    def __init__(self):
+        self._listings = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._listings)
+
+    def get(self, path, mtime_ns):
+        """
+        :return: The (files, directories) of the path if it was listed at this mtime, otherwise None
+        """
+        with self._lock:
+            listing = self._listings.get(path)
+        if listing is None or listing[0] != mtime_ns:
+            return None
+        return listing[1], listing[2]
+
+    def put(self, path, mtime_ns, files, directories):
+        with self._lock:
+            self._listings[path] = mtime_ns, files, directories
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+
+
+# Shared by every scan that does not pass its own cache, so rescans of the same folders are incremental
+LISTING_CACHE = DirectoryCache()
+
+
+class _Walk:
+    """
+    The state of one scan: directories already visited, so symlinked loops are only walked once
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+        self._visited = set()
+        self._lock = Lock()
+
+    def list(self, path):
+        """
+        :return: The (files, directories) paths in the directory, None if it was visited or cannot be read
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            if (stat.st_dev, stat.st_ino) in self._visited:
+                return None
+            self._visited.add((stat.st_dev, stat.st_ino))
+        if self._cache is not None:
+            listing = self._cache.get(path, stat.st_mtime_ns)
+            if listing is not None:
+                return listing
+        files = []
+        directories = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    # The entry type comes from the listing itself, only symlinks need a stat
+                    try:
+                        if entry.is_dir():
+                            directories.append(entry.path)
+                        elif entry.is_file():
+                            files.append(entry.path)
+                    except OSError:
+                        continue
+        except OSError:
+            return None
+        if self._cache is not None:
+            self._cache.put(path, stat.st_mtime_ns, files, directories)
+        return files, directories
+
+
+def scan_files(path, extensions=None, workers=1, cache=LISTING_CACHE):
+    """
+    Lazily walk a directory tree with os.scandir
+    :param path: The directory to search in
+    :param extensions: The file extensions to keep, None keeps every file
+    :param workers: With more than one, subdirectories are listed concurrently by that many threads
+    and files are yielded as their directory finishes, otherwise the walk is depth first
+    :param cache: A DirectoryCache reused across scans, None to always list
+    :return: A generator of file paths
+    """
+    if not isdir(path):
+        raise ValueError(f"{path} is not a directory")
+    extensions = None if extensions is None else set(extensions)
+    walk = _Walk(cache)
+
+    def keep(files):
+        if extensions is None:
+            return files
+        return [filepath for filepath in files if file_extension(filepath) in extensions]
+
+    if workers <= 1:
+        stack = [path]
+        while stack:
+            listing = walk.list(stack.pop())
+            if listing is None:
+                continue
+            files, directories = listing
+            yield from keep(files)
+            stack.extend(reversed(directories))
+        return
+
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {executor.submit(walk.list, path)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    listing = future.result()
+                    if listing is None:
+                        continue
+                    files, directories = listing
+                    pending.update(executor.submit(walk.list, directory) for directory in directories)
+                    yield from keep(files)
+        finally:
+            # A consumer that stops early should not wait for the rest of the tree
+            for future in pending:
+                future.cancel()
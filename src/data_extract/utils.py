@@ -1,6 +1,3 @@
-from os import listdir
-from os.path import isdir, join
-
 from src.data_extract import DataExtract
 from src.data_extract.epub import EPUB_EMBEDDINGS, EpubExtract
 
@@ -25,17 +22,3 @@ def get_extractor_struct_for_extension(ext):
         return EPUB_EMBEDDINGS
     else:
         raise ValueError(f"Unknown extractor for extension {ext}")
-
-
-def glob_files(path, supported):
-    files = []
-    for file in listdir(path):
-        name, ext = file.rsplit('.', 1)
-        if ext not in supported:
-            continue
-        if isdir(join(path, file)):
-            files += glob_files(join(path, file), supported)
-        else:
-            files.append(join(path, file))
-    return files
-
@@ -0,0 +1,212 @@
+import json
+from os import remove, replace
+from os.path import exists
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DATASET_VERSION = 1
+# Rows per row group, small enough that a group of full documents fits in memory
+ROW_GROUP_SIZE = 1024
+METADATA_KEY = b'loci'
+
+
+def dataset_exists(path):
+    return exists(path)
+
+
+def store_dataset_path(store_path):
+    """
+    :return: The dataset an embedding store was built from, {name}_embeddings is built from {name}.parquet
+    """
+    return store_path[:-len('_embeddings')] + '.parquet'
+
+
+def migrate_pickle(pickle_path, path):
+    """
+    Convert a dataset saved by an older version as a pandas pickle, the pickle is removed once converted
+    :return: True if a pickle was converted
+    """
+    if not exists(pickle_path) or dataset_exists(path):
+        return False
+    save_dataset(pd.read_pickle(pickle_path), path)
+    remove(pickle_path)
+    return True
+
+
+def _frames(frames):
+    if isinstance(frames, pd.DataFrame):
+        return [frames]
+    return frames
+
+
+def _writable_schema(schema):
+    """
+    Give a type to columns that were inferred as null, such as links that happened to be empty in every row
+    seen so far, so later rows with values still fit. The footer counts of a previous file are dropped
+    """
+    for ix, field in enumerate(schema):
+        if pa.types.is_null(field.type):
+            schema = schema.set(ix, field.with_type(pa.string()))
+        elif pa.types.is_list(field.type) and pa.types.is_null(field.type.value_type):
+            schema = schema.set(ix, field.with_type(pa.list_(pa.string())))
+    return schema.with_metadata({key: value for key, value in (schema.metadata or {}).items() if key != METADATA_KEY})
+
+
+def save_dataset(frames, path, row_group_size=ROW_GROUP_SIZE, schema=None):
+    """
+    Write extracted rows as a Parquet file with column statistics. The file is written next to the path
+    and moved over it when complete, so it can be rewritten from a stream of its own row groups
+    :param frames: A dataframe or an iterable of dataframes with the same columns
+    :param path: The .parquet file
+    :param row_group_size: The maximum rows per row group
+    :param schema: The arrow schema of the rows, inferred from the first rows if None
+    """
+    temporary_path = path + '.tmp'
+    writer = None
+    empty = None
+    rows = 0
+    filepaths = set()
+    try:
+        for frame in _frames(frames):
+            # Columns of an empty frame have no type to infer, the schema comes from the first rows
+            if len(frame) == 0:
+                empty = frame if empty is None else empty
+                continue
+            if writer is None:
+                if schema is None:
+                    schema = pa.Schema.from_pandas(frame, preserve_index=False)
+                writer = pq.ParquetWriter(temporary_path, _writable_schema(schema), write_statistics=True)
+            writer.write_table(pa.Table.from_pandas(frame, schema=writer.schema, preserve_index=False), row_group_size=row_group_size)
+            rows += len(frame)
+            if 'filepath' in frame:
+                filepaths.update(frame['filepath'])
+        if writer is None:
+            if schema is None:
+                schema = pa.Schema.from_pandas(empty if empty is not None else pd.DataFrame(), preserve_index=False)
+            writer = pq.ParquetWriter(temporary_path, _writable_schema(schema))
+        # Counts in the footer let readers skip the data entirely
+        writer.add_key_value_metadata({METADATA_KEY: json.dumps({
+            'version': DATASET_VERSION,
+            'rows': rows,
+            'files': len(filepaths) if len(filepaths) > 0 else rows,
+        })})
+    finally:
+        if writer is not None:
+            writer.close()
+    replace(temporary_path, path)
+
+
+def _to_pandas(table):
+    frame = table.to_pandas()
+    # Lists such as links come back as numpy arrays
+    for column, field in zip(table.column_names, table.schema):
+        if pa.types.is_list(field.type):
+            frame[column] = [value.tolist() if value is not None else [] for value in frame[column]]
+    return frame
+
+
+def load_dataset(path, columns=None):
+    """
+    :param path: The .parquet file
+    :param columns: The columns to read, None reads every column
+    :return: The dataframe
+    """
+    return _to_pandas(pq.read_table(path, columns=columns))
+
+
+def iter_row_groups(path, columns=None):
+    """
+    Read a dataset one row group at a time, so it never has to fit in memory
+    :param columns: The columns to read, None reads every column
+    :return: A generator of dataframes
+    """
+    parquet_file = pq.ParquetFile(path)
+    for group in range(parquet_file.num_row_groups):
+        yield _to_pandas(parquet_file.read_row_group(group, columns=columns))
+
+
+def row_group_offsets(path):
+    """
+    :return: The first row of every row group followed by the row count, from the footer alone
+    """
+    metadata = pq.ParquetFile(path).metadata
+    sizes = [metadata.row_group(group).num_rows for group in range(metadata.num_row_groups)]
+    return np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)])
+
+
+def read_rows(path, rows, columns=None):
+    """
+    Read rows by position, only the row groups holding them are decoded
+    :param rows: The row positions
+    :return: A dataframe of the rows in the given order
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    offsets = row_group_offsets(path)
+    groups = np.searchsorted(offsets, rows, 'right') - 1
+    parquet_file = pq.ParquetFile(path)
+    frames = []
+    positions = []
+    for group in np.unique(groups):
+        mask = groups == group
+        frame = _to_pandas(parquet_file.read_row_group(int(group), columns=columns))
+        frames.append(frame.iloc[rows[mask] - offsets[group]])
+        positions.append(np.flatnonzero(mask))
+    if len(frames) == 0:
+        return load_dataset(path, columns).iloc[:0]
+    order = np.argsort(np.concatenate(positions), kind='stable')
+    return pd.concat(frames, ignore_index=True).iloc[order].reset_index(drop=True)
+
+
+def dataset_info(path):
+    """
+    Counts of a dataset read from the Parquet footer without touching the data
+    :return: A dict of rows, files, row_groups and columns
+    """
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.metadata
+    info = json.loads((metadata.metadata or {}).get(METADATA_KEY, b'{}'))
+    return {
+        'rows': metadata.num_rows,
+        'files': info.get('files', metadata.num_rows),
+        'row_groups': metadata.num_row_groups,
+        'columns': parquet_file.schema_arrow.names,
+    }
+
+
+def merge_dataset(path, new_rows, removed_filepaths, row_group_size=ROW_GROUP_SIZE):
+    """
+    Replace the rows of changed files in a dataset sorted by filepath, streaming over its row groups.
+    Old rows of removed or changed files are dropped and the new rows are merged in filepath order
+    :param path: The .parquet file, created if it does not exist
+    :param new_rows: A dataframe of the rows of changed files
+    :param removed_filepaths: The filepaths whose old rows are dropped, changed and removed files
+    """
+    new_rows = new_rows.sort_values('filepath', kind='stable', ignore_index=True)
+    if not dataset_exists(path):
+        save_dataset(new_rows, path, row_group_size)
+        return
+    removed_filepaths = set(removed_filepaths)
+    new_filepaths = new_rows['filepath'].to_numpy(dtype=object)
+
+    def merged():
+        first = 0
+        pending = []
+        for frame in iter_row_groups(path):
+            frame = frame[~frame['filepath'].isin(removed_filepaths)]
+            if len(frame) == 0:
+                continue
+            last = int(np.searchsorted(new_filepaths, frame['filepath'].iloc[-1], 'right'))
+            pending += [frame, new_rows.iloc[first:last]]
+            first = last
+            # Groups shrunk by dropped rows are joined so repeated merges do not fragment the file
+            if sum(len(part) for part in pending) >= row_group_size:
+                yield pd.concat(pending).sort_values('filepath', kind='stable', ignore_index=True)
+                pending = []
+        pending.append(new_rows.iloc[first:])
+        yield pd.concat(pending).sort_values('filepath', kind='stable', ignore_index=True)
+
+    # The schema of the file, not of its first rows: a first row group without any links would infer list<null>
+    save_dataset(merged(), path, row_group_size, pq.ParquetFile(path).schema_arrow)
@@ -0,0 +1,259 @@
+import json
+from os import makedirs, remove, replace
+from os.path import abspath, exists, join
+from time import time
+
+import numpy as np
+
+STORE_VERSION = 1
+EMBEDDINGS_FILE = 'embeddings.npy'
+FILENAMES_FILE = 'filenames.npy'
+SPANS_FILE = 'spans.npy'
+KEYS_FILE = 'keys.npy'
+HEADER_FILE = 'header.json'
+
+
+def embeddings_path(store_path):
+    """
+    :return: The path of the raw embedding matrix inside a store, used to write it in place
+    """
+    return join(store_path, EMBEDDINGS_FILE)
+
+
+def store_exists(store_path):
+    # The header is written last, a store without one was interrupted
+    return exists(join(store_path, HEADER_FILE))
+
+
+def invalidate_store(store_path):
+    """
+    Remove the header of a store before any of its files are rewritten, so an interrupted rewrite
+    is never mistaken for a complete store
+    """
+    header_path = join(store_path, HEADER_FILE)
+    if exists(header_path):
+        remove(header_path)
+
+
+def save_store(store_path, embeddings, filenames, spans=None, keys=None, **provenance):
+    """
+    Saves an embedding store: a directory holding the matrix as a raw .npy, the filenames as a
+    fixed width string table and a header with the dtype, shape and provenance
+    :param store_path: The store directory
+    :param embeddings: The embedding matrix, a memmap already at embeddings_path(store_path) is not rewritten
+    :param filenames: The filename of each row
+    :param spans: Optional (row, start, end) int array locating each chunk in its source dataframe
+    :param keys: Optional content key of each chunk
+    :param provenance: Extra header fields such as model and chunk_size
+    """
+    makedirs(store_path, exist_ok=True)
+    invalidate_store(store_path)
+    matrix_path = embeddings_path(store_path)
+    if not (isinstance(embeddings, np.memmap) and abspath(embeddings.filename) == abspath(matrix_path)):
+        np.save(matrix_path, embeddings)
+    np.save(join(store_path, FILENAMES_FILE), np.asarray(filenames, dtype=str))
+    # Optional arrays of a previous save would no longer match the rows
+    for name, values, dtype in ((SPANS_FILE, spans, np.int64), (KEYS_FILE, keys, 'S40')):
+        if values is not None:
+            np.save(join(store_path, name), np.asarray(values, dtype=dtype))
+        elif exists(join(store_path, name)):
+            remove(join(store_path, name))
+    header = {
+        'version': STORE_VERSION,
+        'dtype': np.dtype(embeddings.dtype).name,
+        'shape': list(embeddings.shape),
+        'created': time(),
+        **provenance
+    }
+    # Written last and moved into place, so the store only exists once every other file is complete
+    header_path = join(store_path, HEADER_FILE)
+    with open(header_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(header, f, indent=2)
+    replace(header_path + '.tmp', header_path)
+
+
+def load_header(store_path):
+    with open(join(store_path, HEADER_FILE), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_store(store_path, mmap_mode='r'):
+    """
+    Opens an embedding store without reading the matrix into memory
+    :param store_path: The store directory
+    :param mmap_mode: The numpy mmap mode, None loads the matrix into memory
+    :return: The embeddings and the filename of each row
+    """
+    if not store_exists(store_path):
+        raise ValueError(f"{store_path} is not an embedding store")
+    embeddings = np.load(embeddings_path(store_path), mmap_mode=mmap_mode, allow_pickle=False)
+    filenames = np.load(join(store_path, FILENAMES_FILE), allow_pickle=False)
+    return embeddings, filenames
+
+
+def load_spans(store_path):
+    """
+    :return: The (row, start, end) array of the store or None if it was saved without one
+    """
+    path = join(store_path, SPANS_FILE)
+    return np.load(path, allow_pickle=False) if exists(path) else None
+
+
+def load_keys(store_path):
+    """
+    :return: The chunk key of each row or None if the store was saved without them
+    """
+    path = join(store_path, KEYS_FILE)
+    return np.load(path, allow_pickle=False) if exists(path) else None
+
+
+class ShardedEmbeddings:
+    """
+    Presents several embedding stores as one logical row-indexed matrix.
+    Shards stay memory-mapped, rows are only read when indexed, sliced or iterated
+    """
+
+    def __init__(self, store_paths=()):
+        self._paths = []
+        self._shards = []
+        self._filenames = []
+        self._offsets = np.zeros(1, dtype=np.int64)
+        for store_path in store_paths:
+            self.add_store(store_path)
+
+    def add_store(self, store_path):
+        """
+        Append a store as new rows, the existing shards are left untouched
+        :param store_path: The store directory
+        """
+        embeddings, filenames = load_store(store_path)
+        if len(self._shards) > 0:
+            if embeddings.shape[1:] != self._shards[0].shape[1:]:
+                raise ValueError(f"{store_path} has shape {embeddings.shape}, expected {self.shape}")
+            if embeddings.dtype != self.dtype:
+                raise ValueError(f"{store_path} has dtype {embeddings.dtype}, expected {self.dtype}")
+        self._paths.append(store_path)
+        self._shards.append(embeddings)
+        self._filenames.append(filenames)
+        self._offsets = np.append(self._offsets, self._offsets[-1] + len(embeddings))
+
+    @property
+    def store_paths(self):
+        return list(self._paths)
+
+    @property
+    def shape(self):
+        if len(self._shards) == 0:
+            return 0, 0
+        return (int(self._offsets[-1]),) + self._shards[0].shape[1:]
+
+    @property
+    def dtype(self):
+        return self._shards[0].dtype if len(self._shards) > 0 else np.dtype(np.float32)
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    @property
+    def filenames(self):
+        return np.concatenate(self._filenames) if len(self._filenames) > 0 else np.empty(0, dtype=str)
+
+    @property
+    def keys(self):
+        """
+        :return: The chunk key of every row, None if any store was saved without them
+        """
+        keys = [load_keys(path) for path in self._paths]
+        if any(key is None for key in keys):
+            return None
+        return np.concatenate(keys) if len(keys) > 0 else np.empty(0, dtype='S40')
+
+    def locate(self, row):
+        """
+        Find which store a row of the combined matrix lives in
+        :param row: A row index
+        :return: The store path and the row within that store
+        """
+        shard_id = int(np.searchsorted(self._offsets, row, 'right') - 1)
+        return self._paths[shard_id], int(row - self._offsets[shard_id])
+
+    def take(self, rows):
+        """
+        Gather rows from the shards they live in
+        :param rows: An int array of row indices
+        :return: A new in-memory array of the rows in the given order
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.ndim != 1:
+            raise ValueError("rows must be one dimensional")
+        rows = np.where(rows < 0, rows + len(self), rows)
+        if len(rows) > 0 and (rows.min() < 0 or rows.max() >= len(self)):
+            raise IndexError("row index out of range")
+        out = np.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+        shard_ids = np.searchsorted(self._offsets, rows, 'right') - 1
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            out[mask] = self._shards[shard_id][rows[mask] - self._offsets[shard_id]]
+        return out
+
+    def __getitem__(self, index):
+        columns = ()
+        if isinstance(index, tuple):
+            index, columns = index[0], index[1:]
+        if isinstance(index, (int, np.integer)):
+            return self.take([index])[0][columns]
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            rows = self._slice(start, stop) if step == 1 else self.take(np.arange(start, stop, step))
+        else:
+            index = np.asarray(index)
+            rows = self.take(np.flatnonzero(index) if index.dtype == bool else index)
+        return rows[(slice(None),) + columns]
+
+    def _slice(self, start, stop):
+        """
+        Contiguous rows, a view into the shard when they do not cross a shard boundary
+        """
+        if stop <= start:
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+        first = int(np.searchsorted(self._offsets, start, 'right') - 1)
+        if stop <= self._offsets[first + 1]:
+            return self._shards[first][start - self._offsets[first]:stop - self._offsets[first]]
+        return self.take(np.arange(start, stop))
+
+    def iter_blocks(self, block_size=65536):
+        """
+        Iterate over the matrix in blocks that never cross a shard, each block is a memmap view
+        :param block_size: The maximum rows per block
+        :return: A generator of (first row, block)
+        """
+        for shard_id, shard in enumerate(self._shards):
+            offset = int(self._offsets[shard_id])
+            for start in range(0, len(shard), block_size):
+                yield offset + start, shard[start:start + block_size]
+
+    def astype(self, dtype):
+        out = np.empty(self.shape, dtype=dtype)
+        for start, block in self.iter_blocks():
+            out[start:start + len(block)] = block
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        return self.astype(self.dtype if dtype is None else dtype)
+
+    def save(self, path):
+        """
+        Save the list of shards, the shards themselves are not copied
+        :param path: The path of the json index
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'version': STORE_VERSION, 'stores': self._paths}, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f)['stores'])
@@ -1,6 +1,8 @@
 import platform
 
-from src.gui_utils import Embeddings
+from src.chunking import DEFAULT_CHUNK_SIZE
+from src.data_extract.scanner import file_extension, scan_files
+from src.gui_utils import Embeddings, FolderScan
 
 if platform.system() == 'Windows':
     from win32api import GetSystemMetrics
@@ -24,8 +26,8 @@ Config.set('graphics', 'height', window_height)
 Config.set('graphics', 'left', left)
 Config.set('graphics', 'top', top)
 
-from os import listdir, makedirs
-from os.path import exists, expanduser, isdir, join
+from os import makedirs
+from os.path import exists, expanduser
 
 from kivy.app import App
 from kivy.clock import Clock
@@ -41,6 +43,9 @@ from kivy.uix.tabbedpanel import TabbedPanel
 from kivy_garden.filebrowser import FileBrowser
 
 from configparser import ConfigParser
+from datetime import timedelta
+from functools import partial
+from queue import Empty
 import multiprocessing
 from uuid import uuid5
 
@@ -69,27 +74,27 @@ if not exists(parser.get('data', 'data_folder')):
     makedirs(parser.get('data', 'data_folder'))
 
 
-def _get_valid(path, valid):
-    items = [join(path, x) for x in listdir(path)]
-    count = 0
-    file_types = set()
-    for item in items:
-        if isdir(item):
-            c, f = _get_valid(item, valid)
-            count += c
-            file_types = file_types.union(f)
-        else:
-            ext = item.rsplit('.', 1)[-1]
-            if ext in valid:
-                count += 1
-                file_types.add(ext)
-    return count, file_types
+# Seconds a rescan waits for further requests before it starts
+SCAN_DEBOUNCE = 0.5
+
+
+def file_type_string(file_types):
+    file_types = sorted(file_types)
+    text = ', '.join(file_types[:5])
+    if len(file_types) > 5:
+        text += ', and {} others'.format(len(file_types) - 5)
+    return text
 
 
 def get_valid_files(folder, valid=None):
     if valid is None:
         valid = [y for x, y in DATA_TYPES]
-    return _get_valid(folder, valid)
+    count = 0
+    file_types = set()
+    for filepath in scan_files(folder, valid):
+        count += 1
+        file_types.add(file_extension(filepath))
+    return count, file_types
 
 
 class InsetCheckBox(RelativeLayout):
@@ -254,37 +259,92 @@ class InputFoldersRecycleView(HeaderRecycleView):
         self.data = []
         self._popup = None
         self._last_path = None
+        # Rows are keyed by an index that is never reused, so a late scan result cannot land on a newer row
+        self._next_index = 0
+        self._scans = {}
+        self._scan_triggers = {}
         self._headers = [('Path', 0.55), ('Detected Files', 0.1), ('Supported File Types', 0.15), ('Enabled', 0.1), ('Remove', 0.1)]
         for ix, (path, data) in enumerate(parser.items('input_folders')):
             enabled, item_count, valid_types = data.split('|')
-            self.data.append({
-                'root':    self,
-                'sizes':   [y for x, y in self._headers],
-                'info':    [item_count, valid_types],
-                'title':   path.replace('&col', ':'),
-                'enabled': enabled == 'True',
-                'index':   len(self.data),
-                'type':    'input_folder',
-            })
+            self._append_row(path.replace('&col', ':'), [item_count, valid_types], enabled == 'True')
+        # Saved counts are shown right away and refreshed in the background
+        self.rescan_all()
 
-    def _add_folder(self, path):
-        if path == '':
-            return
-        item_count, file_types = get_valid_files(path)
-        file_type_string = ', '.join(list(file_types)[:5])
-        if len(file_types) > 5:
-            file_type_string += ', and {} others'.format(len(file_types) - 5)
-        self.data.append({
+    def _append_row(self, path, info, enabled=True):
+        item = {
             'root':    self,
             'sizes':   [y for x, y in self._headers],
-            'info':    [str(item_count), file_type_string],
-            'title':   path.lower(),
-            'enabled': True,
-            'index':   len(self.data),
+            'info':    info,
+            'title':   path,
+            'enabled': enabled,
+            'index':   self._next_index,
             'type':    'input_folder',
-        })
+        }
+        self._next_index += 1
+        self.data.append(item)
+        return item
+
+    def _find(self, index):
+        for item in self.data:
+            if item['index'] == index:
+                return item
+        return None
+
+    def rescan(self, index):
+        """
+        Schedule a background scan of a row, repeated requests within SCAN_DEBOUNCE start a single scan
+        """
+        if index not in self._scan_triggers:
+            self._scan_triggers[index] = Clock.create_trigger(partial(self._start_scan, index), SCAN_DEBOUNCE)
+        self._scan_triggers[index]()
+
+    def rescan_all(self):
+        for item in self.data:
+            self.rescan(item['index'])
+
+    def _cancel_scan(self, index, forget=False):
+        scan = self._scans.pop(index, None)
+        if scan is not None:
+            scan.stop()
+        if forget and index in self._scan_triggers:
+            self._scan_triggers.pop(index).cancel()
+
+    def _start_scan(self, index, *_):
+        item = self._find(index)
+        if item is None:
+            return
+        self._cancel_scan(index)
+        # Unchanged directories are served from the scanner's listing cache, so rescans only list what changed
+        rescan = item['info'][0] != ''
+        scan = FolderScan(item['title'], [y for x, y in DATA_TYPES],
+                          lambda count, file_types, done: Clock.schedule_once(
+                              lambda _: self._scan_progress(index, scan, count, file_types, done, rescan)))
+        self._scans[index] = scan
+        scan.start()
+
+    def _scan_progress(self, index, scan, count, file_types, done, rescan):
+        # Ignore results from a scan that was cancelled or replaced
+        if self._scans.get(index) is not scan:
+            return
+        item = self._find(index)
+        if item is None:
+            return
+        if done:
+            self._scans.pop(index)
+            item['info'] = [str(count), file_type_string(file_types)]
+        elif rescan:
+            # Keep the previous result until the rescan finishes
+            return
+        else:
+            item['info'] = [f'{count}...', file_type_string(file_types)]
+        self.refresh_from_data()
 
+    def _add_folder(self, path):
+        if path == '':
+            return
+        item = self._append_row(path.lower(), ['', 'Scanning...'])
         self.refresh_from_data()
+        self._start_scan(item['index'])
 
     def add_folder(self, text_input, error_label):
         if text_input.text == '':
@@ -328,15 +388,16 @@ class InputFoldersRecycleView(HeaderRecycleView):
         self._add_folder(path)
 
     def remove_all(self):
+        for item in self.data:
+            self._cancel_scan(item['index'], forget=True)
         self.data = []
         self.refresh_from_data()
 
     def remove(self, widget):
-        to_remove = None
-        for item in self.data:
-            if item['index'] == widget.index:
-                to_remove = item
-                break
+        to_remove = self._find(widget.index)
+        if to_remove is None:
+            return
+        self._cancel_scan(to_remove['index'], forget=True)
         self.data.remove(to_remove)
         self.refresh_from_data()
 
@@ -358,6 +419,8 @@ class CreateEmbeddings(RelativeLayout):
         self._status = 'not_started'
         self._embedding_type = None
         self._embedding_thread = None
+        self._check_event = None
+        self._result = None
         super().__init__(**kwargs)
 
         default_type = options['type']
@@ -377,18 +440,20 @@ class CreateEmbeddings(RelativeLayout):
         info = {
             'input_folders': [],
             'output_folder': parser.get('data', 'data_folder'),
+            'api_key': parser.get('cohere', 'api_key'),
             'force': self.ids.force_reload.state == 'down',
         }
 
+        supported = [y for x, y in DATA_TYPES]
         for item in self.pipeline.ids.input_folders_rv.data:
             if item['enabled']:
                 info['input_folders'].append({
                     'path': item['title'],
-                    'extensions': item['info'][1].split(', '),
+                    'extensions': [ext for ext in item['info'][1].split(', ') if ext in supported],
                 })
 
         if self._embedding_type == 'Cohere':
-            info['chunk_size'] = self.ids.chunk_size.value
+            info['chunk_size'] = int(self.ids.chunk_size.value)
         else:
             raise NotImplementedError('Only Cohere Supported')
 
@@ -398,24 +463,54 @@ class CreateEmbeddings(RelativeLayout):
             self.ids.embedding_status.text = 'Running'
             self._embedding_thread = Embeddings(info)
             self._embedding_thread.start()
-            Clock.schedule_interval(self.check_finish, 0.25)
+            self._check_event = Clock.schedule_interval(self.check_finish, 0.25)
         elif self._status == 'running':
-            # TODO: Stop the embedding
+            # The worker stops after the file or batch it is on, finished batches stay in the embedding cache
             if self._embedding_thread.is_alive():
                 self._embedding_thread.stop()
-            self._status = 'not_started'
+            self._status = 'stopping'
             self.ids.embedding_status.text = 'Stopping'
             self.ids.interaction.text = 'Start'
             self.ids.interaction.disabled = True
 
+    def _show_progress(self, progress):
+        stage = progress['stage']
+        if stage == 'error':
+            self.set_status(f'Error: {progress["message"]}')
+            return
+        if stage in ('finished', 'cancelled'):
+            return
+        text = f'{stage.capitalize()} {progress["done"]}/{progress["total"]} {progress["unit"]}, {progress["rate"]:.1f} {progress["unit"]}/s'
+        if progress['eta'] is not None:
+            text += f', ETA {timedelta(seconds=round(progress["eta"]))}'
+        self.set_status(text)
+
     def check_finish(self, _):
-        if not self._embedding_thread.is_alive():
-            if self._status == 'running':
-                self.ids.embedding_status.text = 'Finished'
-                self.ids.interaction.text = 'Start'
-            elif self._status == 'not_running':
-                self.ids.embedding_status.text = 'Terminated'
-                self.ids.interaction.disabled = False
+        # Only the latest update is worth drawing
+        last = None
+        while True:
+            try:
+                last = self._embedding_thread.progress.get_nowait()
+            except Empty:
+                break
+            if last['stage'] in ('finished', 'cancelled', 'error'):
+                self._result = last
+        if last is not None:
+            self._show_progress(last)
+        if self._embedding_thread.is_alive():
+            return
+        self._check_event.cancel()
+        result = self._result['stage'] if self._result is not None else 'error'
+        if result == 'finished':
+            self.set_status(f'Finished: {self._result["files"]} files, {self._result["chunks"]} chunks')
+        elif result == 'cancelled' or self._status == 'stopping':
+            self.set_status('Terminated')
+        elif self._result is None:
+            self.set_status('Error')
+        self._result = None
+        self._status = 'not_started'
+        self.ids.interaction.text = 'Start'
+        self.ids.interaction.disabled = False
 
     def change_embedding_type(self, new_type):
         self._embedding_type = new_type
@@ -441,10 +536,11 @@ class Pipeline(TabbedPanel):
 
         self.options = {
             'type': 'Cohere',
-            'chunk_size': 512,
+            'chunk_size': DEFAULT_CHUNK_SIZE,
             'embedding_types': {
                 'Cohere': {
-                    'max_chunk_size': 512,
+                    # In words, the model truncates anything past 512 tokens
+                    'max_chunk_size': DEFAULT_CHUNK_SIZE,
 
                 }
             }
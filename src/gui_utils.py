@@ -1,13 +1,21 @@
-from os import makedirs
+from os import makedirs, remove
+from queue import Queue
+from time import monotonic
 from typing import Optional
-from uuid import uuid4
 
 import pandas as pd
 
 from hashlib import sha1
-from os.path import basename, exists, join
+from os.path import exists, join
 
-from src.data_extract.utils import get_extractor_struct_for_extension, get_extractor_for_extension, glob_files
+import src.data_extract.cohere_api as capi
+from src.data_extract import DataExtract
+from src.data_extract.embedding_cache import EmbeddingCache
+from src.data_extract.manifest import load_manifest, save_manifest, update_manifest
+from src.data_extract.scanner import file_extension, scan_files
+from src.data_extract.utils import get_extractor_struct_for_extension, get_extractor_for_extension
+from src.dataset import dataset_exists, dataset_info, merge_dataset
+from src.embedding_store import load_header
 
 import threading
 
@@ -27,53 +35,186 @@ class StoppableThread(threading.Thread):
         return self._stop_event.is_set()
 
 
+class FolderScan(StoppableThread):
+    """
+    Counts the supported files of a folder in the background. Progress is reported through a callback
+    from this thread, the caller is responsible for moving it to the UI thread
+    """
+
+    def __init__(self, path, extensions, on_progress, interval=0.1, workers=4, **kwargs):
+        """
+        :param path: The folder to scan
+        :param extensions: The file extensions to count
+        :param on_progress: Called with (count, file_types, done), at most every interval seconds and once when done
+        :param workers: The number of threads listing subdirectories
+        """
+        super().__init__(daemon=True, **kwargs)
+        self._path = path
+        self._extensions = extensions
+        self._on_progress = on_progress
+        self._interval = interval
+        self._workers = workers
+
+    def run(self):
+        count = 0
+        file_types = set()
+        last_report = monotonic()
+        files = scan_files(self._path, self._extensions, self._workers)
+        try:
+            for filepath in files:
+                if self.stopped():
+                    return
+                count += 1
+                file_types.add(file_extension(filepath))
+                if monotonic() - last_report >= self._interval:
+                    last_report = monotonic()
+                    self._on_progress(count, set(file_types), False)
+        except ValueError:
+            # The folder was removed or is not a directory
+            pass
+        finally:
+            files.close()
+        if not self.stopped():
+            self._on_progress(count, file_types, True)
+
+
 def hash_string(string):
     return sha1(string.encode('utf-8')).hexdigest()
 
 
+class Throughput:
+    """
+    Rate and ETA of a stage from the work done since it started
+    """
+
+    def __init__(self, total, interval=0.1):
+        self.total = total
+        self._start = monotonic()
+        self._interval = interval
+        self._last = None
+
+    def report(self, stage, unit, done, **extra):
+        """
+        :return: The progress dict, None if the last one was less than interval seconds ago and the stage is not done
+        """
+        now = monotonic()
+        if self._last is not None and now - self._last < self._interval and done < self.total:
+            return None
+        self._last = now
+        elapsed = max(now - self._start, 1e-9)
+        rate = done / elapsed
+        eta = (self.total - done) / rate if rate > 0 else None
+        return {'stage': stage, 'unit': unit, 'done': done, 'total': self.total, 'rate': rate, 'eta': eta, **extra}
+
+
 class Embeddings(StoppableThread):
+    """
+    Runs extraction, chunking and embedding for the folders chosen in the GUI.
+    Progress dicts are put on the progress queue for the UI to poll: stage, unit, done, total, rate (units per second)
+    and eta (seconds), followed by a final 'finished' (with the file and chunk counts), 'cancelled' or 'error' message.
+    Stopping is checked after every file and every embedding batch. Finished batches are kept in the embedding cache,
+    so starting the same run again continues from the last completed batch
+    """
+
     def __init__(self, info, **kwargs):
+        """
+        :param info: The input_folders (path and extensions), output_folder, chunk_size, api_key and force flag
+        """
         self._info = info
-        super().__init__(**kwargs)
+        self.progress = Queue()
+        super().__init__(daemon=True, **kwargs)
 
     def run(self) -> Optional[str]:
-        self._info['name'] = uuid4().hex
+        # The name only depends on the inputs, so a stopped run resumes into the same dataset and store
+        self._info['name'] = hash_string(repr(sorted((folder['path'], sorted(folder['extensions'])) for folder in self._info['input_folders'])))[:16]
         print('Running Embeddings', self._info['name'])
-        print(self._info)
-        if self.stopped():
-            return None
-        # Stage 1: Glob Files
-        # data = self.load_data()
-        if self.stopped():
+        try:
+            # Stage 1: Extract the files
+            data_path = self.load_data()
+            if data_path is None:
+                self.progress.put({'stage': 'cancelled'})
+                return None
+            # Stage 2 and 3: Chunk and embed
+            self.create_embedding(data_path)
+        except capi.EmbeddingCancelled:
+            self.progress.put({'stage': 'cancelled'})
             return None
-        # Stage 3: Run Embedding
-        embedding = self.create_embedding(data)
-        if self.stopped():
-            return None
-        # Stage 4: Save Embedding
-
+        except Exception as e:
+            self.progress.put({'stage': 'error', 'message': str(e)})
+            raise
+        # Counts come from the dataset footer and the store header, neither is read in full
+        output_folder = self._info['output_folder']
+        self.progress.put({'stage': 'finished', 'name': self._info['name'],
+                           'files': dataset_info(data_path)['files'],
+                           'chunks': load_header(join(output_folder, f'{self._info["name"]}_embeddings'))['shape'][0]})
         return self._info['name']
 
+    def _publish(self, report):
+        if report is not None:
+            self.progress.put(report)
+
     def load_data(self):
-        data = {}
+        """
+        Extract every supported file, only files changed since the last run are read again
+        :return: The path of the dataset of the run or None if it was stopped
+        """
+        output_folder = self._info['output_folder']
+        makedirs(output_folder, exist_ok=True)
+        data_path = join(output_folder, f'{self._info["name"]}.parquet')
+        manifest_path = join(output_folder, f'{self._info["name"]}_manifest.json')
+
+        files = {}
         for input_folder in self._info['input_folders']:
-            extensions = input_folder['extensions']
-            valid_files = glob_files(input_folder['path'], extensions)
-            extractors = {extension: get_extractor_for_extension(extension)() for extension in extensions}
-            for file in valid_files:
-                file_hash = hash_string(file)
-                extractor = extractors[file.rsplit('.', 1)[1]]
-                data[file_hash] = extractor.extract_data(file)
+            for filepath in scan_files(input_folder['path'], input_folder['extensions']):
+                files[filepath] = file_extension(filepath)
                 if self.stopped():
-                    return {}
-        return data
-
-    def create_embedding(self, data):
-        embedding = None
-        for file_hash, file_data in data.items():
-
-        # for data_name, dataframe in data.items():
-        #     embedding = dataframe
-        #     if self.stopped():
-        #         return None
-        return embedding
+                    return None
+
+        manifest = {}
+        if not self._info.get('force') and dataset_exists(data_path) and exists(manifest_path):
+            manifest = load_manifest(manifest_path)
+        elif dataset_exists(data_path):
+            remove(data_path)
+        manifest, changed, removed = update_manifest(manifest, list(files))
+        if len(changed) == 0 and len(removed) == 0 and dataset_exists(data_path):
+            return data_path
+
+        extractors = {}
+        rows = []
+        throughput = Throughput(len(changed))
+        for ix, filepath in enumerate(changed):
+            extension = files[filepath]
+            if extension not in extractors:
+                extractor = get_extractor_for_extension(extension)()
+                extractor.set_valid_extensions([extension])
+                struct = {'filepath': DataExtract.get_filepath, **get_extractor_struct_for_extension(extension)}
+                extractors[extension] = extractor, struct
+            extractor, struct = extractors[extension]
+            # Only the columns every extractor shares are kept
+            rows += [{'filepath': row['filepath'], 'filename': row['filename'], 'text': row['text']}
+                     for row in extractor._extract_rows(filepath, struct)]
+            self._publish(throughput.report('extracting', 'files', ix + 1))
+            if self.stopped():
+                return None
+        merge_dataset(data_path, pd.DataFrame(rows, columns=['filepath', 'filename', 'text']), changed + removed)
+        # The manifest is saved last, an interrupted extraction is redone next time
+        save_manifest(manifest, manifest_path)
+        return data_path
+
+    def create_embedding(self, data_path):
+        output_folder = self._info['output_folder']
+        cache = EmbeddingCache(join(output_folder, 'embedding_cache.sqlite'))
+        throughput = None
+
+        def progress(done, total):
+            nonlocal throughput
+            if throughput is None:
+                throughput = Throughput(total)
+            self._publish(throughput.report('embedding', 'chunks', done))
+
+        try:
+            return capi.create_embeddings(data_path, self._info['api_key'], cache=cache, chunk_size=self._info['chunk_size'],
+                                          store_path=join(output_folder, f'{self._info["name"]}_embeddings'),
+                                          stop=self.stopped, progress=progress)
+        finally:
+            cache.close()
@@ -0,0 +1,222 @@
+import json
+from os import makedirs, remove, replace
+from os.path import exists, join
+
+import numpy as np
+from scipy.cluster.hierarchy import leaves_list
+
+HIERARCHY_VERSION = 1
+HEADER_FILE = 'header.json'
+ARRAYS = ('parent', 'left', 'right', 'height', 'size', 'order', 'start')
+
+
+def leaf_order(linked):
+    """
+    The dendrogram leaf order of a linkage and where every node's leaves start in it.
+    The leaves under a node are a contiguous run of the order that begins at the node's first leaf,
+    found by following left children down, doubling the jump each pass
+    :param linked: A scipy linkage matrix
+    :return: The int64 leaf order and the int64 start of each of the 2 * leaves - 1 nodes
+    """
+    linked = np.asarray(linked)
+    count = len(linked) + 1
+    first_leaf = np.arange(2 * count - 1, dtype=np.int64)
+    first_leaf[count:] = linked[:, 0].astype(np.int64)
+    while True:
+        jumped = first_leaf[first_leaf]
+        if np.array_equal(jumped, first_leaf):
+            break
+        first_leaf = jumped
+    order = leaves_list(linked).astype(np.int64) if count > 1 else np.zeros(1, dtype=np.int64)
+    position = np.empty(count, dtype=np.int64)
+    position[order] = np.arange(count)
+    return order, position[first_leaf]
+
+
+class ClusterTree:
+    """
+    A cluster hierarchy as flat arrays indexed by node id, using scipy's numbering: leaves are 0..count - 1 and
+    are the rows of the clustered matrices, merge i of the linkage is node count + i and the root is the last node.
+    Nothing is copied per node, data for a leaf is looked up in the shared matrices by its id.
+    The leaves under a node are the contiguous run order[start[node]:start[node] + size[node]]
+    """
+
+    def __init__(self, parent, left, right, height, size, order, start):
+        self.parent = parent
+        self.left = left
+        self.right = right
+        self.height = height
+        self.size = size
+        self.order = order
+        self.start = start
+        self._position = None
+
+    @classmethod
+    def from_linkage(cls, linked):
+        """
+        :param linked: A scipy linkage matrix
+        :return: The tree of its merges
+        """
+        linked = np.asarray(linked)
+        count = len(linked) + 1
+        node_count = 2 * count - 1
+        merged = np.arange(count, node_count, dtype=np.int32)
+        left = np.full(node_count, -1, dtype=np.int32)
+        right = np.full(node_count, -1, dtype=np.int32)
+        left[count:] = linked[:, 0]
+        right[count:] = linked[:, 1]
+        parent = np.full(node_count, -1, dtype=np.int32)
+        parent[left[count:]] = merged
+        parent[right[count:]] = merged
+        height = np.zeros(node_count)
+        height[count:] = linked[:, 2]
+        size = np.ones(node_count, dtype=np.int32)
+        size[count:] = linked[:, 3]
+        order, start = leaf_order(linked)
+        return cls(parent, left, right, height, size, order.astype(np.int32), start.astype(np.int32))
+
+    def to_linkage(self):
+        """
+        :return: The scipy linkage matrix of the tree
+        """
+        count = self.count
+        return np.column_stack([self.left[count:], self.right[count:], self.height[count:], self.size[count:]]).astype(np.float64)
+
+    @property
+    def count(self):
+        """
+        The number of leaves
+        """
+        return (len(self.parent) + 1) // 2
+
+    @property
+    def root(self):
+        return len(self.parent) - 1
+
+    def __len__(self):
+        return len(self.parent)
+
+    def is_leaf(self, node):
+        return node < self.count
+
+    def children(self, node):
+        """
+        :return: The (left, right) children of a merge, an empty tuple for a leaf
+        """
+        if self.is_leaf(node):
+            return ()
+        return int(self.left[node]), int(self.right[node])
+
+    def leaf_range(self, node):
+        """
+        :return: The (start, stop) run of the leaf order covered by a node
+        """
+        start = int(self.start[node])
+        return start, start + int(self.size[node])
+
+    def leaves(self, node):
+        """
+        :return: The leaf ids, which are the matrix rows, under a node in dendrogram order
+        """
+        start, stop = self.leaf_range(node)
+        return self.order[start:stop]
+
+    @property
+    def position(self):
+        """
+        Where each leaf sits in the leaf order
+        """
+        if self._position is None:
+            self._position = np.empty(self.count, dtype=np.int32)
+            self._position[self.order] = np.arange(self.count, dtype=np.int32)
+        return self._position
+
+    def contains(self, node, leaves):
+        """
+        :param node: A node id
+        :param leaves: A leaf id or an array of them
+        :return: Whether each leaf is under the node
+        """
+        start, stop = self.leaf_range(node)
+        position = self.position[leaves]
+        return (position >= start) & (position < stop)
+
+    def ancestors(self, node):
+        """
+        :return: The generator of node ids from the node's parent up to the root
+        """
+        node = self.parent[node]
+        while node >= 0:
+            yield int(node)
+            node = self.parent[node]
+
+    def preorder(self, node=None):
+        """
+        Depth first traversal with an explicit stack, so deep trees do not hit the recursion limit
+        :param node: The subtree to walk, the whole tree if None
+        :return: A generator of node ids, parents before children and left before right
+        """
+        stack = [self.root if node is None else node]
+        count = self.count
+        while stack:
+            node = stack.pop()
+            yield node
+            if node >= count:
+                stack.append(int(self.right[node]))
+                stack.append(int(self.left[node]))
+
+    def postorder(self, node=None):
+        """
+        :param node: The subtree to walk, the whole tree if None
+        :return: A generator of node ids, children before parents and left before right
+        """
+        stack = [(self.root if node is None else node, False)]
+        count = self.count
+        while stack:
+            node, expanded = stack.pop()
+            if expanded or node < count:
+                yield node
+                continue
+            stack.append((node, True))
+            stack.append((int(self.right[node]), False))
+            stack.append((int(self.left[node]), False))
+
+    def depth(self):
+        """
+        :return: The depth of every node, the root has depth 0
+        """
+        depth = np.zeros(len(self), dtype=np.int32)
+        # Parents always have larger ids than their children, so walking ids downward visits parents first
+        for node in range(self.root, self.count - 1, -1):
+            depth[self.left[node]] = depth[self.right[node]] = depth[node] + 1
+        return depth
+
+    def save(self, path):
+        """
+        Saves the arrays as raw .npy files in a directory. The header of a previous save is removed before
+        any array is rewritten and the new one is written last, so an interrupted save never loads
+        :param path: The directory
+        """
+        makedirs(path, exist_ok=True)
+        header_path = join(path, HEADER_FILE)
+        if exists(header_path):
+            remove(header_path)
+        for name in ARRAYS:
+            np.save(join(path, f'{name}.npy'), getattr(self, name))
+        with open(header_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'version': HIERARCHY_VERSION, 'count': self.count}, f, indent=2)
+        replace(header_path + '.tmp', header_path)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        :param path: The directory written by save
+        :param mmap_mode: The numpy mmap mode, None loads the arrays into memory
+        """
+        if not hierarchy_exists(path):
+            raise ValueError(f"{path} is not a saved hierarchy")
+        return cls(*(np.load(join(path, f'{name}.npy'), mmap_mode=mmap_mode, allow_pickle=False) for name in ARRAYS))
+
+
+def hierarchy_exists(path):
+    return exists(join(path, HEADER_FILE))
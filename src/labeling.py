@@ -0,0 +1,199 @@
+from os.path import exists
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import CountVectorizer
+
+from src.api_client import RateLimitedClient
+from src.dataset import iter_row_groups, store_dataset_path
+from src.embedding_store import load_spans
+from src.sqlite_cache import SqliteCache
+from src.stages import fingerprint
+
+# Leaves gathered into one sparse product when counting the terms of a batch of nodes
+BATCH_LEAVES = 1 << 20
+PROMPT = 'Give a short title of two to five words for a group of notes about: {keywords}\nTitle:'
+
+
+def subtree_hashes(tree, keys):
+    """
+    Content hash of every node's set of chunks. Each chunk key gives two random 64 bit words and a node hashes
+    to their wrapping sum over its leaves, so every node is one difference of a prefix sum over the leaf order
+    and a subtree hashes the same wherever it moves in the tree
+    :param tree: A ClusterTree
+    :param keys: The hex chunk key of each leaf
+    :return: A (nodes, 2) uint64 array
+    """
+    digests = np.frombuffer(bytes.fromhex(b''.join(np.asarray(keys, dtype='S40')).decode('ascii')), dtype=np.uint8)
+    words = digests.reshape(-1, 20)[:, :16].copy().view(np.uint64)
+    totals = np.zeros((tree.count + 1, 2), dtype=np.uint64)
+    np.cumsum(words[tree.order], axis=0, out=totals[1:])
+    starts = np.asarray(tree.start, dtype=np.int64)
+    return totals[starts + tree.size] - totals[starts]
+
+
+class LabelCache(SqliteCache):
+    """
+    Persistent cache of node labels keyed by the labelling parameters and the subtree content hash,
+    so subtrees that did not change are never labelled again
+    """
+
+    def __init__(self, path):
+        super().__init__(path, 'labels', 'label TEXT NOT NULL, keywords TEXT NOT NULL')
+
+    def get_many(self, keys):
+        """
+        :param keys: An iterable of cache keys
+        :return: A dict of key -> (label, keywords) for every key found
+        """
+        return {key: (label, keywords) for _, rows in self._select_many(keys, ('label', 'keywords'))
+                for key, label, keywords in rows}
+
+    def put_many(self, items):
+        """
+        :param items: An iterable of (key, label, keywords)
+        """
+        self._conn.executemany('INSERT OR REPLACE INTO labels (key, label, keywords) VALUES (?, ?, ?)', items)
+        self._conn.commit()
+
+
+def iter_chunk_texts(embeddings):
+    """
+    Read the text of every row of a ShardedEmbeddings back from the datasets its stores were built from.
+    Spans follow the dataset order, so each dataset is read one row group of its text column at a time
+    :return: A generator of chunk texts in row order
+    """
+    for store_path in embeddings.store_paths:
+        spans = load_spans(store_path)
+        data_path = store_dataset_path(store_path)
+        if spans is None or not exists(data_path):
+            raise ValueError(f"{store_path} has no spans or dataset to read chunk text from")
+        first_row = 0
+        span = 0
+        for frame in iter_row_groups(data_path, ['text']):
+            texts = frame['text'].tolist()
+            last = int(np.searchsorted(spans[:, 0], first_row + len(texts), 'left'))
+            for data_row, start, end in spans[span:last]:
+                yield texts[data_row - first_row][start:end]
+            first_row += len(texts)
+            span = last
+
+
+def term_counts(texts, max_features=50000, min_df=2):
+    """
+    :param texts: An iterable of chunk texts, consumed once
+    :return: The (chunks, terms) sparse count matrix and the vocabulary
+    """
+    vectorizer = CountVectorizer(stop_words='english', max_features=max_features, min_df=min_df, dtype=np.int32)
+    try:
+        counts = vectorizer.fit_transform(texts)
+    except ValueError:
+        # Every term was filtered out, e.g. a tiny corpus with min_df > 1
+        return csr_matrix((0, 0), dtype=np.int32), np.empty(0, dtype=str)
+    return counts.tocsr(), vectorizer.get_feature_names_out()
+
+
+def ctfidf_keywords(tree, counts, vocabulary, nodes, top_k=8, batch_leaves=BATCH_LEAVES):
+    """
+    c-TF-IDF keywords of nodes: the term frequencies of everything under a node weighted by
+    log(1 + average terms per chunk / corpus frequency of the term).
+    Node counts come from one sparse product per batch, an indicator of each node's leaf range times the term matrix
+    :param tree: A ClusterTree
+    :param counts: The (leaves, terms) sparse count matrix
+    :param vocabulary: The term of each column
+    :param nodes: The node ids to describe
+    :param batch_leaves: The leaves summed per batch, bounds the size of the indicator matrix
+    :return: A generator of (node, keywords) in the order of nodes
+    """
+    nodes = np.asarray(nodes, dtype=np.int64)
+    if counts.shape[1] == 0:
+        for node in nodes:
+            yield int(node), []
+        return
+    ordered = counts[np.asarray(tree.order)]
+    frequency = np.asarray(counts.sum(axis=0)).ravel()
+    idf = np.log1p(counts.sum() / counts.shape[0] / np.maximum(frequency, 1))
+
+    sizes = np.asarray(tree.size, dtype=np.int64)[nodes]
+    first = 0
+    while first < len(nodes):
+        last = first + max(1, int(np.searchsorted(np.cumsum(sizes[first:]), batch_leaves, 'right')))
+        batch, batch_sizes = nodes[first:last], sizes[first:last]
+        indptr = np.concatenate([[0], np.cumsum(batch_sizes)])
+        # The positions start[node] .. start[node] + size[node] - 1 of every node, laid end to end
+        positions = np.arange(indptr[-1]) + np.repeat(np.asarray(tree.start, dtype=np.int64)[batch] - indptr[:-1], batch_sizes)
+        indicator = csr_matrix((np.ones(len(positions), dtype=np.int32), positions, indptr), shape=(len(batch), tree.count))
+        node_counts = (indicator @ ordered).tocsr().astype(np.float64)
+        totals = np.maximum(np.asarray(node_counts.sum(axis=1)).ravel(), 1)
+        scores = csr_matrix(node_counts.multiply(1 / totals[:, None]).multiply(idf[None, :]))
+        for ix, node in enumerate(batch):
+            row = slice(scores.indptr[ix], scores.indptr[ix + 1])
+            data, columns = scores.data[row], scores.indices[row]
+            top = np.argsort(-data, kind='stable')[:top_k]
+            yield int(node), vocabulary[columns[top]].tolist()
+        first = last
+
+
+def label_hierarchy(tree, keys, texts, cache, min_size=5, top_k=8, max_features=50000, min_df=2,
+                    llm=None, llm_name=None, concurrency=4, batch_leaves=BATCH_LEAVES):
+    """
+    Label every cluster of the hierarchy with at least min_size chunks.
+    Labels are the top c-TF-IDF keywords, or the answer of an LLM prompted with them
+    :param tree: A ClusterTree
+    :param keys: The hex chunk key of each leaf
+    :param texts: A callable returning an iterable of the chunk text of each leaf, only called if some node is not cached
+    :param cache: A LabelCache
+    :param min_size: The smallest cluster labelled
+    :param top_k: The number of keywords kept per cluster
+    :param llm: A callable taking one prompt and returning its answer, None to label with keywords
+    :param llm_name: Identifies the LLM in the cache keys, so changing it relabels everything
+    :param concurrency: The number of prompts in flight
+    :return: The label and the comma separated keywords of every node, '' for nodes that were not labelled
+    """
+    nodes = np.flatnonzero(np.asarray(tree.size) >= max(min_size, 2))
+    labels = np.full(len(tree), '', dtype=object)
+    keywords = np.full(len(tree), '', dtype=object)
+    params = fingerprint(top_k, max_features, min_df, llm_name if llm is not None else None)
+    hashes = subtree_hashes(tree, keys)[nodes]
+    cache_keys = [f'{params}:{high:016x}{low:016x}' for high, low in hashes]
+    found = cache.get_many(cache_keys)
+    missing = []
+    for node, key in zip(nodes, cache_keys):
+        if key in found:
+            labels[node], keywords[node] = found[key]
+        else:
+            missing.append((int(node), key))
+    print(f'labels: {len(nodes) - len(missing)} cached, {len(missing)} to label')
+    if len(missing) == 0:
+        return labels, keywords
+
+    counts, vocabulary = term_counts(texts(), max_features, min_df)
+    key_of = dict(missing)
+    described = ctfidf_keywords(tree, counts, vocabulary, [node for node, _ in missing], top_k, batch_leaves)
+    if llm is None:
+        results = ((node, ', '.join(terms), terms) for node, terms in described)
+    else:
+        results = _llm_labels(described, llm, concurrency)
+
+    pending = []
+    for node, label, terms in results:
+        labels[node], keywords[node] = label, ', '.join(terms)
+        pending.append((key_of[node], labels[node], keywords[node]))
+        # Checkpoint as labels arrive so an interrupted run keeps its work
+        if len(pending) >= 1000:
+            cache.put_many(pending)
+            pending = []
+    cache.put_many(pending)
+    return labels, keywords
+
+
+def _llm_labels(described, llm, concurrency):
+    """
+    Prompt the llm with the keywords of each node, every prompt is its own request so concurrency of them are in flight
+    :return: A generator of (node, label, keywords)
+    """
+    client = RateLimitedClient(llm, concurrency=concurrency)
+    get_prompt = lambda item: PROMPT.format(keywords=', '.join(item[1]))
+    for (node, terms), answer in client.call_batches(described, get_prompt):
+        answer = answer.strip()
+        yield node, (answer.splitlines()[0].strip() if answer else ', '.join(terms)), terms
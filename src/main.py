@@ -1,4 +1,6 @@
-from os import getcwd
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from os import cpu_count, getcwd, remove
 from subprocess import run
 from configparser import ConfigParser, NoOptionError
 
@@ -6,106 +8,177 @@ import numpy as np
 import pandas as pd
 from os.path import basename, exists, join
 
-from scipy.cluster.hierarchy import dendrogram, linkage, to_tree
+from scipy.cluster.hierarchy import dendrogram, linkage
 
+from src.chunking import DEFAULT_CHUNK_SIZE
+from src.clustering import hierarchical_linkage
 from src.color_utils import blend_colors, blend_pca_colors, color_to_hex
-from src.utils import load_npz, load_pickle, plot_dendrogram, plot_embeddings, read_file, reduce_embeddings, save_npz, save_pickle, store_info_in_leaves
+from src.dataset import dataset_exists, dataset_info, merge_dataset, migrate_pickle
+from src.embedding_store import ShardedEmbeddings, load_store, store_exists
+from src.hierarchy import ClusterTree, hierarchy_exists
+from src.labeling import LabelCache, iter_chunk_texts, label_hierarchy
+from src.reduction import parse_method, run_reduction
+from src.stages import StageRunner
+from src.utils import load_pickle, plot_dendrogram, plot_embeddings, read_file, save_pickle
+from src.data_extract import DataExtract
+from src.data_extract.manifest import load_manifest, save_manifest, update_manifest
 from src.data_extract.utils import get_extractor_struct_for_extension, get_extractor_for_extension
 import src.data_extract.cohere_api as capi
+from src.data_extract.embedding_cache import EmbeddingCache
 
 if not getcwd().endswith('fractal-embeddings'):
     print('Please run this script from the root directory of the project.')
     exit(1)
 
 
-def load_data(config):
+def load_data(config, runner=None):
     try:
         input_folders = config.get('data', 'input_folders')
         output_folder = config.get('data', 'output_folder')
     except NoOptionError:
         print('Specify input_folders and output_folder in config.ini under [data] header')
         exit(1)
+    workers = config.getint('data', 'extract_workers', fallback=1)
+    if runner is None:
+        runner = StageRunner(output_folder)
 
     data = {}
     for input_regex in input_folders.split(','):
         extension, input_folder = input_regex.split(':', 1)
         data_name = basename(input_folder)
-        data_path = join(output_folder, f'{data_name}.pkl')
-        if exists(data_path):
+        data_path = join(output_folder, f'{data_name}.parquet')
+        manifest_path = join(output_folder, f'{data_name}_manifest.json')
+        extractor = get_extractor_for_extension(extension)()
+        extractor.set_valid_extensions([extension])
+        struct = {'filepath': DataExtract.get_filepath, **get_extractor_struct_for_extension(extension)}
+
+        migrate_pickle(join(output_folder, f'{data_name}.pkl'), data_path)
+        manifest = {}
+        if dataset_exists(data_path) and exists(manifest_path):
+            manifest = load_manifest(manifest_path)
+            if 'filepath' not in dataset_info(data_path)['columns']:
+                manifest = {}
+        if len(manifest) == 0 and dataset_exists(data_path):
+            remove(data_path)
+
+        manifest, changed, removed = update_manifest(manifest, extractor.list_files(input_folder))
+        if len(changed) == 0 and len(removed) == 0 and dataset_exists(data_path):
             print(f'Data already extracted. Skipping.')
-            data[data_name] = pd.read_pickle(data_path)
         else:
-            extractor = get_extractor_for_extension(extension)()
-            extractor.set_valid_extensions([extension])
-            struct = get_extractor_struct_for_extension(extension)
-            data[data_name] = extractor.extract_data(input_folder, struct)
-            data[data_name].to_pickle(data_path)
+            print(f'{data_name}: re-extracting {len(changed)} changed files, dropping {len(removed)} removed files')
+            dataframe = pd.DataFrame(columns=struct.keys())
+            if len(changed) > 0:
+                dataframe = extractor.extract_files(changed, struct, workers=workers)
+            # Rows stay sorted by filepath, so the order is independent of which files happened to change
+            merge_dataset(data_path, dataframe, changed + removed)
+        save_manifest(manifest, manifest_path)
+        # The manifest keeps the dataset itself up to date, its content hashes fingerprint it for later stages
+        runner.record(f'data:{data_name}', {'extension': extension, 'files': {path: entry['hash'] for path, entry in manifest.items()}})
+        data[data_name] = data_path
     return data
 
 
-def get_embeddings(config):
-    api_key = None
+def get_embeddings(config, runner=None):
     try:
         output_folder = config.get('data', 'output_folder')
     except NoOptionError:
         print('Specify output_folder in config.ini under [data] header')
         exit(1)
+    if runner is None:
+        runner = StageRunner(output_folder)
+
+    data = load_data(config, runner)
 
-    data = load_data(config)
+    params = {
+        'model': config.get('cohere', 'model', fallback='large'),
+        'truncate': 'END',
+        # Whitespace words, the default stays inside the model's 512 token window
+        'chunk_size': config.getint('data', 'chunk_size', fallback=DEFAULT_CHUNK_SIZE),
+        'chunk_unit': 'words',
+        'dtype': config.get('data', 'embedding_dtype', fallback='float32'),
+    }
+    clients = {}
+    cache = EmbeddingCache(join(output_folder, 'embedding_cache.sqlite'),
+                           max_bytes=config.getint('cohere', 'cache_size_mb', fallback=2048) * 1024 ** 2)
+
+    def build(data_path, embedding_path):
+        if 'cohere' not in clients:
+            try:
+                api_key = config.get('cohere', 'api_key')
+            except NoOptionError:
+                print('Please paste your API key in config.ini under a [cohere] header.')
+                exit(1)
+            # api_url lets the pipeline run against a local embedding server
+            clients['cohere'] = capi.make_client(api_key, config.get('cohere', 'api_url', fallback=None))
+        return capi.create_embeddings(data_path, None, cache=cache, client=clients['cohere'],
+                                      concurrency=config.getint('cohere', 'concurrency', fallback=4),
+                                      model=params['model'], truncate=params['truncate'], chunk_size=params['chunk_size'],
+                                      chunk_unit=params['chunk_unit'],
+                                      dtype=np.dtype(params['dtype']), store_path=embedding_path)
 
     embeddings = {}
-    for data_name, dataframe in data.items():
-        embedding_path = join(output_folder, f'{data_name}_embeddings.npz')
-        if exists(embedding_path):
-            print('Embeddings already extracted. Skipping.')
-            embeddings[data_name] = load_npz(embedding_path)
-        else:
-            if api_key is None:
-                try:
-                    api_key = config.get('cohere', 'api_key')
-                except NoOptionError:
-                    print('Please paste your API key in config.ini under a [cohere] header.')
-                    exit(1)
-            embeddings[data_name] = capi.create_embeddings(dataframe, api_key)
-            save_npz(embeddings[data_name], embedding_path)
+    for data_name, data_path in data.items():
+        embedding_path = join(output_folder, f'{data_name}_embeddings')
+        embeddings[data_name] = runner.run(f'embeddings:{data_name}',
+                                           lambda: build(data_path, embedding_path),
+                                           lambda: load_store(embedding_path),
+                                           lambda: store_exists(embedding_path),
+                                           params, [f'data:{data_name}'])
+    cache.close()
     return embeddings
 
 
-def get_combined_embeddings(config):
+def get_combined_embeddings(config, runner=None):
     try:
         output_folder = config.get('data', 'output_folder')
     except NoOptionError:
         print('Specify output_folder in config.ini under [data] header')
         exit(1)
+    if runner is None:
+        runner = StageRunner(output_folder)
 
-    if exists(join(output_folder, 'combined_embeddings.npz')):
-        print('Combined embeddings already extracted. Skipping.')
-        return load_npz(join(output_folder, 'combined_embeddings.npz'))
-    embeddings = get_embeddings(config)
-    combined_embeddings = np.concatenate([embedding[0] for embedding in embeddings.values()], axis=0)
-    combined_filenames = np.concatenate([embedding[1] for embedding in embeddings.values()], axis=0)
-    save_npz((combined_embeddings, combined_filenames), join(output_folder, 'combined_embeddings.npz'))
-    return combined_embeddings, combined_filenames
+    # The combined matrix is a view over the per dataset stores, only the list of stores is saved
+    embeddings = get_embeddings(config, runner)
+    combined_embeddings = ShardedEmbeddings([join(output_folder, f'{data_name}_embeddings') for data_name in embeddings])
+    combined_embeddings.save(join(output_folder, 'combined_embeddings.json'))
+    runner.record('combined', None, [f'embeddings:{data_name}' for data_name in embeddings])
+    return combined_embeddings, combined_embeddings.filenames
 
 
-def get_reduced_embeddings(config):
+def get_reduced_embeddings(config, runner=None):
     try:
-        reduction_methods = config.get('data', 'reduction_methods')
         output_folder = config.get('data', 'output_folder')
     except NoOptionError:
-        reduction_methods = ['pca5', 'umap2', 'tsne2']
+        print('Specify output_folder in config.ini under [data] header')
+        exit(1)
+    reduction_methods = config.get('data', 'reduction_methods', fallback='pca5,umap2,tsne2').split(',')
+    if runner is None:
+        runner = StageRunner(output_folder)
+
+    get_combined_embeddings(config, runner)
 
-    combined_embeddings, combined_filenames = get_combined_embeddings(config)
+    refit_threshold = config.getfloat('data', 'reduction_refit_threshold', fallback=0.1)
+    workers = config.getint('reduction', 'workers', fallback=len(reduction_methods))
+    combined_path = join(output_folder, 'combined_embeddings.json')
 
-    reduced_embeddings = {}
+    stages = []
     for method in reduction_methods:
-        reduction_path = join(output_folder, f'{method}_embeddings.npz')
-        if exists(reduction_path):
-            print(f'{method} embeddings already extracted. Skipping.')
-            reduced_embeddings[method] = load_npz(reduction_path)
-        else:
-            reduced_embeddings[method] = reduce_embeddings(combined_embeddings, method), combined_filenames
-            save_npz(reduced_embeddings[method], reduction_path)
+        reduction_path = join(output_folder, f'{method}_embeddings')
+        # Split the cores between the reducers running at once unless configured, e.g. [reduction] umap_threads = 4
+        threads = config.getint('reduction', f'{parse_method(method)[0]}_threads',
+                                fallback=max(1, (cpu_count() or 1) // min(workers, len(reduction_methods))))
+        stages.append((f'reduction:{method}',
+                       partial(run_reduction, combined_path, method, output_folder, refit_threshold, threads),
+                       partial(load_store, reduction_path, mmap_mode=None),
+                       partial(store_exists, reduction_path),
+                       {'method': method, 'refit_threshold': refit_threshold}, ['combined']))
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            reduced_embeddings = runner.run_many(stages, executor)
+    else:
+        reduced_embeddings = runner.run_many(stages)
+    reduced_embeddings = {method: reduced_embeddings[f'reduction:{method}'] for method in reduction_methods}
 
     colors = None
     if 'pca5' in reduction_methods:
@@ -118,6 +191,106 @@ def get_reduced_embeddings(config):
     return reduced_embeddings
 
 
+def get_linkage(config, runner=None, combined_embeddings=None):
+    try:
+        output_folder = config.get('data', 'output_folder')
+    except NoOptionError:
+        print('Specify output_folder in config.ini under [data] header')
+        exit(1)
+    if runner is None:
+        runner = StageRunner(output_folder)
+
+    if combined_embeddings is None:
+        combined_embeddings, _ = get_combined_embeddings(config, runner)
+
+    # Exact ward linkage needs O(n^2) memory, past leaf_size rows it is built from micro clusters
+    params = {'leaf_size': config.getint('clustering', 'leaf_size', fallback=2000)}
+    linkage_path = join(output_folder, 'linkage.npy')
+
+    def build():
+        linked = hierarchical_linkage(combined_embeddings, params['leaf_size'])
+        np.save(linkage_path, linked)
+        return linked
+
+    return runner.run('clustering', build,
+                      lambda: np.load(linkage_path, allow_pickle=False),
+                      lambda: exists(linkage_path),
+                      params, ['combined'])
+
+
+def get_hierarchy(config, runner=None, linked=None):
+    try:
+        output_folder = config.get('data', 'output_folder')
+    except NoOptionError:
+        print('Specify output_folder in config.ini under [data] header')
+        exit(1)
+    if runner is None:
+        runner = StageRunner(output_folder)
+
+    if linked is None:
+        linked = get_linkage(config, runner)
+
+    # The tree only holds node arrays, leaf ids index the combined and reduced embedding stores
+    hierarchy_path = join(output_folder, 'hierarchy')
+
+    def build():
+        tree = ClusterTree.from_linkage(linked)
+        tree.save(hierarchy_path)
+        return tree
+
+    return runner.run('hierarchy', build,
+                      lambda: ClusterTree.load(hierarchy_path),
+                      lambda: hierarchy_exists(hierarchy_path),
+                      None, ['clustering'])
+
+
+def get_labels(config, runner=None, tree=None, combined_embeddings=None):
+    try:
+        output_folder = config.get('data', 'output_folder')
+    except NoOptionError:
+        print('Specify output_folder in config.ini under [data] header')
+        exit(1)
+    if runner is None:
+        runner = StageRunner(output_folder)
+
+    if combined_embeddings is None:
+        combined_embeddings, _ = get_combined_embeddings(config, runner)
+    if tree is None:
+        tree = get_hierarchy(config, runner)
+
+    params = {
+        'min_size': config.getint('labels', 'min_size', fallback=5),
+        'top_k': config.getint('labels', 'top_k', fallback=8),
+        # Set [labels] llm_model to name clusters with a Cohere model instead of keywords
+        'llm_model': config.get('labels', 'llm_model', fallback=None),
+    }
+    hierarchy_path = join(output_folder, 'hierarchy')
+    labels_path = join(hierarchy_path, 'labels.npy')
+    keywords_path = join(hierarchy_path, 'keywords.npy')
+
+    def build():
+        keys = combined_embeddings.keys
+        if keys is None:
+            raise ValueError('The embedding stores have no chunk keys, rebuild them to label the hierarchy')
+        llm = None
+        if params['llm_model'] is not None:
+            co = capi.make_client(config.get('cohere', 'api_key'), config.get('cohere', 'api_url', fallback=None))
+            llm = lambda prompt: co.generate(prompt=prompt, model=params['llm_model'], max_tokens=16).generations[0].text
+        cache = LabelCache(join(output_folder, 'label_cache.sqlite'))
+        labels, keywords = label_hierarchy(tree, keys, lambda: iter_chunk_texts(combined_embeddings), cache,
+                                           params['min_size'], params['top_k'], llm=llm, llm_name=params['llm_model'],
+                                           concurrency=config.getint('cohere', 'concurrency', fallback=4))
+        cache.close()
+        np.save(labels_path, labels.astype(str))
+        np.save(keywords_path, keywords.astype(str))
+        return labels.astype(str), keywords.astype(str)
+
+    return runner.run('labels', build,
+                      lambda: (np.load(labels_path, allow_pickle=False), np.load(keywords_path, allow_pickle=False)),
+                      lambda: exists(labels_path) and exists(keywords_path),
+                      params, ['hierarchy', 'combined'])
+
+
 def main():
     # 1. Load Configuration Data
     if not exists('config.ini'):
@@ -127,13 +300,22 @@ def main():
     config = ConfigParser()
     config.read('config.ini')
 
-    get_reduced_embeddings(config)
+    output_folder = config.get('data', 'output_folder')
+    runner = StageRunner(output_folder)
+    reduced_embeddings = get_reduced_embeddings(config, runner)
+    combined_embeddings = ShardedEmbeddings.load(join(output_folder, 'combined_embeddings.json'))
 
     # 7. Cluster the embeddings
-    # linked = linkage(combined_embeddings, method='ward')
+    linked = get_linkage(config, runner, combined_embeddings)
+    tree = get_hierarchy(config, runner, linked)
+    # 9. Name the clusters
+    get_labels(config, runner, tree, combined_embeddings)
     # 8. Plot Dendrogram
-    # cluster_colors = blend_pca_colors(linked, colors, len(combined_filenames))
-    # plot_dendrogram(linked, combined_filenames, color_to_hex(cluster_colors))
+    if 'pca5' in reduced_embeddings:
+        combined_filenames = combined_embeddings.filenames
+        colors = reduced_embeddings['pca5'][0][:, 2:5]
+        cluster_colors = blend_pca_colors(linked, colors, len(combined_filenames))
+        plot_dendrogram(linked, combined_filenames, color_to_hex(cluster_colors))
 
 
 
@@ -0,0 +1,223 @@
+from os import makedirs
+from os.path import exists, join
+
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+from threadpoolctl import threadpool_limits
+
+from src.embedding_store import (ShardedEmbeddings, embeddings_path, invalidate_store, load_keys, load_store, save_store,
+                                 store_exists)
+from src.utils import REDUCTION_METHODS, load_pickle, normalize, save_pickle
+
+# Reducers that can project rows they were not fitted on
+TRANSFORM_METHODS = ('pca', 'umap')
+# Rows per block when streaming over an embedding matrix
+BLOCK_SIZE = 16384
+
+
+def parse_method(method):
+    """
+    Split a reduction method such as pca5 into its reducer name and number of components
+    """
+    for name in REDUCTION_METHODS:
+        if method.startswith(name):
+            return name, int(method[len(name):])
+    raise ValueError(f"Unknown reduction {method}")
+
+
+def _as_float(block):
+    return block if block.dtype in (np.float32, np.float64) else block.astype(np.float32)
+
+
+def _transform(reducer, embeddings, rows=None, block_size=BLOCK_SIZE, out_path=None):
+    """
+    Project rows through a fitted reducer block by block
+    :param embeddings: An array, memmap or ShardedEmbeddings
+    :param rows: The row indices to project, all rows if None
+    :param out_path: If given, the projection is written to a .npy memmap at this path
+    :return: The projected rows
+    """
+    count = len(embeddings) if rows is None else len(rows)
+    out = None
+    for start in range(0, count, block_size):
+        if rows is None:
+            block = embeddings[start:start + block_size]
+        else:
+            block = embeddings[rows[start:start + block_size]]
+        projected = reducer.transform(_as_float(block))
+        if out is None:
+            shape = (count, projected.shape[1])
+            if out_path is not None:
+                out = np.lib.format.open_memmap(out_path, mode='w+', dtype=projected.dtype, shape=shape)
+            else:
+                out = np.empty(shape, dtype=projected.dtype)
+        out[start:start + len(projected)] = projected
+    return out
+
+
+def _scale(reduced, state):
+    # Projections use the bounds of the original fit so the existing layout does not move
+    reduced -= state['minimum']
+    reduced /= state['maximum'] - state['minimum']
+    return np.clip(reduced, 0, 1, out=reduced)
+
+
+def _partial_fit(reducer, embeddings, rows=None, block_size=BLOCK_SIZE):
+    """
+    Update an IncrementalPCA block by block. A last block smaller than the number of components is merged into
+    the one before it, with fewer rows than components in total nothing is fitted
+    :return: The number of rows fitted, either every row or none
+    """
+    count = len(embeddings) if rows is None else len(rows)
+    if count < reducer.n_components:
+        return 0
+    starts = list(range(0, count, block_size))
+    if len(starts) > 1 and count - starts[-1] < reducer.n_components:
+        starts.pop()
+    for start, end in zip(starts, starts[1:] + [count]):
+        if rows is None:
+            reducer.partial_fit(_as_float(embeddings[start:end]))
+        else:
+            reducer.partial_fit(_as_float(embeddings[rows[start:end]]))
+    return count
+
+
+def streaming_pca(embeddings, components, out_path=None, block_size=BLOCK_SIZE):
+    """
+    Out-of-core PCA: an IncrementalPCA is fitted over blocks of the matrix and the components are written
+    block by block, so only one block of the embeddings is in memory at a time
+    :param embeddings: An array, memmap or ShardedEmbeddings
+    :param components: The number of components
+    :param out_path: If given, the components are written to a .npy memmap at this path
+    :return: The fitted reducer and the unnormalized components
+    """
+    reducer = IncrementalPCA(n_components=components)
+    _partial_fit(reducer, embeddings, block_size=block_size)
+    return reducer, _transform(reducer, embeddings, block_size=block_size, out_path=out_path)
+
+
+def fit_reduction(embeddings, method, keys=None, out_path=None, reducer_kwargs=None):
+    """
+    Fit a reducer from scratch
+    :param embeddings: The embedding matrix
+    :param method: The reduction method, such as pca5
+    :param keys: The chunk key of each row, recorded so later runs know which rows the reducer has seen
+    :param out_path: If given, PCA components are written to a .npy memmap at this path
+    :param reducer_kwargs: Extra arguments for the UMAP or TSNE constructor, such as n_jobs
+    :return: The normalized reduction and the reducer state
+    """
+    name, components = parse_method(method)
+    if name == 'pca':
+        # Streams over the matrix, the IncrementalPCA can later be updated with partial_fit
+        reducer, reduced = streaming_pca(embeddings, components, out_path)
+    else:
+        reducer = REDUCTION_METHODS[name](n_components=components, **(reducer_kwargs or {}))
+        reduced = reducer.fit_transform(_as_float(np.asarray(embeddings)))
+    keys = None if keys is None else np.unique(keys)
+    state = {
+        'method': method,
+        'reducer': reducer,
+        'minimum': reduced.min(),
+        'maximum': reduced.max(),
+        # The rows the layout was fitted on, drift is measured against them for every method
+        'keys': keys,
+        # The rows the reducer has learned from, PCA adds the rows it is updated with
+        'fitted': keys,
+    }
+    return normalize(reduced, copy=False), state
+
+
+def project_reduction(embeddings, keys, state, previous=None, out_path=None):
+    """
+    Place rows into an existing layout without refitting.
+    PCA is updated with partial_fit on the rows it has not learned from and every row is projected again,
+    fewer new rows than components wait for a later run. UMAP keeps the previous coordinates of known rows
+    and only transforms new ones
+    :param embeddings: The embedding matrix
+    :param keys: The chunk key of each row
+    :param state: The reducer state from fit_reduction
+    :param previous: The (reduced, keys) of the last run or None
+    :param out_path: If given, PCA components are written to a .npy memmap at this path
+    :return: The normalized reduction, the state is updated in place
+    """
+    name, components = parse_method(state['method'])
+    reducer = state['reducer']
+    if name == 'pca':
+        fitted = state.get('fitted', state['keys'])
+        new_rows = np.flatnonzero(~np.isin(keys, fitted))
+        if _partial_fit(reducer, embeddings, new_rows) > 0:
+            state['fitted'] = np.union1d(fitted, keys[new_rows])
+        return _scale(_transform(reducer, embeddings, out_path=out_path), state)
+
+    reduced = np.empty((len(keys), components), dtype=np.float32)
+    missing = np.ones(len(keys), dtype=bool)
+    if previous is not None and len(previous[1]) > 0:
+        previous_reduced, previous_keys = previous
+        order = np.argsort(previous_keys)
+        positions = np.minimum(np.searchsorted(previous_keys[order], keys), len(order) - 1)
+        found = previous_keys[order][positions] == keys
+        reduced[found] = previous_reduced[order[positions[found]]]
+        missing = ~found
+    rows = np.flatnonzero(missing)
+    if len(rows) > 0:
+        reduced[rows] = _scale(_transform(reducer, embeddings, rows), state)
+    return reduced
+
+
+def update_reduction(embeddings, keys, method, state_path, previous=None, refit_threshold=0.1, out_path=None, reducer_kwargs=None):
+    """
+    Reduce the embeddings, projecting into the saved layout while few rows are new and refitting otherwise
+    :param embeddings: The embedding matrix
+    :param keys: The chunk key of each row, None forces a refit
+    :param method: The reduction method, such as umap2
+    :param state_path: Where the fitted reducer is saved
+    :param previous: The (reduced, keys) of the last run or None
+    :param refit_threshold: The fraction of rows outside the last full fit that triggers a refit, the same for every
+    method: rows PCA was later updated with still count, as they were never part of the layout's own fit
+    :param out_path: If given, PCA components are written to a .npy memmap at this path
+    :param reducer_kwargs: Extra arguments for the reducer constructor when it is refit
+    :return: The normalized reduction
+    """
+    name, _ = parse_method(method)
+    if keys is not None and name in TRANSFORM_METHODS and exists(state_path):
+        state = load_pickle(state_path)
+        if state['method'] == method and state['keys'] is not None:
+            drift = np.mean(~np.isin(keys, state['keys'])) if len(keys) > 0 else 0.0
+            if drift <= refit_threshold:
+                print(f'{method}: projecting {drift:.1%} unseen rows into the saved layout')
+                reduced = project_reduction(embeddings, keys, state, previous, out_path)
+                save_pickle(state, state_path)
+                return reduced
+            print(f'{method}: {drift:.1%} of rows are unseen, refitting')
+    reduced, state = fit_reduction(embeddings, method, keys, out_path, reducer_kwargs)
+    if name in TRANSFORM_METHODS:
+        save_pickle(state, state_path)
+    return reduced
+
+
+def run_reduction(combined_path, method, output_folder, refit_threshold=0.1, threads=None):
+    """
+    Build the {method}_embeddings store. Meant to run in a worker process: the combined matrix is reopened
+    from its memmapped shards so it is shared through the page cache instead of being pickled
+    :param combined_path: The json index of the ShardedEmbeddings
+    :param method: The reduction method, such as umap2
+    :param output_folder: Where the store and the fitted reducer are saved
+    :param threads: The number of threads the reducer may use, None leaves the libraries' defaults
+    :return: The path of the store
+    """
+    embeddings = ShardedEmbeddings.load(combined_path)
+    keys = embeddings.keys
+    reduction_path = join(output_folder, f'{method}_embeddings')
+    previous = None
+    if store_exists(reduction_path) and load_keys(reduction_path) is not None:
+        previous = load_store(reduction_path, mmap_mode=None)[0], load_keys(reduction_path)
+    makedirs(reduction_path, exist_ok=True)
+    # PCA streams its components into the store's matrix in place, an interrupted run must not leave a loadable store
+    invalidate_store(reduction_path)
+    name, _ = parse_method(method)
+    reducer_kwargs = {'n_jobs': threads} if threads is not None and name != 'pca' else None
+    with threadpool_limits(limits=threads):
+        reduced = update_reduction(embeddings, keys, method, join(output_folder, f'{method}_reducer.pkl'),
+                                   previous, refit_threshold, embeddings_path(reduction_path), reducer_kwargs)
+    save_store(reduction_path, reduced, embeddings.filenames, keys=keys, method=method)
+    return reduction_path
@@ -0,0 +1,305 @@
+import json
+from os import makedirs, remove, replace
+from os.path import abspath, exists, join
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+from src.dataset import read_rows, store_dataset_path
+from src.embedding_store import ShardedEmbeddings, load_spans
+
+INDEX_VERSION = 1
+
+
+def normalize_rows(vectors):
+    """
+    Scale rows to unit length so dot products are cosine similarities
+    :return: A new float32 array
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _top_k(scores, k):
+    """
+    Indices of the k largest scores, best first
+    """
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate cosine search.
+    Rows are clustered around n_lists centroids, a query only scans the rows of its n_probe closest lists.
+    New rows are kept in a pending segment that is searched exhaustively until compact merges it into the lists
+    """
+
+    def __init__(self, n_lists=None, n_probe=8):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self._centroids = None
+        self._vectors = None
+        self._ids = None
+        self._offsets = None
+        self._pending_vectors = []
+        self._pending_ids = []
+
+    def __len__(self):
+        indexed = 0 if self._ids is None else len(self._ids)
+        return indexed + sum(len(ids) for ids in self._pending_ids)
+
+    def _assign(self, vectors):
+        return np.argmax(vectors @ self._centroids.T, axis=1)
+
+    def build(self, embeddings, ids=None, sample_size=100000, block_size=16384, seed=0, vectors_path=None):
+        """
+        Train the centroids on a sample of the rows and fill the inverted lists.
+        Rows are normalized and assigned one block at a time and scattered straight into their list,
+        only the centroid sample and one block are ever held in memory besides the list vectors themselves
+        :param embeddings: An array, memmap or ShardedEmbeddings
+        :param ids: The id of each row, defaults to the row index
+        :param sample_size: The number of rows the centroids are trained on
+        :param block_size: Rows read at a time
+        :param vectors_path: If given, the list vectors are written to a .npy memmap at this path
+        """
+        count = len(embeddings)
+        ids = np.arange(count, dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+        if self.n_lists is None:
+            self.n_lists = int(np.clip(np.sqrt(count), 1, 65536))
+        sample = np.sort(np.random.default_rng(seed).choice(count, min(count, max(sample_size, self.n_lists)), replace=False))
+        kmeans = MiniBatchKMeans(n_clusters=self.n_lists, batch_size=4096, n_init=1, random_state=seed)
+        kmeans.fit(normalize_rows(embeddings[sample]))
+        self._centroids = normalize_rows(kmeans.cluster_centers_)
+
+        assignments = np.empty(count, dtype=np.int64)
+        for start in range(0, count, block_size):
+            assignments[start:start + block_size] = self._assign(normalize_rows(embeddings[start:start + block_size]))
+        order = np.argsort(assignments, kind='stable')
+        # The position of every row inside the lists
+        positions = np.empty(count, dtype=np.int64)
+        positions[order] = np.arange(count)
+        shape = (count, embeddings.shape[1])
+        if vectors_path is not None:
+            self._vectors = np.lib.format.open_memmap(vectors_path, mode='w+', dtype=np.float32, shape=shape)
+        else:
+            self._vectors = np.empty(shape, dtype=np.float32)
+        for start in range(0, count, block_size):
+            self._vectors[positions[start:start + block_size]] = normalize_rows(embeddings[start:start + block_size])
+        self._ids = ids[order]
+        self._offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=self.n_lists))])
+        self._pending_vectors = []
+        self._pending_ids = []
+        return self
+
+    def add(self, vectors, ids):
+        """
+        Insert rows without retraining, they are searched exhaustively until the next compact
+        :param vectors: The new embeddings
+        :param ids: Their ids
+        """
+        self._pending_vectors.append(normalize_rows(vectors))
+        self._pending_ids.append(np.asarray(ids, dtype=np.int64))
+
+    def compact(self):
+        """
+        Merge pending rows into the inverted lists
+        """
+        if len(self._pending_ids) == 0:
+            return
+        vectors = np.concatenate([np.asarray(self._vectors)] + self._pending_vectors)
+        ids = np.concatenate([self._ids] + self._pending_ids)
+        assignments = np.concatenate([np.repeat(np.arange(self.n_lists), np.diff(self._offsets)),
+                                      self._assign(np.concatenate(self._pending_vectors))])
+        order = np.argsort(assignments, kind='stable')
+        self._vectors = vectors[order]
+        self._ids = ids[order]
+        self._offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=self.n_lists))])
+        self._pending_vectors = []
+        self._pending_ids = []
+
+    def query(self, vector, k=10, n_probe=None):
+        """
+        Approximate nearest neighbours of one vector
+        :param vector: The query embedding
+        :param k: The number of results
+        :param n_probe: The number of lists to scan, more is slower and more accurate
+        :return: The ids and cosine similarities of the results, best first
+        """
+        query = normalize_rows(vector).reshape(-1)
+        n_probe = min(self.n_probe if n_probe is None else n_probe, self.n_lists)
+        lists = _top_k(self._centroids @ query, n_probe)
+        rows = np.concatenate([np.arange(self._offsets[ix], self._offsets[ix + 1]) for ix in lists])
+        candidates = [self._ids[rows]]
+        scores = [self._vectors[rows] @ query]
+        for pending_vectors, pending_ids in zip(self._pending_vectors, self._pending_ids):
+            candidates.append(pending_ids)
+            scores.append(pending_vectors @ query)
+        candidates = np.concatenate(candidates)
+        scores = np.concatenate(scores)
+        best = _top_k(scores, k)
+        return candidates[best], scores[best]
+
+    def save(self, path):
+        """
+        Save the index as a directory of .npy files, pending rows are merged first.
+        The header is removed before any file is rewritten and written again last
+        """
+        self.compact()
+        makedirs(path, exist_ok=True)
+        invalidate_index(path)
+        np.save(join(path, 'centroids.npy'), self._centroids)
+        vectors_path = join(path, 'vectors.npy')
+        # Vectors built into a memmap at the path are already in place
+        if isinstance(self._vectors, np.memmap) and abspath(self._vectors.filename) == abspath(vectors_path):
+            self._vectors.flush()
+        else:
+            np.save(vectors_path, self._vectors)
+        np.save(join(path, 'ids.npy'), self._ids)
+        np.save(join(path, 'offsets.npy'), self._offsets)
+        # Written last, an index without a header was interrupted
+        with open(join(path, 'header.json') + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'version': INDEX_VERSION, 'n_lists': self.n_lists, 'n_probe': self.n_probe,
+                       'count': len(self._ids), 'dim': int(self._centroids.shape[1])}, f, indent=2)
+        replace(join(path, 'header.json') + '.tmp', join(path, 'header.json'))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        Open a saved index, the vectors stay memory-mapped
+        """
+        with open(join(path, 'header.json'), 'r', encoding='utf-8') as f:
+            header = json.load(f)
+        index = cls(header['n_lists'], header['n_probe'])
+        index._centroids = np.load(join(path, 'centroids.npy'))
+        index._vectors = np.load(join(path, 'vectors.npy'), mmap_mode=mmap_mode)
+        index._ids = np.load(join(path, 'ids.npy'))
+        index._offsets = np.load(join(path, 'offsets.npy'))
+        return index
+
+
+def update_index(embeddings, index_path, n_lists=None, n_probe=8):
+    """
+    Build the index of the combined embeddings or, if only rows were appended since it was saved, insert them
+    :param embeddings: The combined ShardedEmbeddings
+    :param index_path: The index directory
+    :return: The up to date index
+    """
+    keys = embeddings.keys
+    keys_path = join(index_path, 'row_keys.npy')
+    if keys is not None and exists(join(index_path, 'header.json')) and exists(keys_path):
+        index = IVFIndex.load(index_path, mmap_mode=None)
+        indexed_keys = np.load(keys_path)
+        if len(indexed_keys) <= len(keys) and np.array_equal(indexed_keys, keys[:len(indexed_keys)]):
+            if len(indexed_keys) < len(keys):
+                print(f'Adding {len(keys) - len(indexed_keys)} rows to the index')
+                index.add(embeddings[len(indexed_keys):], np.arange(len(indexed_keys), len(keys)))
+                # The keys go in before the header that makes the index valid again
+                invalidate_index(index_path)
+                np.save(keys_path, keys)
+                index.save(index_path)
+            return index
+    print(f'Building index over {len(embeddings)} rows')
+    makedirs(index_path, exist_ok=True)
+    invalidate_index(index_path)
+    if exists(keys_path):
+        remove(keys_path)
+    index = IVFIndex(n_lists, n_probe).build(embeddings, vectors_path=join(index_path, 'vectors.npy'))
+    if keys is not None:
+        np.save(keys_path, keys)
+    index.save(index_path)
+    return index
+
+
+def invalidate_index(index_path):
+    """
+    Remove the header of a saved index before any of its files are rewritten, so an interrupted save
+    is never loaded as a complete index
+    """
+    header_path = join(index_path, 'header.json')
+    if exists(header_path):
+        remove(header_path)
+
+
+def index_matches(embeddings, index_path):
+    """
+    :param embeddings: The combined ShardedEmbeddings
+    :param index_path: The index directory
+    :return: True if the saved index was built over exactly these rows
+    """
+    header_path = join(index_path, 'header.json')
+    if not exists(header_path):
+        return False
+    keys = embeddings.keys
+    keys_path = join(index_path, 'row_keys.npy')
+    if keys is None or not exists(keys_path):
+        # Without chunk keys only the row count can be compared
+        with open(header_path, 'r', encoding='utf-8') as f:
+            return json.load(f)['count'] == len(embeddings)
+    return np.array_equal(np.load(keys_path), keys)
+
+
+class ChunkSearch:
+    """
+    Query API over the combined embeddings, results are mapped back to their filename and chunk
+    """
+
+    def __init__(self, output_folder, embed=None, index_name='ann_index', update=False):
+        """
+        :param output_folder: The pipeline output folder
+        :param embed: A callable embedding a list of texts, needed to query by text
+        :param update: Bring an index built over other rows up to date instead of raising ValueError
+        """
+        self._output_folder = output_folder
+        self._embeddings = ShardedEmbeddings.load(join(output_folder, 'combined_embeddings.json'))
+        self._filenames = self._embeddings.filenames
+        index_path = join(output_folder, index_name)
+        # Result ids are rows of the combined matrix, an index over other rows would map them to the wrong chunks
+        if not index_matches(self._embeddings, index_path):
+            if not update:
+                raise ValueError(f"{index_path} does not match the combined embeddings, rebuild it with python -m src.search build")
+            update_index(self._embeddings, index_path)
+        self._index = IVFIndex.load(index_path)
+        self._embed = embed
+
+    def chunk_text(self, row):
+        """
+        Read the text of a chunk back from its dataset, only the row group holding it is decoded
+        :param row: A row of the combined matrix
+        :return: The chunk text or None if the dataset or spans are missing
+        """
+        store_path, local_row = self._embeddings.locate(row)
+        spans = load_spans(store_path)
+        data_path = store_dataset_path(store_path)
+        if spans is None or not exists(data_path):
+            return None
+        data_row, start, end = spans[local_row]
+        return read_rows(data_path, [data_row], ['text'])['text'].iloc[0][start:end]
+
+    def query(self, text_or_vector, k=10, n_probe=None):
+        """
+        Find the chunks closest to a text or an embedding
+        :param text_or_vector: The query text or embedding
+        :param k: The number of results
+        :return: A list of dicts with the row, filename and cosine score of each result
+        """
+        if isinstance(text_or_vector, str):
+            if self._embed is None:
+                raise ValueError("An embed function is needed to query by text")
+            text_or_vector = self._embed([text_or_vector])[0]
+        ids, scores = self._index.query(text_or_vector, k, n_probe)
+        return [{
+            'row': int(row),
+            'filename': str(self._filenames[row]),
+            'score': float(score),
+        } for row, score in zip(ids, scores)]
+
+    def query_row(self, row, k=10, n_probe=None):
+        """
+        Find the chunks related to an existing chunk, the chunk itself is excluded
+        """
+        return [result for result in self.query(self._embeddings[row], k + 1, n_probe) if result['row'] != row][:k]
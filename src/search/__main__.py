@@ -0,0 +1,76 @@
+"""
+Find related notes from the command line, run from the project root after the pipeline:
+    python -m src.search build
+    python -m src.search query "text to search for" -k 10
+    python -m src.search related 42
+"""
+from argparse import ArgumentParser
+from configparser import ConfigParser, NoOptionError
+from os.path import exists, join
+
+from src.data_extract.cohere_api import make_client
+from src.embedding_store import ShardedEmbeddings
+from src.search import ChunkSearch, update_index
+
+
+def main():
+    parser = ArgumentParser(prog='python -m src.search')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='Build or update the index of the combined embeddings')
+    build.add_argument('--lists', type=int, default=None, help='Number of inverted lists, defaults to sqrt(rows)')
+    build.add_argument('--probe', type=int, default=8, help='Default number of lists scanned per query')
+    query = commands.add_parser('query', help='Find the chunks closest to a text')
+    query.add_argument('text')
+    related = commands.add_parser('related', help='Find the chunks closest to an existing chunk')
+    related.add_argument('row', type=int)
+    for command in (query, related):
+        command.add_argument('-k', type=int, default=10)
+        command.add_argument('--probe', type=int, default=None)
+        command.add_argument('--text', action='store_true', dest='show_text', help='Print the text of each chunk')
+        command.add_argument('--update', action='store_true', help='Update the index first if the embeddings changed')
+    args = parser.parse_args()
+
+    if not exists('config.ini'):
+        print('Please run this from the root directory of the project, next to config.ini')
+        exit(1)
+    config = ConfigParser()
+    config.read('config.ini')
+    try:
+        output_folder = config.get('data', 'output_folder')
+    except NoOptionError:
+        print('Specify output_folder in config.ini under [data] header')
+        exit(1)
+
+    if args.command == 'build':
+        embeddings = ShardedEmbeddings.load(join(output_folder, 'combined_embeddings.json'))
+        update_index(embeddings, join(output_folder, 'ann_index'), args.lists, args.probe)
+        return
+
+    embed = None
+    if args.command == 'query':
+        try:
+            api_key = config.get('cohere', 'api_key')
+        except NoOptionError:
+            print('Please paste your API key in config.ini under a [cohere] header.')
+            exit(1)
+        co = make_client(api_key, config.get('cohere', 'api_url', fallback=None))
+        model = config.get('cohere', 'model', fallback='large')
+        embed = lambda texts: co.embed(texts=texts, model=model, truncate='END').embeddings
+
+    try:
+        search = ChunkSearch(output_folder, embed, update=args.update)
+    except ValueError as e:
+        print(e)
+        exit(1)
+    if args.command == 'query':
+        results = search.query(args.text, args.k, args.probe)
+    else:
+        results = search.query_row(args.row, args.k, args.probe)
+    for result in results:
+        print(f"{result['score']:.4f}  {result['row']:>8}  {result['filename']}")
+        if args.show_text:
+            print('    ' + (search.chunk_text(result['row']) or '').replace('\n', ' ')[:200])
+
+
+if __name__ == '__main__':
+    main()
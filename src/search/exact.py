@@ -0,0 +1,109 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from src.search import normalize_rows
+
+
+class ExactIndex:
+    """
+    Exact cosine or dot product search over an embedding matrix.
+    Rows are normalized once, queries are scored in batches against blocks of rows so memory stays
+    bounded by query_batch x block_size, and the top k of each block is kept with argpartition
+    """
+
+    def __init__(self, embeddings, metric='cosine', block_size=16384, normalized_path=None):
+        """
+        :param embeddings: An array, float32/float16 memmap or ShardedEmbeddings
+        :param metric: 'cosine' or 'dot'
+        :param block_size: Rows scored at a time
+        :param normalized_path: If given, the normalized rows are written to a .npy memmap at this path
+        """
+        if metric not in ('cosine', 'dot'):
+            raise ValueError(f"Unknown metric {metric}")
+        self.metric = metric
+        self.block_size = block_size
+        if metric == 'dot':
+            self._rows = embeddings
+            return
+        shape = (len(embeddings), embeddings.shape[1])
+        if normalized_path is not None:
+            self._rows = np.lib.format.open_memmap(normalized_path, mode='w+', dtype=np.float32, shape=shape)
+        else:
+            self._rows = np.empty(shape, dtype=np.float32)
+        for start in range(0, shape[0], block_size):
+            self._rows[start:start + block_size] = normalize_rows(embeddings[start:start + block_size])
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _prepare(self, queries):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        return normalize_rows(queries) if self.metric == 'cosine' else queries
+
+    def search(self, queries, k=10, query_batch=256, exclude=None):
+        """
+        Exact top k rows for every query
+        :param queries: One query vector or a (queries, dim) matrix
+        :param k: The number of results per query
+        :param query_batch: Queries scored at a time
+        :param exclude: Optional row index per query to leave out of its results, used for self matches
+        :return: (ids, scores) arrays of shape (queries, k), best first, padded with -1 and -inf past the row count
+        """
+        queries = self._prepare(queries)
+        count = len(queries)
+        ids = np.full((count, k), -1, dtype=np.int64)
+        scores = np.full((count, k), -np.inf, dtype=np.float32)
+        for query_start in range(0, count, query_batch):
+            batch = queries[query_start:query_start + query_batch]
+            best_ids = ids[query_start:query_start + query_batch]
+            best_scores = scores[query_start:query_start + query_batch]
+            for start in range(0, len(self._rows), self.block_size):
+                block = np.asarray(self._rows[start:start + self.block_size], dtype=np.float32)
+                block_scores = batch @ block.T
+                if exclude is not None:
+                    excluded = np.asarray(exclude[query_start:query_start + query_batch]) - start
+                    inside = np.flatnonzero((excluded >= 0) & (excluded < len(block)))
+                    block_scores[inside, excluded[inside]] = -np.inf
+                # Reduce the block to its own top k before merging with the running best
+                if block_scores.shape[1] > k:
+                    block_top = np.argpartition(-block_scores, k - 1, axis=1)[:, :k]
+                    block_scores = np.take_along_axis(block_scores, block_top, axis=1)
+                else:
+                    block_top = np.broadcast_to(np.arange(block_scores.shape[1]), block_scores.shape)
+                merged_scores = np.concatenate([best_scores, block_scores], axis=1)
+                merged_ids = np.concatenate([best_ids, block_top + start], axis=1)
+                top = np.argpartition(-merged_scores, k - 1, axis=1)[:, :k]
+                best_scores[:] = np.take_along_axis(merged_scores, top, axis=1)
+                best_ids[:] = np.take_along_axis(merged_ids, top, axis=1)
+        order = np.argsort(-scores, axis=1, kind='stable')
+        ids, scores = np.take_along_axis(ids, order, axis=1), np.take_along_axis(scores, order, axis=1)
+        # With k at least the row count an excluded row is still picked, with its -inf score
+        ids[scores == -np.inf] = -1
+        return ids, scores
+
+    def knn_graph(self, k=10, query_batch=256):
+        """
+        The k nearest neighbours of every row, excluding the row itself
+        :return: (ids, scores) arrays of shape (rows, k), padded with -1 and -inf when k is not below the row count
+        """
+        ids = np.empty((len(self._rows), k), dtype=np.int64)
+        scores = np.empty((len(self._rows), k), dtype=np.float32)
+        for start in range(0, len(self._rows), self.block_size):
+            block = self._rows[start:start + self.block_size]
+            rows = np.arange(start, start + len(block))
+            ids[rows], scores[rows] = self.search(block, k, query_batch, exclude=rows)
+        return ids, scores
+
+
+def knn_to_csr(ids, scores, symmetric=True):
+    """
+    Turn a kNN graph into a sparse adjacency matrix, for example as clustering connectivity
+    :param ids: The (rows, k) neighbour ids from knn_graph, -1 for no neighbour
+    :param scores: The matching similarities, non finite scores are not edges
+    :param symmetric: Add the transpose so every edge goes both ways
+    :return: A (rows, rows) csr_matrix
+    """
+    count, k = ids.shape
+    valid = (ids >= 0) & np.isfinite(scores)
+    graph = csr_matrix((scores[valid], (np.repeat(np.arange(count), k)[valid.ravel()], ids[valid])), shape=(count, count))
+    return graph.maximum(graph.T) if symmetric else graph
@@ -0,0 +1,47 @@
+import sqlite3
+
+
+class SqliteCache:
+    """
+    Base of the persistent caches: one sqlite table keyed by a text primary key.
+    Lookups bind at most _QUERY_SIZE keys per query to stay under sqlite's limit on bound parameters
+    """
+    _QUERY_SIZE = 500
+
+    def __init__(self, path, table, columns):
+        """
+        :param path: The sqlite file
+        :param table: The table name
+        :param columns: The column definitions after the key, such as 'label TEXT NOT NULL'
+        """
+        self._table = table
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, {columns})')
+        self._conn.commit()
+
+    def __len__(self):
+        return self._conn.execute(f'SELECT COUNT(*) FROM {self._table}').fetchone()[0]
+
+    def _select_many(self, keys, columns):
+        """
+        Look up keys in batches of _QUERY_SIZE, duplicate keys are queried once
+        :param keys: An iterable of keys
+        :param columns: The columns selected after the key
+        :return: A generator of (the keys of a batch, the rows found for them)
+        """
+        keys = list(dict.fromkeys(keys))
+        for ix in range(0, len(keys), self._QUERY_SIZE):
+            query_keys = keys[ix:ix + self._QUERY_SIZE]
+            rows = self._conn.execute(f'SELECT key, {", ".join(columns)} FROM {self._table} '
+                                      f'WHERE key IN ({placeholders(query_keys)})', query_keys).fetchall()
+            yield query_keys, rows
+
+    def close(self):
+        self._conn.close()
+
+
+def placeholders(keys):
+    """
+    :return: The '?,?,..' parameter list of an IN clause over keys
+    """
+    return ','.join('?' * len(keys))
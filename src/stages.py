@@ -0,0 +1,121 @@
+import json
+from hashlib import sha1
+from os.path import exists, join
+
+
+def fingerprint(*parts):
+    """
+    Stable hash of json serializable parts
+    :return: A hex digest
+    """
+    return sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class StageRunner:
+    """
+    Tracks the artifacts of the pipeline as a small DAG of stages.
+    Each stage's fingerprint covers its parameters and the fingerprints of the stages it reads, the fingerprint
+    behind every artifact is recorded in stages.json so a stage is only recomputed when something upstream changed
+    """
+
+    def __init__(self, output_folder):
+        self._path = join(output_folder, 'stages.json')
+        self._recorded = {}
+        if exists(self._path):
+            with open(self._path, 'r', encoding='utf-8') as f:
+                self._recorded = json.load(f)
+        self._current = {}
+
+    def fingerprint(self, name):
+        """
+        :param name: A stage evaluated in this run
+        :return: Its fingerprint
+        """
+        if name not in self._current:
+            raise ValueError(f"Stage {name} has not been evaluated")
+        return self._current[name]
+
+    def _fingerprint(self, name, params, inputs):
+        return fingerprint(name, params, [self.fingerprint(stage) for stage in inputs])
+
+    def _save(self):
+        with open(self._path, 'w', encoding='utf-8') as f:
+            json.dump(self._recorded, f, indent=2, sort_keys=True)
+
+    def record(self, name, params, inputs=()):
+        """
+        Register a stage that keeps its own artifact up to date, so later stages can depend on it
+        :param name: The stage name
+        :param params: The parameters or content digest describing the artifact
+        :param inputs: The names of the stages it reads
+        :return: The stage fingerprint
+        """
+        self._current[name] = self._fingerprint(name, params, inputs)
+        if self._recorded.get(name) != self._current[name]:
+            self._recorded[name] = self._current[name]
+            self._save()
+        return self._current[name]
+
+    def run(self, name, build, load, artifact_exists, params=None, inputs=()):
+        """
+        Load a stage's artifact if it was built from the same parameters and inputs, otherwise rebuild it
+        :param name: The stage name
+        :param build: Builds and saves the artifact, returns the result
+        :param load: Loads the saved artifact
+        :param artifact_exists: Returns whether the artifact is on disk
+        :param params: The parameters of the stage
+        :param inputs: The names of the stages it reads
+        :return: The result of build or load
+        """
+        stage_fingerprint = self._fingerprint(name, params, inputs)
+        self._current[name] = stage_fingerprint
+        if self._recorded.get(name) == stage_fingerprint and artifact_exists():
+            print(f'{name} is up to date. Skipping.')
+            return load()
+        if name in self._recorded:
+            print(f'{name} is stale. Rebuilding.')
+        # Forget the old fingerprint first so an interrupted build is never mistaken for a fresh one
+        self._recorded.pop(name, None)
+        self._save()
+        result = build()
+        self._recorded[name] = stage_fingerprint
+        self._save()
+        return result
+
+    def run_many(self, stages, executor=None):
+        """
+        Like run for independent stages, the stale ones are built concurrently
+        :param stages: A list of (name, build, load, artifact_exists, params, inputs), with executor the builds must be picklable
+        :param executor: A concurrent.futures executor, stages are built one after another without one
+        :return: A dict of stage name -> the result of load
+        """
+        futures = {}
+        for name, build, load, artifact_exists, params, inputs in stages:
+            stage_fingerprint = self._fingerprint(name, params, inputs)
+            self._current[name] = stage_fingerprint
+            if self._recorded.get(name) == stage_fingerprint and artifact_exists():
+                print(f'{name} is up to date. Skipping.')
+                continue
+            if name in self._recorded:
+                print(f'{name} is stale. Rebuilding.')
+            self._recorded.pop(name, None)
+            self._save()
+            if executor is None:
+                build()
+                self._recorded[name] = stage_fingerprint
+                self._save()
+            else:
+                futures[name] = executor.submit(build)
+        # Record every stage that finished even if another one failed
+        error = None
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            self._recorded[name] = self._current[name]
+            self._save()
+        if error is not None:
+            raise error
+        return {name: load() for name, _, load, _, _, _ in stages}
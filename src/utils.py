@@ -9,6 +9,8 @@ from umap import UMAP
 from sklearn.decomposition import PCA
 from sklearn.manifold import TSNE
 
+from src.chunking import DEFAULT_CHUNK_SIZE, chunk_spans
+
 
 REDUCTION_METHODS = {
     'pca': PCA,
@@ -27,31 +29,29 @@ def load_pickle(file_path=join('output', 'tree.pkl')):
         return load(f)
 
 
-def save_npz(obj, file_path=join('output', 'embeddings.npz')):
-    np.savez(file_path, embeddings=obj[0], filenames=obj[1])
-
-
-def load_npz(file_path=join('output', 'embeddings.npz')):
-    data = np.load(file_path, allow_pickle=True)
-    return data['embeddings'], data['filenames']
-    # return pd.DataFrame(data['embeddings'], index=data['filenames'])
-
-
 def read_file(filename):
     with open(filename, 'r', encoding='utf-8') as f:
         return f.read()
 
 
-def normalize(embeddings):
-    return (embeddings - embeddings.min()) / (embeddings.max() - embeddings.min())
+def normalize(embeddings, copy=True):
+    minimum, maximum = embeddings.min(), embeddings.max()
+    if copy:
+        return (embeddings - minimum) / (maximum - minimum)
+    embeddings -= minimum
+    embeddings /= maximum - minimum
+    return embeddings
 
 
 def reduce_embeddings(embeddings, method):
+    # The reducers work in float32 or float64, anything else would be copied to float64
+    if embeddings.dtype not in (np.float32, np.float64):
+        embeddings = embeddings.astype(np.float32)
     for name, reducer in REDUCTION_METHODS.items():
         if method.startswith(name):
             components = int(method[len(name):])
             instance = reducer(n_components=components)
-            return normalize(instance.fit_transform(embeddings))
+            return normalize(instance.fit_transform(embeddings), copy=False)
     raise ValueError(f"Unknown reduction {method}")
 
 
@@ -79,41 +79,11 @@ def plot_dendrogram(linked, filenames, colors):
     plt.show()
 
 
-# Define a function to recursively traverse the tree and store information in the leaves
-def store_info_in_leaves(node, filenames, embeddings, umap2, pca5, tsne2):
-    if node.is_leaf():
-        node.data = {
-            'filename':  filenames[node.id],
-            'embedding': embeddings[node.id],
-            'umap2':     umap2[node.id],
-            'pca5':      pca5[node.id],
-            'tsne2':     tsne2[node.id]
-        }
-    else:
-        store_info_in_leaves(node.left, filenames, embeddings, umap2, pca5, tsne2)
-        store_info_in_leaves(node.right, filenames, embeddings, umap2, pca5, tsne2)
-
-
-def chunk_text(text, chunk_size=512):
+def chunk_text(text, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
     """
-    Splits text into tokens
+    Splits text into chunks, see chunk_spans for the options
     :param text: The raw text
-    :param chunk_size: The maximum number of tokens
+    :param chunk_size: The maximum number of words
     :return: The list of chunks
     """
-    tokens = text.split()
-    chunks = []
-    chunk = []
-
-    for token in tokens:
-        if len(chunk) + len(token) + 1 <= chunk_size:
-            chunk.append(token)
-        else:
-            chunks.append(' '.join(chunk))
-            chunk = [token]
-
-    if len(chunk) > 0:
-        chunks.append(' '.join(chunk))
-
-    return chunks
-
+    return [text[start:end] for start, end in chunk_spans(text, chunk_size, **kwargs)]
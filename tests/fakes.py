@@ -0,0 +1,18 @@
+"""
+Stand-ins for the Cohere client shared by the tests
+"""
+
+
+class _Response:
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+
+class FakeClient:
+    def __init__(self, dim=4):
+        self.dim = dim
+        self.texts = []
+
+    def embed(self, texts, model=None, truncate=None):
+        self.texts += texts
+        return _Response([[float(len(text))] * self.dim for text in texts])
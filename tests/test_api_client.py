@@ -0,0 +1,101 @@
+import json
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
+import httpx
+import pandas as pd
+import pytest
+from cohere.core.api_error import ApiError
+
+import src.data_extract.cohere_api as capi
+from src.api_client import RateLimitedClient, is_retryable
+
+
+class FlakyEmbed:
+    """
+    Raises the given errors in turn, then embeds every text as its length
+    """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, texts):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return [[len(text)] for text in texts]
+
+
+def make_client(embed, max_retries=5):
+    return RateLimitedClient(embed, rate_limit_calls=1000, rate_limit_duration=1, max_retries=max_retries, backoff=0.0)
+
+
+@pytest.mark.parametrize('error', [
+    httpx.ConnectError('refused'),
+    httpx.ReadTimeout('timed out'),
+    httpx.RemoteProtocolError('disconnected'),
+    ConnectionResetError(),
+    ApiError(status_code=429),
+    ApiError(status_code=503),
+])
+def test_transient_errors_are_retried(error):
+    embed = FlakyEmbed(error, error)
+    assert make_client(embed).call(['a', 'bb']) == [[1], [2]]
+    assert embed.calls == 3
+
+
+@pytest.mark.parametrize('error', [ValueError('bad input'), ApiError(status_code=400)])
+def test_other_errors_are_raised_at_once(error):
+    embed = FlakyEmbed(error)
+    with pytest.raises(type(error)):
+        make_client(embed).call(['a'])
+    assert embed.calls == 1
+    assert not is_retryable(error)
+
+
+def test_retries_are_bounded():
+    embed = FlakyEmbed(*[httpx.ConnectError('refused')] * 3)
+    with pytest.raises(httpx.ConnectError):
+        make_client(embed, max_retries=2).call(['a'])
+    assert embed.calls == 3
+
+
+def test_empty_batches_are_not_sent():
+    embed = FlakyEmbed(ValueError('sent'))
+    assert make_client(embed).call([]) == []
+    assert embed.calls == 0
+
+
+def test_call_batches_keeps_order():
+    client = RateLimitedClient(FlakyEmbed(), concurrency=3, rate_limit_calls=1000, rate_limit_duration=1)
+    batches = [['a' * ix] for ix in range(10)]
+    assert [vectors for _, vectors in client.call_batches(batches)] == [[[ix]] for ix in range(10)]
+
+
+class _EmbedServer(BaseHTTPRequestHandler):
+    def do_POST(self):
+        texts = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['texts']
+        body = json.dumps({'id': 'fake', 'response_type': 'embeddings_floats', 'texts': texts,
+                           'embeddings': [[float(len(text)), 1.0] for text in texts]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):
+        pass
+
+
+def test_api_url_points_the_client_at_another_server():
+    server = HTTPServer(('127.0.0.1', 0), _EmbedServer)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = capi.make_client('key', f'http://127.0.0.1:{server.server_port}')
+        dataframe = pd.DataFrame({'filename': ['a'], 'text': ['one two three']})
+        embeddings, filenames = capi.create_embeddings(dataframe, None, client=client)
+    finally:
+        server.shutdown()
+    assert embeddings.tolist() == [[13.0, 1.0]]
+    assert list(filenames) == ['a']
@@ -0,0 +1,37 @@
+import importlib
+import json
+import sys
+import tracemalloc
+
+import numpy as np
+
+from benchmarks import bench_pipeline
+
+
+def test_pipeline_benchmark_runs_every_stage(tmp_path, monkeypatch):
+    output = tmp_path / 'results.json'
+    monkeypatch.setattr(sys, 'argv', ['bench_pipeline', '--notes', '20', '--books', '1', '--chapters', '3', '--chapter-words', '300',
+                                      '--dim', '8', '--output', str(output)])
+    bench_pipeline.main()
+    with open(output, 'r', encoding='utf-8') as f:
+        stages = {stage['stage']: stage for stage in json.load(f)['stages']}
+    assert list(stages) == ['extract md', 'extract epub', 'dataset write', 'dataset merge', 'dataset scan',
+                            'chunking', 'embedding', 'embedding cached', 'reduction pca5']
+    assert stages['embedding']['chunks'] == stages['embedding cached']['chunks'] > 0
+    assert all(stage['peak_rss_megabytes'] > 0 for stage in stages.values())
+
+
+def test_peak_memory_without_proc_or_resource(monkeypatch):
+    # Windows has neither /proc nor the resource module
+    monkeypatch.setitem(sys.modules, 'resource', None)
+    module = importlib.reload(bench_pipeline)
+    try:
+        monkeypatch.setattr(module, 'system', 'win32')
+        with module.PeakMemory() as memory:
+            block = np.ones(1 << 20)
+            del block
+        assert memory.peak >= 8 << 20
+        assert not tracemalloc.is_tracing()
+    finally:
+        monkeypatch.delitem(sys.modules, 'resource')
+        importlib.reload(bench_pipeline)
@@ -0,0 +1,73 @@
+import re
+
+import pytest
+
+from src.chunking import DEFAULT_CHUNK_SIZE, chunk_spans, token_spans
+
+
+def words(count):
+    return ' '.join(f'w{ix}' for ix in range(count))
+
+
+def test_word_spans_match_regex():
+    text = ' one\ttwo　three\n\nfour  '
+    starts, ends = token_spans(text)
+    assert list(zip(starts, ends)) == [match.span() for match in re.finditer(r'\S+', text)]
+
+
+def test_words_are_split_into_budgets():
+    text = words(25)
+    spans = chunk_spans(text, 10)
+    assert [len(text[start:end].split()) for start, end in spans] == [10, 10, 5]
+    assert ' '.join(text[start:end] for start, end in spans) == text
+
+
+def test_default_budget_is_in_words():
+    spans = chunk_spans(words(DEFAULT_CHUNK_SIZE + 1))
+    assert len(spans) == 2
+    assert DEFAULT_CHUNK_SIZE < 512
+
+
+def test_overlap_repeats_words():
+    text = words(20)
+    chunks = [text[start:end].split() for start, end in chunk_spans(text, 8, overlap=3)]
+    for previous, following in zip(chunks, chunks[1:]):
+        assert previous[-3:] == following[:3]
+    assert chunks[-1][-1] == 'w19'
+
+
+def test_chars_never_exceed_budget():
+    text = words(200)
+    for start, end in chunk_spans(text, 50, unit='chars'):
+        assert end - start <= 50
+
+
+def test_sentence_boundary_is_preferred():
+    text = 'one two three. four five six seven eight nine'
+    start, end = chunk_spans(text, 5, boundary='sentence')[0]
+    assert text[start:end] == 'one two three.'
+
+
+def test_tokens_follow_the_tokenizer():
+    # Two tokens per word, so a budget of 6 tokens holds three words
+    def tokenizer(text):
+        for match in re.finditer(r'\S+', text):
+            middle = (match.start() + match.end()) // 2
+            yield match.start(), middle
+            yield middle, match.end()
+
+    text = words(9)
+    spans = chunk_spans(text, 6, unit='tokens', tokenizer=tokenizer)
+    assert [len(text[start:end].split()) for start, end in spans] == [3, 3, 3]
+
+
+def test_tokens_need_a_tokenizer():
+    with pytest.raises(ValueError):
+        chunk_spans('text', unit='tokens')
+    with pytest.raises(ValueError):
+        chunk_spans('text', 4, overlap=4)
+
+
+def test_empty_text_has_no_chunks():
+    assert chunk_spans('') == []
+    assert chunk_spans(' \n ') == []
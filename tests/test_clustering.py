@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from scipy.cluster.hierarchy import fcluster, is_monotonic, is_valid_linkage, leaves_list, linkage
+from sklearn.metrics import adjusted_rand_score
+
+from src.clustering import hierarchical_linkage
+
+
+def make_blobs(rows, dim=8, clusters=4, seed=0):
+    random = np.random.default_rng(seed)
+    centers = 20 * random.normal(size=(clusters, dim))
+    labels = random.integers(clusters, size=rows)
+    return (centers[labels] + random.normal(size=(rows, dim))).astype(np.float32), labels
+
+
+def check(linked, rows):
+    assert linked.shape == (rows - 1, 4)
+    assert is_valid_linkage(linked)
+    assert is_monotonic(linked)
+    assert linked[-1, 3] == rows
+    assert sorted(leaves_list(linked)) == list(range(rows))
+
+
+def test_small_input_is_exact_ward():
+    embeddings, _ = make_blobs(50)
+    np.testing.assert_allclose(hierarchical_linkage(embeddings, leaf_size=100), linkage(embeddings.astype(np.float64), 'ward'))
+
+
+def test_large_input_is_valid_and_recovers_clusters():
+    embeddings, labels = make_blobs(3000)
+    linked = hierarchical_linkage(embeddings, leaf_size=200, block_size=700)
+    check(linked, 3000)
+    assert adjusted_rand_score(labels, fcluster(linked, 4, 'maxclust')) > 0.99
+
+
+def test_sample_is_capped_by_bytes():
+    embeddings, labels = make_blobs(3000)
+    # Room for 100 rows of 8 float32, fewer than the micro clusters, which k-means needs at least
+    linked = hierarchical_linkage(embeddings, leaf_size=200, sample_bytes=3200)
+    check(linked, 3000)
+    assert adjusted_rand_score(labels, fcluster(linked, 4, 'maxclust')) > 0.99
+
+
+def test_duplicates_are_split_by_index():
+    check(hierarchical_linkage(np.ones((500, 4), dtype=np.float32), leaf_size=100), 500)
+
+
+def test_tiny_inputs():
+    assert hierarchical_linkage(np.zeros((1, 3))).shape == (0, 4)
+    check(hierarchical_linkage(np.arange(6, dtype=np.float32).reshape(3, 2)), 3)
+
+
+def test_leaf_size_below_two_is_rejected():
+    with pytest.raises(ValueError, match='leaf_size'):
+        hierarchical_linkage(np.zeros((10, 3)), leaf_size=1)
+
+
+@pytest.mark.parametrize('leaf_size', [2, 3])
+def test_smallest_leaf_sizes(leaf_size):
+    embeddings, _ = make_blobs(60)
+    check(hierarchical_linkage(embeddings, leaf_size=leaf_size), 60)
+    check(hierarchical_linkage(np.ones((20, 4), dtype=np.float32), leaf_size=leaf_size), 20)
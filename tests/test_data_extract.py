@@ -0,0 +1,115 @@
+import os
+
+import pandas as pd
+import pytest
+
+from src.data_extract import DataExtract
+from src.data_extract.scanner import DirectoryCache, file_extension, scan_files
+from src.data_extract.utils import get_extractor_struct_for_extension
+
+
+def make_notes(path, count):
+    for ix in range(count):
+        folder = path / f'folder{ix % 3}'
+        folder.mkdir(exist_ok=True)
+        (folder / f'note{ix}.md').write_text(f'# Note {ix}\n\nLinks to [[note{ix + 1}]]\n', encoding='utf-8')
+
+
+def test_process_pool_matches_serial_extraction(tmp_path):
+    make_notes(tmp_path, 12)
+    extractor = DataExtract()
+    extractor.set_valid_extensions(['md'])
+    struct = {'filepath': DataExtract.get_filepath, **get_extractor_struct_for_extension('md')}
+    serial = extractor.extract_data(str(tmp_path), struct)
+    pooled = extractor.extract_data(str(tmp_path), struct, workers=2)
+    assert len(serial) == 12
+    # Rows keep the order of the listed files whatever order the workers finish in
+    pd.testing.assert_frame_equal(serial, pooled)
+    assert set(serial['filename']) == {f'note{ix}' for ix in range(12)}
+
+
+def make_tree(path):
+    """
+    :return: The set of files written, nested a few folders deep
+    """
+    files = set()
+    for ix in range(40):
+        folder = path.joinpath(*[f'd{(ix >> depth) % 3}' for depth in range(ix % 4)])
+        folder.mkdir(parents=True, exist_ok=True)
+        filepath = folder / f'file{ix}.{"md" if ix % 2 else "txt"}'
+        filepath.write_text(str(ix), encoding='utf-8')
+        files.add(str(filepath))
+    return files
+
+
+def test_threaded_scan_matches_serial_scan(tmp_path):
+    files = make_tree(tmp_path)
+    serial = list(scan_files(str(tmp_path), cache=None))
+    assert set(serial) == files and len(serial) == len(files)
+    threaded = list(scan_files(str(tmp_path), workers=4, cache=None))
+    assert sorted(threaded) == sorted(serial)
+    assert sorted(scan_files(str(tmp_path), ['md'], workers=4, cache=None)) == sorted(path for path in files if path.endswith('.md'))
+
+
+def test_changed_directories_are_listed_again(tmp_path):
+    folder = tmp_path / 'notes'
+    folder.mkdir()
+    (folder / 'a.md').write_text('a', encoding='utf-8')
+    cache = DirectoryCache()
+    assert list(scan_files(str(tmp_path), cache=cache)) == [str(folder / 'a.md')]
+    assert len(cache) == 2
+
+    # An unchanged directory is served from the cache without being listed
+    mtime = os.stat(folder).st_mtime_ns
+    cache.put(str(folder), mtime, [str(folder / 'cached.md')], [])
+    assert list(scan_files(str(tmp_path), cache=cache)) == [str(folder / 'cached.md')]
+
+    (folder / 'b.md').write_text('b', encoding='utf-8')
+    # Some filesystems keep coarse mtimes, make sure the directory's moved
+    os.utime(folder, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+    assert sorted(scan_files(str(tmp_path), cache=cache)) == [str(folder / 'a.md'), str(folder / 'b.md')]
+
+
+def test_names_without_an_extension(tmp_path):
+    for name in ('README', 'notes.md', 'archive.tar.gz', '.hidden'):
+        (tmp_path / name).write_text(name, encoding='utf-8')
+    (tmp_path / 'folder.d').mkdir()
+    (tmp_path / 'folder.d' / 'LICENSE').write_text('', encoding='utf-8')
+    assert [file_extension(name) for name in ('README', 'notes.md', 'archive.tar.gz', '.hidden', 'folder.d/LICENSE')] == \
+        ['', 'md', 'gz', 'hidden', '']
+    assert sorted(os.path.basename(path) for path in scan_files(str(tmp_path), cache=None)) == \
+        ['.hidden', 'LICENSE', 'README', 'archive.tar.gz', 'notes.md']
+    assert sorted(os.path.basename(path) for path in scan_files(str(tmp_path), ['md', 'gz'], cache=None)) == \
+        ['archive.tar.gz', 'notes.md']
+    # The empty extension selects exactly the files without one
+    assert sorted(os.path.basename(path) for path in scan_files(str(tmp_path), [''], cache=None)) == ['LICENSE', 'README']
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_symlink_loops_are_walked_once(tmp_path, workers):
+    (tmp_path / 'a' / 'b').mkdir(parents=True)
+    (tmp_path / 'a' / 'b' / 'note.md').write_text('note', encoding='utf-8')
+    try:
+        os.symlink(tmp_path / 'a', tmp_path / 'a' / 'b' / 'loop', target_is_directory=True)
+        os.symlink(tmp_path, tmp_path / 'a' / 'root', target_is_directory=True)
+    except (OSError, NotImplementedError):
+        pytest.skip('symlinks are not available')
+    assert list(scan_files(str(tmp_path), ['md'], workers, cache=None)) == [str(tmp_path / 'a' / 'b' / 'note.md')]
+
+
+def test_closing_a_scan_early(tmp_path):
+    files = make_tree(tmp_path)
+    scan = scan_files(str(tmp_path), workers=4, cache=None)
+    first = next(scan)
+    scan.close()
+    assert first in files
+    with pytest.raises(StopIteration):
+        next(scan)
+    # Nothing is left behind that would affect the next scan
+    assert set(scan_files(str(tmp_path), workers=4)) == files
+
+
+def test_scanning_a_file_is_an_error(tmp_path):
+    (tmp_path / 'a.md').write_text('a', encoding='utf-8')
+    with pytest.raises(ValueError):
+        list(scan_files(str(tmp_path / 'a.md')))
@@ -0,0 +1,81 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.dataset import (dataset_info, iter_row_groups, load_dataset, merge_dataset, migrate_pickle, read_rows,
+                         row_group_offsets, save_dataset)
+
+
+def make_rows(names, links=None):
+    return pd.DataFrame({
+        'filepath': [f'/vault/{name}.md' for name in names],
+        'filename': list(names),
+        'text': [f'text of {name}' for name in names],
+        'links': [list(links or []) for _ in names],
+    })
+
+
+def test_merge_rows_with_links_after_rows_without(tmp_path):
+    # The first row groups have no links at all, their schema alone would type links as list<null>
+    path = str(tmp_path / 'vault.parquet')
+    merge_dataset(path, make_rows([f'a{ix:04d}' for ix in range(2000)]), [])
+    merge_dataset(path, make_rows([f'b{ix:04d}' for ix in range(1000)], ['a0001']), [])
+    merge_dataset(path, make_rows(['a0500'], ['b0001', 'b0002']), ['/vault/a0500.md'])
+
+    dataset = load_dataset(path)
+    assert len(dataset) == 3000
+    assert pq.ParquetFile(path).schema_arrow.field('links').type == pa.list_(pa.string())
+    assert dataset.loc[dataset['filename'] == 'a0500', 'links'].iloc[0] == ['b0001', 'b0002']
+    assert dataset['links'].iloc[0] == []
+    assert dataset['links'].iloc[-1] == ['a0001']
+
+
+def test_streamed_frames_keep_a_typed_schema(tmp_path):
+    path = str(tmp_path / 'vault.parquet')
+    save_dataset(iter([make_rows(['a']), make_rows(['b'], ['a'])]), path)
+    assert load_dataset(path)['links'].tolist() == [[], ['a']]
+
+
+def test_rewriting_a_file_typed_list_null(tmp_path):
+    # Files written before the schema was carried over can hold list<null>
+    path = str(tmp_path / 'vault.parquet')
+    pq.write_table(pa.Table.from_pandas(make_rows(['a', 'c']), preserve_index=False), path)
+    assert pa.types.is_null(pq.ParquetFile(path).schema_arrow.field('links').type.value_type)
+    merge_dataset(path, make_rows(['b'], ['a']), [])
+    assert load_dataset(path)['links'].tolist() == [[], ['a'], []]
+
+
+def test_merge_keeps_filepath_order_and_drops_removed_files(tmp_path):
+    path = str(tmp_path / 'vault.parquet')
+    merge_dataset(path, make_rows([f'n{ix:03d}' for ix in range(0, 300, 2)]), [], row_group_size=16)
+    changed = make_rows(['n001', 'n004', 'n299'], ['x'])
+    merge_dataset(path, changed, ['/vault/n004.md', '/vault/n010.md', '/vault/n011.md'], row_group_size=16)
+
+    dataset = load_dataset(path)
+    expected = sorted({f'n{ix:03d}' for ix in range(0, 300, 2)} - {'n010'} | {'n001', 'n299'})
+    assert dataset['filename'].tolist() == expected
+    assert dataset.loc[dataset['filename'] == 'n004', 'links'].iloc[0] == ['x']
+    assert sum(len(frame) for frame in iter_row_groups(path)) == len(expected)
+    assert row_group_offsets(path)[-1] == len(expected)
+
+    info = dataset_info(path)
+    assert info['rows'] == info['files'] == len(expected)
+    assert info['columns'] == ['filepath', 'filename', 'text', 'links']
+
+
+def test_read_rows_in_the_requested_order(tmp_path):
+    path = str(tmp_path / 'vault.parquet')
+    save_dataset(make_rows([f'n{ix:03d}' for ix in range(100)]), path, row_group_size=7)
+    rows = read_rows(path, [93, 2, 50, 2], ['filename'])
+    assert rows['filename'].tolist() == ['n093', 'n002', 'n050', 'n002']
+    assert list(read_rows(path, [], ['text']).columns) == ['text']
+
+
+def test_migrate_pickle(tmp_path):
+    pickle_path = str(tmp_path / 'vault.pkl')
+    path = str(tmp_path / 'vault.parquet')
+    make_rows(['a', 'b'], ['c']).to_pickle(pickle_path)
+    assert migrate_pickle(pickle_path, path)
+    assert not (tmp_path / 'vault.pkl').exists()
+    assert load_dataset(path)['links'].tolist() == [['c'], ['c']]
+    assert not migrate_pickle(pickle_path, path)
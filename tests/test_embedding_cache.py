@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+import src.data_extract.cohere_api as capi
+from src.data_extract.embedding_cache import EmbeddingCache, chunk_key
+from tests.fakes import FakeClient
+
+
+def test_chunk_key_depends_on_model_truncate_and_text():
+    key = chunk_key('large', 'END', 'text')
+    assert key == chunk_key('large', 'END', 'text')
+    assert len(key) == 40
+    assert len({key, chunk_key('small', 'END', 'text'), chunk_key('large', 'NONE', 'text'), chunk_key('large', 'END', 'texts')}) == 4
+
+
+def test_hits_and_misses(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'cache.sqlite'))
+    cache.put_many([('a', [1, 2]), ('b', [3, 4])])
+    found = cache.get_many(['a', 'c', 'a'])
+    assert list(found) == ['a']
+    np.testing.assert_array_equal(found['a'], np.float32([1, 2]))
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert len(cache) == 2
+    cache.close()
+
+
+def test_evicts_least_recently_used(tmp_path):
+    # Every vector is 8 bytes, the limit holds two
+    cache = EmbeddingCache(str(tmp_path / 'cache.sqlite'), max_bytes=16)
+    cache.put_many([('a', [1, 1])])
+    cache.put_many([('b', [2, 2])])
+    cache.get_many(['a'])
+    cache.put_many([('c', [3, 3])])
+    assert set(cache.get_many(['a', 'b', 'c'])) == {'a', 'c'}
+    assert cache.size == 16
+    cache.close()
+
+
+def test_create_embeddings_reports_each_call(tmp_path, capsys):
+    cache = EmbeddingCache(str(tmp_path / 'cache.sqlite'))
+    client = FakeClient()
+    first = pd.DataFrame({'filename': ['a', 'b'], 'text': ['one two', 'three four']})
+    second = pd.DataFrame({'filename': ['c'], 'text': ['five six']})
+    capi.create_embeddings(first, None, cache=cache, client=client)
+    capi.create_embeddings(second, None, cache=cache, client=client)
+    reports = [line for line in capsys.readouterr().out.splitlines() if line.startswith('Embedding cache')]
+    assert reports == ['Embedding cache: 0 hits, 2 misses', 'Embedding cache: 0 hits, 1 misses']
+    embeddings, filenames = capi.create_embeddings(first, None, cache=cache, client=client)
+    assert capsys.readouterr().out.splitlines()[-1] == 'Embedding cache: 2 hits, 0 misses'
+    assert len(client.texts) == 3
+    assert list(filenames) == ['a', 'b']
+    cache.close()
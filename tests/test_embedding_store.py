@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.data_extract.cohere_api as capi
+from src.embedding_store import (HEADER_FILE, ShardedEmbeddings, load_header, load_keys, load_spans, load_store,
+                                 save_store, store_exists)
+from tests.fakes import FakeClient
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'store')
+    embeddings = np.arange(12, dtype=np.float32).reshape(4, 3)
+    spans = [[0, 0, 5], [0, 5, 9], [1, 0, 3], [2, 0, 1]]
+    save_store(path, embeddings, ['a', 'a', 'b', 'c'], spans, ['0' * 40] * 4, model='large')
+    loaded, filenames = load_store(path)
+    np.testing.assert_array_equal(loaded, embeddings)
+    assert isinstance(loaded, np.memmap)
+    assert filenames.tolist() == ['a', 'a', 'b', 'c']
+    assert load_spans(path).tolist() == spans
+    assert load_header(path)['shape'] == [4, 3] and load_header(path)['model'] == 'large'
+    assert not os.path.exists(os.path.join(path, HEADER_FILE + '.tmp'))
+
+
+def test_resave_drops_stale_optional_arrays(tmp_path):
+    path = str(tmp_path / 'store')
+    save_store(path, np.zeros((2, 2), np.float32), ['a', 'b'], [[0, 0, 1], [1, 0, 1]], ['0' * 40] * 2)
+    save_store(path, np.zeros((3, 2), np.float32), ['a', 'b', 'c'])
+    assert load_spans(path) is None and load_keys(path) is None
+
+
+def test_stopped_rebuild_leaves_no_store(tmp_path):
+    path = str(tmp_path / 'store')
+    client = FakeClient()
+    small = pd.DataFrame({'filename': ['a'], 'text': ['one']})
+    capi.create_embeddings(small, None, client=client, store_path=path)
+    assert store_exists(path)
+
+    large = pd.DataFrame({'filename': [f'f{ix}' for ix in range(30)], 'text': [f'text {ix}' for ix in range(30)]})
+    with pytest.raises(capi.EmbeddingCancelled):
+        capi.create_embeddings(large, None, client=client, batch_size=2, store_path=path, stop=lambda: True)
+    # The matrix was partly rewritten, the old header must not describe it
+    assert not store_exists(path)
+    with pytest.raises(ValueError):
+        load_store(path)
+
+    capi.create_embeddings(large, None, client=client, batch_size=2, store_path=path)
+    embeddings, filenames = load_store(path)
+    assert embeddings.shape == (30, 4) and len(filenames) == 30
+
+
+def test_sharded_rows(tmp_path):
+    paths = [str(tmp_path / 'first'), str(tmp_path / 'second')]
+    save_store(paths[0], np.zeros((2, 3), np.float32), ['a', 'b'])
+    save_store(paths[1], np.ones((3, 3), np.float32), ['c', 'd', 'e'])
+    sharded = ShardedEmbeddings(paths)
+    assert sharded.shape == (5, 3)
+    assert sharded.locate(3) == (paths[1], 1)
+    assert sharded.filenames.tolist() == ['a', 'b', 'c', 'd', 'e']
+    np.testing.assert_array_equal(sharded.take([1, 4]), [[0, 0, 0], [1, 1, 1]])
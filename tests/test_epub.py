@@ -0,0 +1,60 @@
+import xml.etree.ElementTree as ET
+from zipfile import ZIP_DEFLATED, ZipFile
+
+import pytest
+
+from benchmarks.synthetic import CONTAINER, PACKAGE
+from src.data_extract.epub import EpubExtract, parse_chapter
+
+DOCTYPES = {
+    'xhtml11': '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">',
+    'html5': '<!DOCTYPE html>',
+    'none': '',
+}
+
+
+def chapter(body, doctype=''):
+    return (f'<?xml version="1.0" encoding="utf-8"?>{doctype}\n<html xmlns="http://www.w3.org/1999/xhtml">'
+            f'<head><title>ignored</title><style>p {{}}</style></head><body>{body}</body></html>').encode('utf-8')
+
+
+@pytest.mark.parametrize('doctype', DOCTYPES.values(), ids=DOCTYPES.keys())
+def test_html_entities_resolve_with_any_doctype(doctype):
+    title, text = parse_chapter(chapter('<h1>Caf&eacute;</h1><p>one&nbsp;two &amp; &lt;three&gt; &#233;</p>', doctype))
+    assert title == 'Café'
+    assert text == 'Café\none\xa0two & <three> é'
+
+
+def test_inline_text_and_tails_are_kept():
+    title, text = parse_chapter(chapter('<h1>Title</h1><p>a <em>b</em> c<br/>d</p><script>skip()</script><div>e</div>'))
+    assert title == 'Title'
+    assert text == 'Title\na b c\nd\ne'
+
+
+def test_unknown_entities_and_broken_markup_still_raise():
+    with pytest.raises(ET.ParseError):
+        parse_chapter(chapter('<p>&notanentity;</p>'))
+    with pytest.raises(ET.ParseError):
+        parse_chapter(chapter('<p>unclosed'))
+
+
+def test_html5_chapters_are_extracted(tmp_path):
+    path = str(tmp_path / 'book.epub')
+    chapters = [chapter('<h1>First</h1><p>Caf&eacute; au lait</p>', DOCTYPES['html5']),
+                chapter('<p>More&hellip;</p>', DOCTYPES['html5']),
+                chapter('<h1>Second</h1><p>&laquo;Quoted&raquo;</p>')]
+    with ZipFile(path, 'w', ZIP_DEFLATED) as book:
+        book.writestr('mimetype', 'application/epub+zip')
+        book.writestr('META-INF/container.xml', CONTAINER)
+        book.writestr('OEBPS/nav.xhtml', chapter(''))
+        for ix, data in enumerate(chapters):
+            book.writestr(f'OEBPS/chapter{ix}.xhtml', data)
+        items = '\n'.join(f'<item id="chapter{ix}" href="chapter{ix}.xhtml" media-type="application/xhtml+xml"/>' for ix in range(3))
+        refs = '\n'.join(f'<itemref idref="chapter{ix}"/>' for ix in range(3))
+        book.writestr('OEBPS/content.opf', PACKAGE.format(title='Book', items=items, refs=refs))
+
+    extractor = EpubExtract()
+    assert extractor._load_data(path) == 2
+    assert [extractor.get_combined_title(ix) for ix in range(2)] == ['Book - First', 'Book - Second']
+    assert extractor.get_chapter_text(0) == 'Café au lait\nMore…'
+    assert extractor.get_chapter_text(1) == '«Quoted»'
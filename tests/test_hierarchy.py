@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from scipy.cluster.hierarchy import leaves_list, linkage, to_tree
+
+from src.color_utils import blend_pca_colors, color_to_hex
+from src.hierarchy import ClusterTree, hierarchy_exists, leaf_order
+
+
+def make_linkage(count, seed=0):
+    return linkage(np.random.default_rng(seed).normal(size=(count, 3)), 'ward')
+
+
+def chain_linkage(count):
+    # Every merge adds one leaf to the previous cluster, the deepest possible tree
+    rows = [[0, 1, 1.0, 2]] + [[ix, count + ix - 2, float(ix), ix + 1] for ix in range(2, count)]
+    return np.array(rows, dtype=np.float64)
+
+
+def test_leaf_order_matches_scipy():
+    linked = make_linkage(200)
+    order, start = leaf_order(linked)
+    np.testing.assert_array_equal(order, leaves_list(linked))
+    nodes = to_tree(linked, rd=True)[1]
+    for node in nodes:
+        assert sorted(order[start[node.id]:start[node.id] + node.count]) == sorted(node.pre_order())
+
+
+def test_round_trip(tmp_path):
+    linked = make_linkage(100)
+    tree = ClusterTree.from_linkage(linked)
+    np.testing.assert_array_equal(tree.to_linkage(), linked)
+    tree.save(str(tmp_path / 'hierarchy'))
+    loaded = ClusterTree.load(str(tmp_path / 'hierarchy'))
+    np.testing.assert_array_equal(loaded.to_linkage(), linked)
+    assert list(loaded.preorder()) == list(tree.preorder())
+
+
+def test_interrupted_save_is_not_loaded(tmp_path, monkeypatch):
+    path = str(tmp_path / 'hierarchy')
+    ClusterTree.from_linkage(make_linkage(100)).save(path)
+    save = np.save
+
+    def crash_on_order(file, array):
+        if str(file).endswith('order.npy'):
+            raise KeyboardInterrupt
+        save(file, array)
+    monkeypatch.setattr(np, 'save', crash_on_order)
+    with pytest.raises(KeyboardInterrupt):
+        ClusterTree.from_linkage(make_linkage(80, seed=2)).save(path)
+    assert not hierarchy_exists(path)
+    with pytest.raises(ValueError):
+        ClusterTree.load(path)
+
+
+def test_queries_match_to_tree():
+    linked = make_linkage(60, seed=1)
+    tree = ClusterTree.from_linkage(linked)
+    root, nodes = to_tree(linked, rd=True)
+    assert tree.root == root.id and len(tree) == len(nodes)
+    for node in nodes:
+        assert list(tree.leaves(node.id)) == node.pre_order()
+        if not node.is_leaf():
+            assert tree.children(node.id) == (node.left.id, node.right.id)
+            assert tree.parent[node.left.id] == node.id
+    assert list(tree.postorder())[-1] == tree.root
+    assert set(tree.ancestors(0)) <= set(range(60, len(tree)))
+
+
+def test_deep_tree_without_recursion():
+    count = 50000
+    tree = ClusterTree.from_linkage(chain_linkage(count))
+    assert tree.depth().max() == count - 1
+    assert sum(1 for _ in tree.preorder()) == 2 * count - 1
+    assert tree.contains(tree.root, np.arange(count)).all()
+
+
+def test_blended_colors_are_leaf_means():
+    linked = make_linkage(40)
+    colors = np.random.default_rng(2).random((40, 3))
+    blended = blend_pca_colors(linked, colors, 40)
+    tree = ClusterTree.from_linkage(linked)
+    for node in range(len(tree)):
+        np.testing.assert_allclose(blended[node], colors[tree.leaves(node)].mean(axis=0))
+
+
+def test_color_to_hex():
+    assert color_to_hex(np.array([[0, 0.5, 1], [1, 1, 1]])) == ['#0080ff', '#ffffff']
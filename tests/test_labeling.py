@@ -0,0 +1,88 @@
+import threading
+import time
+from hashlib import sha1
+
+import numpy as np
+from scipy.cluster.hierarchy import linkage
+
+from src.hierarchy import ClusterTree
+from src.labeling import LabelCache, ctfidf_keywords, label_hierarchy, subtree_hashes, term_counts
+
+TOPICS = ['cat kitten purr whiskers', 'rocket orbit launch booster']
+
+
+def make_corpus(per_topic=10):
+    # Two well separated topics, the root splits them into two clusters
+    texts = [f'{TOPICS[ix % 2]} note{ix}' for ix in range(2 * per_topic)]
+    points = np.array([[ix % 2 * 10.0, ix * 0.01] for ix in range(len(texts))])
+    keys = np.array([sha1(text.encode('utf-8')).hexdigest() for text in texts])
+    return ClusterTree.from_linkage(linkage(points, 'ward')), keys, texts
+
+
+class SlowLLM:
+    """
+    Answers every prompt with its first keyword, recording how many prompts were in flight at once
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, prompt):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        time.sleep(0.02)
+        with self._lock:
+            self.in_flight -= 1
+        return ' ' + prompt.split(': ')[1].split(',')[0] + '\nmore text'
+
+
+def test_subtree_hashes_depend_only_on_the_leaves():
+    tree, keys, _ = make_corpus()
+    hashes = subtree_hashes(tree, keys)
+    assert hashes.shape == (len(tree), 2)
+    # The same chunks under another tree shape still hash the same at the root
+    reordered = ClusterTree.from_linkage(linkage(np.random.default_rng(0).normal(size=(len(keys), 2)), 'average'))
+    np.testing.assert_array_equal(subtree_hashes(reordered, keys)[reordered.root], hashes[tree.root])
+    assert len({tuple(row) for row in hashes}) == len(tree)
+
+
+def test_label_cache_batches_lookups(tmp_path):
+    cache = LabelCache(str(tmp_path / 'labels.sqlite'))
+    cache.put_many((f'k{ix}', f'label {ix}', f'words {ix}') for ix in range(1200))
+    assert len(cache) == 1200
+    found = cache.get_many([f'k{ix}' for ix in range(0, 1300, 2)] + ['k0'])
+    assert len(found) == 600
+    assert found['k1198'] == ('label 1198', 'words 1198')
+    cache.close()
+
+
+def test_ctfidf_keywords_describe_each_cluster():
+    tree, _, texts = make_corpus()
+    counts, vocabulary = term_counts(texts, min_df=1)
+    children = [tree.left[tree.root], tree.right[tree.root]]
+    described = dict(ctfidf_keywords(tree, counts, vocabulary, children, top_k=4, batch_leaves=3))
+    assert sorted(sorted(terms) for terms in described.values()) == sorted(sorted(topic.split()) for topic in TOPICS)
+
+
+def test_label_hierarchy_prompts_concurrently_and_caches(tmp_path):
+    tree, keys, texts = make_corpus()
+    cache = LabelCache(str(tmp_path / 'labels.sqlite'))
+    llm = SlowLLM()
+    labels, keywords = label_hierarchy(tree, keys, lambda: texts, cache, min_size=5, min_df=1, llm=llm, llm_name='fake', concurrency=4)
+    labelled = np.flatnonzero(labels != '')
+    assert len(labelled) == np.sum(np.asarray(tree.size) >= 5) == llm.calls
+    assert llm.most_in_flight > 1
+    for node in labelled:
+        assert labels[node] == keywords[node].split(', ')[0]
+
+    # Nothing changed, every label comes from the cache and the texts are never read
+    again = SlowLLM()
+    cached, _ = label_hierarchy(tree, keys, None, cache, min_size=5, min_df=1, llm=again, llm_name='fake')
+    assert again.calls == 0
+    np.testing.assert_array_equal(cached, labels)
+    cache.close()
@@ -0,0 +1,80 @@
+import importlib
+import os
+from configparser import ConfigParser
+
+import pytest
+
+from src.data_extract import DataExtract
+from src.dataset import dataset_info, load_dataset
+
+
+@pytest.fixture
+def main(monkeypatch):
+    # src.main exits when it is imported outside the project root
+    monkeypatch.setattr(os, 'getcwd', lambda: '/checkout/fractal-embeddings')
+    return importlib.import_module('src.main')
+
+
+@pytest.fixture
+def extracted(monkeypatch):
+    # The files every load_data call hands to the extractor
+    calls = []
+    extract_files = DataExtract.extract_files
+
+    def record(self, files_to_extract, *args, **kwargs):
+        calls.append(sorted(files_to_extract))
+        return extract_files(self, files_to_extract, *args, **kwargs)
+    monkeypatch.setattr(DataExtract, 'extract_files', record)
+    return calls
+
+
+def write_note(vault, name, text):
+    path = vault / f'{name}.md'
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+
+def test_load_data_only_extracts_changed_files(tmp_path, main, extracted):
+    vault = tmp_path / 'vault'
+    output = tmp_path / 'output'
+    vault.mkdir()
+    output.mkdir()
+    paths = {name: write_note(vault, name, f'{name} links to [[b]]') for name in 'abcd'}
+    config = ConfigParser()
+    config.read_dict({'data': {'input_folders': f'md:{vault}', 'output_folder': str(output)}})
+
+    data = main.load_data(config)
+    assert data == {'vault': str(output / 'vault.parquet')}
+    assert extracted == [sorted(paths.values())]
+
+    # Unchanged files are skipped without extracting anything
+    main.load_data(config)
+    assert len(extracted) == 1
+
+    write_note(vault, 'b', 'b was edited and links to [[c]] and [[d]]')
+    os.utime(paths['b'], ns=(0, os.stat(paths['b']).st_mtime_ns + 10 ** 9))
+    os.remove(paths['c'])
+    paths['e'] = write_note(vault, 'e', 'e is new')
+    main.load_data(config)
+    assert extracted[1] == sorted([paths['b'], paths['e']])
+
+    dataset = load_dataset(data['vault'])
+    assert dataset['filepath'].tolist() == sorted([paths['a'], paths['b'], paths['d'], paths['e']])
+    assert dataset['filename'].tolist() == ['a', 'b', 'd', 'e']
+    assert dataset['text'].tolist()[1] == 'b was edited and links to [[c]] and [[d]]'
+    assert dataset['links'].tolist() == [['b'], ['c', 'd'], ['b'], []]
+    assert dataset_info(data['vault'])['files'] == 4
+
+
+def test_touching_a_file_without_changing_it_extracts_nothing(tmp_path, main, extracted):
+    vault = tmp_path / 'vault'
+    output = tmp_path / 'output'
+    vault.mkdir()
+    output.mkdir()
+    path = write_note(vault, 'a', 'unchanged')
+    config = ConfigParser()
+    config.read_dict({'data': {'input_folders': f'md:{vault}', 'output_folder': str(output)}})
+    main.load_data(config)
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+    main.load_data(config)
+    assert extracted == [[path]]
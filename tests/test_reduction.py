@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from sklearn.decomposition import IncrementalPCA
+
+import src.reduction
+from src.embedding_store import ShardedEmbeddings, load_store, save_store, store_exists
+from src.reduction import _partial_fit, run_reduction, update_reduction
+from src.utils import load_pickle
+
+
+def make_rows(count, seed=0):
+    return np.random.default_rng(seed).standard_normal((count, 16)).astype(np.float32)
+
+
+def make_keys(start, count):
+    return np.array([f'{ix:040d}' for ix in range(start, start + count)], dtype='S40')
+
+
+def test_partial_fit_merges_the_last_small_block():
+    reducer = IncrementalPCA(n_components=3)
+    assert _partial_fit(reducer, make_rows(21), block_size=10) == 21
+    assert reducer.n_samples_seen_ == 21
+
+
+def test_partial_fit_skips_fewer_rows_than_components():
+    reducer = IncrementalPCA(n_components=3)
+    assert _partial_fit(reducer, make_rows(2)) == 0
+    assert not hasattr(reducer, 'n_samples_seen_')
+
+
+def test_pca_carries_rows_too_few_to_fit(tmp_path):
+    state_path = str(tmp_path / 'pca5_reducer.pkl')
+    embeddings, keys = make_rows(200), make_keys(0, 200)
+    update_reduction(embeddings, keys, 'pca5', state_path)
+
+    # Three new rows are fewer than the components, they wait for the next run
+    embeddings, keys = np.concatenate([embeddings, make_rows(3, 1)]), make_keys(0, 203)
+    reduced = update_reduction(embeddings, keys, 'pca5', state_path)
+    state = load_pickle(state_path)
+    assert reduced.shape == (203, 5)
+    assert len(state['fitted']) == 200 and state['reducer'].n_samples_seen_ == 200
+
+    embeddings, keys = np.concatenate([embeddings, make_rows(3, 2)]), make_keys(0, 206)
+    update_reduction(embeddings, keys, 'pca5', state_path)
+    state = load_pickle(state_path)
+    assert len(state['fitted']) == 206 and state['reducer'].n_samples_seen_ == 206
+    # The layout itself was still fitted on the first rows
+    assert len(state['keys']) == 200
+
+
+def test_pca_drift_accumulates_until_refit(tmp_path, capsys):
+    state_path = str(tmp_path / 'pca5_reducer.pkl')
+    embeddings, keys = make_rows(100), make_keys(0, 100)
+    update_reduction(embeddings, keys, 'pca5', state_path, refit_threshold=0.1)
+    # Two updates of 6 rows each, 11% of the rows are then outside the fitted layout
+    for count in (106, 112):
+        embeddings, keys = np.concatenate([embeddings, make_rows(6, count)]), make_keys(0, count)
+        update_reduction(embeddings, keys, 'pca5', state_path, refit_threshold=0.1)
+    output = capsys.readouterr().out.splitlines()
+    assert output[0].startswith('pca5: projecting 5.7%')
+    assert output[1] == 'pca5: 10.7% of rows are unseen, refitting'
+    assert len(load_pickle(state_path)['keys']) == 112
+
+
+def test_interrupted_projection_leaves_no_store(tmp_path, monkeypatch):
+    store_path = str(tmp_path / 'notes_embeddings')
+    combined_path = str(tmp_path / 'combined_embeddings.json')
+    embeddings = make_rows(300)
+    save_store(store_path, embeddings, [f'file{ix}' for ix in range(300)], keys=make_keys(0, 300))
+    ShardedEmbeddings([store_path]).save(combined_path)
+    reduction_path = run_reduction(combined_path, 'pca5', str(tmp_path))
+
+    transform = src.reduction._transform
+
+    def interrupted(reducer, embeddings, rows=None, block_size=None, out_path=None):
+        # Half of the rows are written into the matrix before the run stops
+        transform(reducer, embeddings[:150], rows, out_path=out_path)
+        raise KeyboardInterrupt
+    monkeypatch.setattr(src.reduction, '_transform', interrupted)
+    save_store(store_path, np.concatenate([embeddings, make_rows(5, 1)]), [f'file{ix}' for ix in range(305)], keys=make_keys(0, 305))
+    with pytest.raises(KeyboardInterrupt):
+        run_reduction(combined_path, 'pca5', str(tmp_path))
+    assert not store_exists(reduction_path)
+
+    monkeypatch.setattr(src.reduction, '_transform', transform)
+    run_reduction(combined_path, 'pca5', str(tmp_path))
+    assert load_store(reduction_path, mmap_mode=None)[0].shape == (305, 5)
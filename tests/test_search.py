@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+
+from src.embedding_store import ShardedEmbeddings, save_store
+from src.search import ChunkSearch, IVFIndex, index_matches, normalize_rows, update_index
+from src.search.exact import ExactIndex, knn_to_csr
+
+
+def make_embeddings(rows, dim=32, clusters=20, seed=0):
+    random = np.random.default_rng(seed)
+    centers = random.normal(size=(clusters, dim)).astype(np.float32)
+    return centers[random.integers(clusters, size=rows)] + 0.3 * random.normal(size=(rows, dim)).astype(np.float32)
+
+
+def brute_force(embeddings, queries, k):
+    scores = normalize_rows(queries) @ normalize_rows(embeddings).T
+    return np.argsort(-scores, axis=1, kind='stable')[:, :k]
+
+
+def make_keys(start, count):
+    return np.array([f'{ix:040d}' for ix in range(start, start + count)], dtype='S40')
+
+
+def test_exact_index_matches_brute_force():
+    embeddings, queries = make_embeddings(1000), make_embeddings(20, seed=1)
+    ids, scores = ExactIndex(embeddings, block_size=128).search(queries, 5, query_batch=7)
+    np.testing.assert_array_equal(ids, brute_force(embeddings, queries, 5))
+    assert np.all(np.diff(scores, axis=1) <= 0)
+
+
+@pytest.mark.parametrize('k', [6, 8])
+def test_knn_graph_has_no_self_edges_when_k_covers_every_row(k):
+    embeddings = make_embeddings(6)
+    ids, scores = ExactIndex(embeddings, block_size=4).knn_graph(k)
+    rows = np.arange(6)[:, None]
+    assert not np.any(ids == rows)
+    # Five other rows exist, the remaining slots are padding
+    assert np.all(ids[:, :5] >= 0) and np.all(ids[:, 5:] == -1) and np.all(scores[:, 5:] == -np.inf)
+    graph = knn_to_csr(ids, scores, symmetric=False)
+    assert graph.diagonal().tolist() == [0] * 6
+    assert graph.nnz == 30
+
+
+def test_knn_to_csr_drops_excluded_rows():
+    # Which -inf slot argpartition keeps is unspecified, an excluded row can come back instead of padding
+    ids = np.array([[1, 0], [0, 1]])
+    scores = np.array([[0.5, -np.inf], [0.5, -np.inf]], dtype=np.float32)
+    graph = knn_to_csr(ids, scores)
+    assert graph.toarray().tolist() == [[0, 0.5], [0.5, 0]]
+
+
+def test_ivf_recall():
+    embeddings, queries = make_embeddings(5000), make_embeddings(50, seed=1)
+    truth = brute_force(embeddings, queries, 10)
+    index = IVFIndex(n_lists=32).build(embeddings, block_size=512)
+    recall = np.mean([len(np.intersect1d(index.query(query, 10, 8)[0], expected)) / 10
+                      for query, expected in zip(queries, truth)])
+    assert recall >= 0.9
+    # Probing every list is exhaustive
+    assert all(np.array_equal(np.sort(index.query(query, 10, 32)[0]), np.sort(expected)) for query, expected in zip(queries, truth))
+
+
+def test_ivf_build_into_memmap_matches_memory(tmp_path):
+    embeddings = make_embeddings(2000)
+    in_memory = IVFIndex(n_lists=16).build(embeddings, block_size=300)
+    mapped = IVFIndex(n_lists=16).build(embeddings, block_size=300, vectors_path=str(tmp_path / 'vectors.npy'))
+    assert isinstance(mapped._vectors, np.memmap)
+    np.testing.assert_array_equal(in_memory._vectors, mapped._vectors)
+    mapped.save(str(tmp_path))
+    loaded = IVFIndex.load(str(tmp_path))
+    query = embeddings[7]
+    np.testing.assert_array_equal(loaded.query(query, 5)[0], in_memory.query(query, 5)[0])
+
+
+def test_added_rows_are_found():
+    embeddings = make_embeddings(1000)
+    index = IVFIndex(n_lists=8).build(embeddings)
+    extra = make_embeddings(10, seed=3)
+    index.add(extra, np.arange(1000, 1010))
+    assert index.query(extra[4], 1)[0][0] == 1004
+    index.compact()
+    assert len(index) == 1010 and index.query(extra[4], 1, 8)[0][0] == 1004
+
+
+def save_combined(output_folder, embeddings, keys):
+    store_path = str(output_folder / 'notes_embeddings')
+    save_store(store_path, embeddings, [f'file{ix}' for ix in range(len(embeddings))], keys=keys)
+    combined = ShardedEmbeddings([store_path])
+    combined.save(str(output_folder / 'combined_embeddings.json'))
+    return combined
+
+
+def test_chunk_search_refuses_a_stale_index(tmp_path):
+    embeddings = make_embeddings(300)
+    combined = save_combined(tmp_path, embeddings, make_keys(0, 300))
+    update_index(combined, str(tmp_path / 'ann_index'), n_lists=4)
+    assert ChunkSearch(str(tmp_path)).query(embeddings[5], 1)[0]['filename'] == 'file5'
+
+    # The pipeline ran again over other chunks but the index was not rebuilt
+    embeddings = make_embeddings(200, seed=4)
+    save_combined(tmp_path, embeddings, make_keys(1000, 200))
+    with pytest.raises(ValueError):
+        ChunkSearch(str(tmp_path))
+    search = ChunkSearch(str(tmp_path), update=True)
+    assert search.query(embeddings[5], 1)[0]['filename'] == 'file5'
+
+
+def test_interrupted_index_update_is_not_loaded(tmp_path, monkeypatch):
+    embeddings = make_embeddings(300)
+    index_path = str(tmp_path / 'ann_index')
+    combined = save_combined(tmp_path, embeddings[:250], make_keys(0, 250))
+    update_index(combined, index_path, n_lists=4)
+
+    save = np.save
+
+    def crash_on_offsets(path, array):
+        if str(path).endswith('offsets.npy'):
+            raise KeyboardInterrupt
+        save(path, array)
+    monkeypatch.setattr(np, 'save', crash_on_offsets)
+    combined = save_combined(tmp_path, embeddings, make_keys(0, 300))
+    with pytest.raises(KeyboardInterrupt):
+        update_index(combined, index_path)
+    assert not index_matches(combined, index_path)
+    with pytest.raises(FileNotFoundError):
+        IVFIndex.load(index_path)
+
+    monkeypatch.setattr(np, 'save', save)
+    index = update_index(combined, index_path, n_lists=4)
+    assert len(index) == 300 and index_matches(combined, index_path)
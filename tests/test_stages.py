@@ -0,0 +1,120 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from src.stages import StageRunner
+
+
+class Stage:
+    """
+    A stage writing its value to a file, counting how often it is built
+    """
+
+    def __init__(self, path, value='built', error=None, check=None):
+        self.path = path
+        self.value = value
+        self.error = error
+        self.check = check
+        self.builds = 0
+
+    def build(self):
+        self.builds += 1
+        if self.check is not None:
+            self.check()
+        if self.error is not None:
+            raise self.error
+        self.path.write_text(self.value)
+        return self.value
+
+    def load(self):
+        return self.path.read_text()
+
+    def exists(self):
+        return self.path.exists()
+
+    def args(self):
+        return self.build, self.load, self.exists
+
+
+def recorded(folder):
+    with open(folder / 'stages.json', 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_up_to_date_stages_are_loaded(tmp_path):
+    stage = Stage(tmp_path / 'a.txt')
+    assert StageRunner(str(tmp_path)).run('a', *stage.args(), {'size': 1}) == 'built'
+    stage.value = 'not rebuilt'
+    assert StageRunner(str(tmp_path)).run('a', *stage.args(), {'size': 1}) == 'built'
+    assert stage.builds == 1
+
+
+def test_changed_params_missing_artifacts_and_stale_inputs_rebuild(tmp_path):
+    upstream = Stage(tmp_path / 'a.txt')
+    downstream = Stage(tmp_path / 'b.txt')
+    runner = StageRunner(str(tmp_path))
+    runner.run('a', *upstream.args(), {'size': 1})
+    runner.run('b', *downstream.args(), None, ['a'])
+
+    runner = StageRunner(str(tmp_path))
+    runner.run('a', *upstream.args(), {'size': 2})
+    runner.run('b', *downstream.args(), None, ['a'])
+    assert (upstream.builds, downstream.builds) == (2, 2)
+
+    (tmp_path / 'b.txt').unlink()
+    runner = StageRunner(str(tmp_path))
+    runner.run('a', *upstream.args(), {'size': 2})
+    runner.run('b', *downstream.args(), None, ['a'])
+    assert (upstream.builds, downstream.builds) == (2, 3)
+
+
+def test_recorded_stages_feed_later_fingerprints(tmp_path):
+    stage = Stage(tmp_path / 'b.txt')
+    for files in ({'x': 'h1'}, {'x': 'h1'}, {'x': 'h2'}):
+        runner = StageRunner(str(tmp_path))
+        runner.record('data', files)
+        runner.run('b', *stage.args(), None, ['data'])
+    assert stage.builds == 2
+    with pytest.raises(ValueError):
+        StageRunner(str(tmp_path)).fingerprint('data')
+
+
+def test_fingerprint_is_removed_before_a_rebuild(tmp_path):
+    stage = Stage(tmp_path / 'a.txt')
+    StageRunner(str(tmp_path)).run('a', *stage.args(), {'size': 1})
+    assert 'a' in recorded(tmp_path)
+
+    # The build sees no fingerprint, then fails: the old artifact must not pass as up to date
+    def check():
+        assert 'a' not in recorded(tmp_path)
+    failing = Stage(tmp_path / 'a.txt', error=RuntimeError('interrupted'), check=check)
+    with pytest.raises(RuntimeError):
+        StageRunner(str(tmp_path)).run('a', *failing.args(), {'size': 2})
+    assert 'a' not in recorded(tmp_path)
+    assert failing.builds == 1
+
+    StageRunner(str(tmp_path)).run('a', *stage.args(), {'size': 1})
+    assert stage.builds == 2
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_run_many_records_the_stages_that_finished(tmp_path, workers):
+    executor = ThreadPoolExecutor(workers) if workers > 0 else None
+    good = Stage(tmp_path / 'good.txt')
+    bad = Stage(tmp_path / 'bad.txt', error=RuntimeError('failed'))
+    stages = [('good', *good.args(), {'n': 1}, []), ('bad', *bad.args(), {'n': 1}, [])]
+    if executor is None:
+        # Without an executor stages are built in order, so the failing one goes first to check the other is skipped
+        stages.reverse()
+    with pytest.raises(RuntimeError):
+        StageRunner(str(tmp_path)).run_many(stages, executor)
+    assert 'bad' not in recorded(tmp_path)
+    assert ('good' in recorded(tmp_path)) == (executor is not None)
+
+    bad.error = None
+    results = StageRunner(str(tmp_path)).run_many(stages, executor)
+    assert results == {'good': 'built', 'bad': 'built'}
+    assert (good.builds, bad.builds) == (1, 2)
+    if executor is not None:
+        executor.shutdown()